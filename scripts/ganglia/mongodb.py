@@ -1,60 +1,206 @@
-from subprocess import Popen, PIPE
-from bson import json_util
+from pymongo.errors import PyMongoError
+from pymongo import MongoClient
+from collections import namedtuple
+from bson.son import SON
 from time import time
 import logging
 import logging.handlers
+import threading
 import socket
-import json
-import re
 
-MAX_DATA_AGE = 5    # seconds
+REFRESH_INTERVAL = 5    # seconds
+MAX_STALENESS = 30      # seconds
+CONN_TIMEOUT_MS = 2000  # milliseconds
+
+# optional serverStatus sections that can be left out of the response
+SERVER_STATUS_SECTIONS = [
+    'asserts', 'catalogStats', 'electionMetrics', 'extra_info', 'flowControl', 'freeMonitoring',
+    'globalLock', 'locks', 'logicalSessionRecordCache', 'metrics', 'mirroredReads', 'opLatencies',
+    'opReadConcernCounters', 'opcountersRepl', 'oplogTruncation', 'repl', 'security',
+    'shardingStatistics', 'storageEngine', 'tcmalloc', 'trafficRecording', 'transactions',
+    'transportSecurity', 'twoPhaseCommitCoordinator', 'wiredTiger',
+]
+
+# value of a metric computed from two serverStatus paths, either as num / den of the
+# latest snapshot or as the ratio of their increments since the previous snapshot
+Ratio = namedtuple('Ratio', ['num', 'den'])
+IntervalRatio = namedtuple('IntervalRatio', ['num', 'den'])
+
+WT_CACHE = ('wiredTiger', 'cache')
+WT_TICKETS = ('wiredTiger', 'concurrentTransactions')
+
+# metric name (after <server_name>_mongodb_), value_type, units, slope, format, description and
+# value, either a serverStatus path, a Ratio or an IntervalRatio of two paths
+METRICS = [
+    ('conn_current',     'int',   'Connections',    'both',     '%i',   'Current Connections',
+     ('connections', 'current')),
+    ('conn_available',   'int',   'Connections',    'both',     '%i',   'Current Available Connections',
+     ('connections', 'available')),
+    ('conn_total',       'int',   'Connections',    'both',     '%i',   'Current Total Connections',
+     ('connections', 'totalCreated')),
+    ('net_bytes_in',     'int',   'Bytes/Sec',      'positive', '%i',   'Bytes Received',
+     ('network', 'bytesIn')),
+    ('net_bytes_out',    'int',   'Bytes/Sec',      'positive', '%i',   'Bytes Sent',
+     ('network', 'bytesOut')),
+    ('op_count_insert',  'int',   'Operations/sec', 'positive', '%i',   'Oplog Inserts/sec',
+     ('opcounters', 'insert')),
+    ('op_count_query',   'int',   'Operations/sec', 'positive', '%i',   'Oplog Queries/sec',
+     ('opcounters', 'query')),
+    ('op_count_update',  'int',   'Operations/sec', 'positive', '%i',   'Oplog Updates/sec',
+     ('opcounters', 'update')),
+    ('op_count_delete',  'int',   'Operations/sec', 'positive', '%i',   'Oplog Deletes/sec',
+     ('opcounters', 'delete')),
+    ('op_count_getmore', 'int',   'Operations/sec', 'positive', '%i',   'Oplog Getmore/sec',
+     ('opcounters', 'getmore')),
+    ('op_count_command', 'int',   'Operations/sec', 'positive', '%i',   'Oplog Commands/sec',
+     ('opcounters', 'command')),
+    ('mem_resident',     'int',   'KB',             'both',     '%i',   'Memory Resident',
+     ('mem', 'resident')),
+    ('mem_virtual',      'int',   'KB',             'both',     '%i',   'Memory Virtual',
+     ('mem', 'virtual')),
+    ('lat_reads_avg',    'float', 'Microseconds',   'both',     '%.1f', 'Average Read Latency',
+     IntervalRatio(('opLatencies', 'reads', 'latency'), ('opLatencies', 'reads', 'ops'))),
+    ('lat_writes_avg',   'float', 'Microseconds',   'both',     '%.1f', 'Average Write Latency',
+     IntervalRatio(('opLatencies', 'writes', 'latency'), ('opLatencies', 'writes', 'ops'))),
+    ('lat_commands_avg', 'float', 'Microseconds',   'both',     '%.1f', 'Average Command Latency',
+     IntervalRatio(('opLatencies', 'commands', 'latency'), ('opLatencies', 'commands', 'ops'))),
+    ('queue_total',      'int',   'Operations',     'both',     '%i',   'Operations Queued for Locks',
+     ('globalLock', 'currentQueue', 'total')),
+    ('queue_readers',    'int',   'Operations',     'both',     '%i',   'Read Operations Queued for Locks',
+     ('globalLock', 'currentQueue', 'readers')),
+    ('queue_writers',    'int',   'Operations',     'both',     '%i',   'Write Operations Queued for Locks',
+     ('globalLock', 'currentQueue', 'writers')),
+    ('cache_used_ratio', 'float', 'Ratio',          'both',     '%.3f', 'WiredTiger Cache Used',
+     Ratio(WT_CACHE + ('bytes currently in the cache',), WT_CACHE + ('maximum bytes configured',))),
+    ('cache_dirty_ratio', 'float', 'Ratio',         'both',     '%.3f', 'WiredTiger Cache Dirty',
+     Ratio(WT_CACHE + ('tracked dirty bytes in the cache',), WT_CACHE + ('maximum bytes configured',))),
+    ('tickets_read_available',  'int', 'Tickets',   'both',     '%i',   'WiredTiger Read Tickets Available',
+     WT_TICKETS + ('read', 'available')),
+    ('tickets_write_available', 'int', 'Tickets',   'both',     '%i',   'WiredTiger Write Tickets Available',
+     WT_TICKETS + ('write', 'available')),
+]
+
+# cumulative counters, served from the last snapshot even when stale: a 0 would read as a reset to the monitor
+COUNTERS = set(m[0] for m in METRICS if m[3] == 'positive')
+
+# not read from serverStatus, age of the snapshot metrics are read from
+DATA_AGE_METRIC = ('data_age', 'float', 'Seconds', 'both', '%.1f', 'Age of serverStatus snapshot', None)
+
+
+def metric_paths(value):
+    return list(value) if isinstance(value, (Ratio, IntervalRatio)) else [value]
+
+
+def get_path(dct, path):
+    for key in path:
+        dct = dct[key]
+    return dct
+
+
+def calc_values(server_status, prev_server_status):
+    """
+    Value of every metric in METRICS from the latest and the previous serverStatus snapshot.
+    Interval ratios are 0 without a previous snapshot or without increments since it, and
+    metrics missing from serverStatus (e.g. on another storage engine) are 0.
+    """
+    values = {}
+    for name, _, _, _, _, _, value in METRICS:
+        try:
+            if isinstance(value, Ratio):
+                den = get_path(server_status, value.den)
+                values[name] = float(get_path(server_status, value.num)) / den if den else 0.0
+            elif isinstance(value, IntervalRatio):
+                values[name] = 0.0
+                if prev_server_status:
+                    den = get_path(server_status, value.den) - get_path(prev_server_status, value.den)
+                    num = get_path(server_status, value.num) - get_path(prev_server_status, value.num)
+                    values[name] = float(num) / den if den > 0 else 0.0
+            else:
+                values[name] = get_path(server_status, value)
+        except KeyError:
+            values[name] = 0
+    return values
+
 
 server_name = ''
 conn_pair = ('', 0)
+client = None
+collector = None
 descriptors = []
 last_data = {}
+max_staleness = MAX_STALENESS
 logger = None
 
 
-def get_command(cmd_name):
-    global conn_pair
+def get_client():
+    global client, conn_pair
 
-    cmds = {
-        'server_status': 'db.serverStatus()',
-        'repl_status': 'rs.status()'
-    }
+    if client is None:
+        host, port = conn_pair
+        client = MongoClient(host, port,
+            directConnection=True,
+            connectTimeoutMS=CONN_TIMEOUT_MS,
+            socketTimeoutMS=CONN_TIMEOUT_MS,
+            serverSelectionTimeoutMS=CONN_TIMEOUT_MS
+        )
+    return client
 
-    host, port = conn_pair
-    args = [
-        'mongo',
-        '--host', host,
-        '--port', str(port),
-        '--quiet', '--eval',
-        'JSON.stringify({})'.format(cmds[cmd_name])
-    ]
 
-    return args
+def close_client():
+    global client
 
+    if client is not None:
+        client.close()
+        client = None
+
+
+def get_server_status():
+    """
+    serverStatus of the local mongod as typed BSON, leaving out the sections
+    no descriptor reads, over a connection kept across calls.
+    """
+    needed = set(path[0] for m in METRICS for path in metric_paths(m[-1]))
+    cmd = SON([('serverStatus', 1)] + [(s, 0) for s in SERVER_STATUS_SECTIONS if s not in needed])
+
+    try:
+        return get_client().admin.command(cmd)
+    except PyMongoError:
+        # drop the connection, the next refresh reconnects
+        close_client()
+        raise
 
-def get_response(cmd):
-    p = Popen(cmd,
-        bufsize=16384,
-        close_fds=True,
-        stdout=PIPE,
-        stderr=PIPE
-    )
 
-    res, err = p.communicate()
-    if err:
-        ok = False
-        data = err
-    else:
-        ok = True
-        # remove objects
-        data = re.sub('(?:NumberLong|ISODate|ObjectId)\((.*)\)', r'\1', res)
-        data = re.sub('(?:Timestamp)\((.*)\)', r'"(\1)"', data)
-        data = json.loads(data, object_hook=json_util.object_hook)
-    return ok, data
+class Collector(threading.Thread):
+    """
+    Refreshes last_data with serverStatus and the metric values computed from
+    it every interval seconds in the background, so that metric_handler never
+    waits on mongod.
+    """
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name='gmond-mongod-collector')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        global last_data, logger
+
+        while not self.stopped.is_set():
+            try:
+                server_status = get_server_status()
+                prev_server_status = last_data['server_status'] if last_data else None
+                # replaced as a whole, readers always see a consistent snapshot
+                last_data = {
+                    'timestamp': time(),
+                    'server_status': server_status,
+                    'values': calc_values(server_status, prev_server_status)
+                }
+            except Exception as e:
+                logger.error("collector exception: {}".format(e))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
 
 
 def metric_init(params):
@@ -72,7 +218,7 @@ def metric_init(params):
         'groups': GROUPS
         }
     """
-    global server_name, conn_pair, descriptors, logger
+    global server_name, conn_pair, collector, descriptors, max_staleness, logger
 
     server_name = params['server_name'] if 'server_name' in params else 'mongod_server'
     TIME_MAX = 60
@@ -92,7 +238,7 @@ def metric_init(params):
     logger.addHandler(slh)
     logger.debug("metric_init called with arg: {}".format(params))
 
-    host, port, max_data_age = 'localhost', 27017, TIME_MAX
+    host, port, max_data_age, refresh_interval = 'localhost', 27017, TIME_MAX, REFRESH_INTERVAL
     try:
         if 'host' in params:
             host = params['host']
@@ -100,157 +246,33 @@ def metric_init(params):
             port = int(params['port'])
         if 'time_max' in params:
             max_data_age = int(params['time_max'])
-    except TypeError as e:
+        if 'refresh_interval' in params:
+            refresh_interval = float(params['refresh_interval'])
+        if 'max_staleness' in params:
+            max_staleness = float(params['max_staleness'])
+    except (TypeError, ValueError) as e:
         logger.error("error: {}".format(e))
 
     conn_pair = (host, port)
 
+    collector = Collector(refresh_interval)
+    collector.start()
+
     try:
 
         descriptors = [
             {
-                'name': server_name + '_mongodb_conn_current',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Connections',
-                'slope': 'both',
-                'format': '%i',
-                'description': 'Current Connections',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_conn_available',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Connections',
-                'slope': 'both',
-                'format': '%i',
-                'description': 'Current Available Connections',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_conn_total',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Connections',
-                'slope': 'both',
-                'format': '%i',
-                'description': 'Current Total Connections',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_net_bytes_in',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Bytes/Sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Bytes Received',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_net_bytes_out',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Bytes/Sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Bytes Sent',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_insert',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Inserts/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_query',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Queries/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_update',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Updates/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_delete',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Deletes/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_getmore',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Getmore/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_op_count_command',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'Operations/sec',
-                'slope': 'positive',
-                'format': '%i',
-                'description': 'Oplog Commands/sec',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_mem_resident',
-                'call_back': metric_handler,
-                'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'KB',
-                'slope': 'both',
-                'format': '%i',
-                'description': 'Memory Resident',
-                'groups': GROUPS
-            },
-            {
-                'name': server_name + '_mongodb_mem_virtual',
+                'name': server_name + '_mongodb_' + name,
                 'call_back': metric_handler,
                 'time_max': max_data_age,
-                'value_type': 'int',
-                'units': 'KB',
-                'slope': 'both',
-                'format': '%i',
-                'description': 'Memory Virtual',
+                'value_type': value_type,
+                'units': units,
+                'slope': slope,
+                'format': fmt,
+                'description': description,
                 'groups': GROUPS
             }
+            for name, value_type, units, slope, fmt, description, _ in METRICS + [DATA_AGE_METRIC]
         ]
 
         return descriptors
@@ -259,50 +281,32 @@ def metric_init(params):
 
 
 def metric_cleanup():
-    global logger
+    global collector, logger
     logger.debug("metric_cleanup called")
+    if collector is not None:
+        collector.stop()
+        collector.join(CONN_TIMEOUT_MS / 1000.0)
+    close_client()
 
 
 def metric_handler(name):
-    global server_name, last_data, logger
+    global server_name, last_data, max_staleness, logger
 
     now = time()
     data = 0
+    # only reads the snapshot kept by the collector thread
+    snapshot = last_data
+    desc_key = name[len(server_name + '_mongodb_'):]
     try:
-        if not last_data or last_data['timestamp'] < (now - MAX_DATA_AGE):
-            ok, resp = get_response(get_command('server_status'))
+        age = now - snapshot['timestamp'] if snapshot else float(max_staleness)
 
-            if not ok:
-                raise Exception(resp)
+        if desc_key == 'data_age':
+            return age
 
-            server_status = resp
-            last_data = {
-                'timestamp': now,
-                'server_status': server_status
-            }
-        else:
-            # using cached data
-            server_status = last_data['server_status']
-
-        descriptor_dict = {
-            'conn_current':     ('connections', 'current'),
-            'conn_available':   ('connections', 'available'),
-            'conn_total':       ('connections', 'totalCreated'),
-            'net_bytes_in':     ('network', 'bytesIn'),
-            'net_bytes_out':    ('network', 'bytesOut'),
-            'op_count_insert':  ('opcounters', 'insert'),
-            'op_count_query':   ('opcounters', 'query'),
-            'op_count_update':  ('opcounters', 'update'),
-            'op_count_delete':  ('opcounters', 'delete'),
-            'op_count_getmore': ('opcounters', 'getmore'),
-            'op_count_command': ('opcounters', 'command'),
-            'mem_resident':     ('mem', 'resident'),
-            'mem_virtual':      ('mem', 'virtual'),
-        }
-        offset = len(server_name + '_mongodb_')
-        desc_key = name[offset:]
-        k1, k2 = descriptor_dict[desc_key]
-        data = server_status[k1][k2]
+        if age > max_staleness:
+            raise Exception("serverStatus snapshot older than {}s".format(max_staleness))
+
+        data = snapshot['values'][desc_key]
 
         logger.debug("metric_handler returning: name={} val={}".format(name, data))
         return data
@@ -310,7 +314,9 @@ def metric_handler(name):
     except Exception as e:
         logger.exception("metric_handler exception: {}".format(e))
         if __name__ == '__main__':
-            print "Exception:", e
+            print("Exception: {}".format(e))
+        if desc_key in COUNTERS and snapshot:
+            return snapshot['values'].get(desc_key, 0)
         return 0
 
 
@@ -320,17 +326,15 @@ if __name__ == '__main__':
     from sys import argv
 
     if len(argv) != 2:
-        print "Usage:", argv[0], "<local_mongod_port>"
+        print("Usage: {} <local_mongod_port>".format(argv[0]))
         exit(1)
 
-    metrics = ['conn_current', 'conn_available', 'conn_total', 'net_bytes_in', 'net_bytes_out',
-               'op_count_insert', 'op_count_query', 'op_count_update', 'op_count_delete',
-               'op_count_getmore', 'op_count_command', 'mem_resident', 'mem_virtual']
+    metrics = [m[0] for m in METRICS + [DATA_AGE_METRIC]]
 
-    metric_init({'time_max': '5', 'server_name': 'svr', 'port': argv[1]})
+    metric_init({'time_max': '5', 'refresh_interval': '1', 'server_name': 'svr', 'port': argv[1]})
 
     while True:
-        print "--- {}".format(datetime.ctime(datetime.utcnow()))
+        print("--- {}".format(datetime.ctime(datetime.utcnow())))
         for m in metrics:
-            print "{}: {}".format(m, metric_handler('svr_mongodb_' + m))
+            print("{}: {}".format(m, metric_handler('svr_mongodb_' + m)))
         sleep(1)
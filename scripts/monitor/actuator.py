@@ -1,19 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger as logging_getLogger
 from configparser import ConfigParser
-from json import loads as json_loads
+from placement import parse_capacity, host_weights, host_load, place_repl_sets
+from drain import shard_load, drain_costs, ShardDrain
+from rebalance import Rebalancer
+from topology import Topology, make_backend
 from subprocess import Popen, PIPE
+from collections import deque
+from itertools import accumulate
+from time import perf_counter
+from threading import Event, Lock
+
+
+class StepTimings:
+    """
+    Rolling wall clock durations in seconds of the last size runs of every actuator step, and a histogram of
+    all the runs since start.
+    """
+
+    steps = ('start', 'add', 'rebalance', 'drain', 'stop', 'ganglia')
+    # upper bounds of the histogram buckets, in seconds
+    buckets = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf'))
+
+    def __init__(self, size=100):
+        self._lock = Lock()
+        self.samples = {s: deque(maxlen=size) for s in self.steps}
+        self.counts = {s: [0] * len(self.buckets) for s in self.steps}
+        self.totals = {s: 0.0 for s in self.steps}
+
+    def record(self, step, seconds):
+        with self._lock:
+            self.samples[step].append(seconds)
+            self.counts[step][next(i for i, b in enumerate(self.buckets) if seconds <= b)] += 1
+            self.totals[step] += seconds
+
+    def mean(self, step):
+        """Mean duration of step, None before its first run."""
+        with self._lock:
+            samples = list(self.samples[step])
+        return sum(samples) / len(samples) if samples else None
+
+    def histogram(self, step):
+        """Cumulative counts of the runs of step up to every bound of buckets, their total duration and count."""
+        with self._lock:
+            counts, total = list(self.counts[step]), self.totals[step]
+        cumulative = list(accumulate(counts))
+        return cumulative, total, cumulative[-1]
+
+    def summary(self):
+        """{step: {count, mean, p50, p90, max}} of the steps run so far."""
+        res = {}
+        with self._lock:
+            items = [(s, sorted(d)) for s, d in self.samples.items() if d]
+        for step, samples in items:
+            n = len(samples)
+            res[step] = {'count': n, 'mean': sum(samples) / n, 'p50': samples[(n - 1) // 2],
+                         'p90': samples[min(n - 1, int(0.9 * n))], 'max': samples[-1]}
+        return res
 
 
 class Actuator:
-    def __init__(self, conf_file='actuator.conf'):
+    def __init__(self, conf_file='actuator.conf', backend=None):
         self.logger = logging_getLogger(__name__)
         self.is_available = True
         cfg = ConfigParser()
         cfg.read(conf_file)
-        self.conf = {k: v for s in cfg.sections() for k, v in cfg.items(s)}
+        self.conf = {k: v for s in cfg.sections() if s != 'host_capacity' for k, v in cfg.items(s)}
         self.conf['base_shard_port'] = int(self.conf['base_shard_port'])
         self.conf['repl_set_members'] = int(self.conf['repl_set_members'])
         self.conf['shard_hosts'] = self.conf['shard_hosts'].split(' ')
+        self.conf['max_parallel_cmds'] = int(self.conf.get('max_parallel_cmds', 1))
+        self.conf['topology_ttl'] = float(self.conf.get('topology_ttl', 0))
+        self.conf['drain_engine'] = self.conf.get('drain_engine', 'script')
+        self.conf['drain_poll_min'] = float(self.conf.get('drain_poll_min', 1))
+        self.conf['drain_poll_max'] = float(self.conf.get('drain_poll_max', 20))
+        self.conf['drain_cancel_unset'] = self.conf.get('drain_cancel_unset', 'false').lower() == 'true'
+        self.conf['rebalance'] = self.conf.get('rebalance', 'false').lower() == 'true'
+        self.conf['rebalance_rate'] = float(self.conf.get('rebalance_rate', 30))
+        self.conf['rebalance_timeout'] = float(self.conf.get('rebalance_timeout', 600))
+
+        # step of every script, timed on every run
+        self.step_of = {
+            self.conf['start_shard_sh']: 'start',
+            self.conf['add_shard_sh']: 'add',
+            self.conf['rmv_shard_sh']: 'drain',
+            self.conf['stop_shard_sh']: 'stop',
+            self.conf['restart_ganglia_sh']: 'ganglia',
+        }
+        self.timings = StepTimings()
+
+        # placement of new replica set members by declared capacity and the latest observed load
+        self.capacity = parse_capacity(cfg.items('host_capacity') if cfg.has_section('host_capacity') else [])
+        self.weights = host_weights(self.conf['shard_hosts'], self.capacity)
+        self.host_load = {}
+        self.shard_load = {}
+        self.drains = []    # ShardDrain of the running action started so far, if it removes replica sets
+        self.added = []     # shards added by the last action
+        self.rebalancer = None  # Rebalancer of the last rebalance, once started
+
+        backend = backend or make_backend(self.conf.get('topology_backend', 'shell'), self.conf['mongos_conn'])
+        self.topology = Topology(backend, self.conf['topology_ttl'])
 
     def _get_port(self, repl_set_no, server_no):
         rs_offs = self.conf['repl_set_members'] * (repl_set_no - 1)
@@ -25,26 +111,14 @@ class Actuator:
         return port - self.conf['base_shard_port'] - rs_offs + 1
 
     def _current_shard_dicts(self):
-        cmd = [
-            'mongo',
-            'admin',
-            '--quiet',
-            '--host', self.conf['mongos_conn'],
-            '--eval',
-            'JSON.stringify(db.adminCommand({ listShards: 1 })["shards"])'
-        ]
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        res, err = p.communicate()
-
-        try:
-            data = json_loads(res) if res else []
-        except Exception as e:
-            self.logger.error("{}, result: {}".format(e, res))
-            data = []
+        return self.topology.shards()
 
-        return data
+    def observe(self, metrics):
+        """Take the host and shard load of metrics, in the layout of XMLHandler.metrics, into account."""
+        self.host_load = host_load(metrics)
+        self.shard_load = shard_load(metrics)
 
-    def _to_be_added_repl_set(self):
+    def _to_be_added_repl_sets(self, k=1):
         shard_dicts = self._current_shard_dicts()
         shard_hosts = [d['host'] for d in shard_dicts]
 
@@ -62,117 +136,258 @@ class Actuator:
                 host = rsvr.split(':')[0]
                 host_dicts[host] += 1
 
-        repl_set_no = max_repl_set_no + 1
-        server_hosts = even_bucket_fill(host_dicts, self.conf['repl_set_members'])
-        info_dicts = []
-
-        for server_no, host in enumerate(server_hosts, 1):
-            port = self._get_port(repl_set_no, server_no)
-            info_dict = {
-                'repl_set_no': str(repl_set_no),
-                'server_no': str(server_no),
-                'host': host,
-                'port': str(port)
-            }
-            info_dicts.append(info_dict)
-
-        return info_dicts
-
-    def _to_be_removed_repl_set(self):
+        placed = place_repl_sets(host_dicts, k, self.conf['repl_set_members'], self.weights, self.host_load)
+        repl_sets = []
+        for repl_set_no, server_hosts in enumerate(placed, max_repl_set_no + 1):
+            info_dicts = []
+
+            for server_no, host in enumerate(server_hosts, 1):
+                port = self._get_port(repl_set_no, server_no)
+                info_dict = {
+                    'repl_set_no': str(repl_set_no),
+                    'server_no': str(server_no),
+                    'host': host,
+                    'port': str(port)
+                }
+                info_dicts.append(info_dict)
+            repl_sets.append(info_dicts)
+
+        return repl_sets
+
+    def _to_be_removed_repl_sets(self, k=1):
+        """
+        The k replica sets cheapest to drain, by chunks, data size, primary databases and load, ties going to the
+        highest repl_set_no N of ShardReplSetN/h1:p1,h2:p2,... as do all of them without shard stats.
+        """
         shard_dicts = self._current_shard_dicts()
         shard_hosts = [d['host'] for d in shard_dicts]
-        info_dicts = []
+        repl_sets = []
 
-        # choose max_repl_set_no N extracting it from ShardReplSetN/h1:p1,h2:p2,...
         offset = len('ShardReplSet')
-        max_repl_set_str = max(shard_hosts, key=lambda h: int(h.split('/')[0][offset:]))
-
-        rset, rsvrs = max_repl_set_str.split('/')
-        rsvrs = rsvrs.split(',')
-        repl_set_no = int(rset[offset:])
-
-        for rsvr in rsvrs:
-            host, port_str = rsvr.split(':')
-            server_no = self._get_server_no(int(port_str), repl_set_no)
-            info_dict = {
-                'repl_set_no': str(repl_set_no),
-                'server_no': str(server_no),
-                'host': host,
-                'port': port_str,
-            }
-            info_dicts.append(info_dict)
-
-        return info_dicts
-
-    def _get_add_repl_set_cmds(self):
-        cmds = []
-        shard_info_dicts = self._to_be_added_repl_set()
-
-        # start shard commands
-        for dct in shard_info_dicts:
-            cmd = [
-                self.conf['start_shard_sh'],
-                '-m', self.conf['scripts_dir'],
-                '-d', self.conf['mongodb_dir'],
-                '-r', dct['repl_set_no'],
-                '-s', dct['server_no'],
-                '-h', dct['host'],
-                '-p', dct['port']
-            ]
-            cmds.append(cmd)
-
-        # add shard command
-        repl_svrs_str = '|'.join([d['host'] + ':' + d['port'] for d in shard_info_dicts])
-        repl_set_no = shard_info_dicts[0]['repl_set_no']
-        cmd = [
-            self.conf['add_shard_sh'],
-            '-c', self.conf['mongos_conn'],
-            '-r', repl_set_no,
-            '-s', repl_svrs_str
-        ]
-        cmds.append(cmd)
-
-        return cmds
-
-    def _get_rmv_repl_set_cmds(self):
-        cmds = []
-        shard_info_dicts = self._to_be_removed_repl_set()
-
-        # remove shard command
-        repl_set_no = shard_info_dicts[0]['repl_set_no']
-        cmd = [
-            self.conf['rmv_shard_sh'],
-            '-c', self.conf['mongos_conn'],
-            '-r', repl_set_no
-        ]
-        cmds.append(cmd)
+        costs = drain_costs([h.split('/')[0] for h in shard_hosts], self.topology.shard_stats(), self.shard_load)
+        cheapest_repl_set_strs = sorted(shard_hosts, key=lambda h: (costs[h.split('/')[0]],
+                                                                    -int(h.split('/')[0][offset:])))[:k]
+        self.logger.debug('Drain costs: ' + ', '.join('{} {:.2f}'.format(s, c)
+                                                      for s, c in sorted(costs.items(), key=lambda x: x[1])))
+
+        for repl_set_str in cheapest_repl_set_strs:
+            rset, rsvrs = repl_set_str.split('/')
+            rsvrs = rsvrs.split(',')
+            repl_set_no = int(rset[offset:])
+            info_dicts = []
 
-        # stop shard commands
-        for dct in shard_info_dicts:
+            for rsvr in rsvrs:
+                host, port_str = rsvr.split(':')
+                server_no = self._get_server_no(int(port_str), repl_set_no)
+                info_dict = {
+                    'repl_set_no': str(repl_set_no),
+                    'server_no': str(server_no),
+                    'host': host,
+                    'port': port_str,
+                }
+                info_dicts.append(info_dict)
+            repl_sets.append(info_dicts)
+
+        return repl_sets
+
+    def _get_add_repl_set_cmds(self, k=1):
+        """
+        Commands adding k replica sets, as stages of (repl_set_no, cmd) pairs.
+        Commands of a stage run concurrently, stages run in order.
+        """
+        repl_sets = self._to_be_added_repl_sets(k)
+
+        # start shard commands, independent of each other
+        start_stage = []
+        for shard_info_dicts in repl_sets:
+            for dct in shard_info_dicts:
+                cmd = [
+                    self.conf['start_shard_sh'],
+                    '-m', self.conf['scripts_dir'],
+                    '-d', self.conf['mongodb_dir'],
+                    '-r', dct['repl_set_no'],
+                    '-s', dct['server_no'],
+                    '-h', dct['host'],
+                    '-p', dct['port']
+                ]
+                start_stage.append((dct['repl_set_no'], cmd))
+
+        # add shard commands, once all members of the replica set are up
+        add_stage = []
+        for shard_info_dicts in repl_sets:
+            repl_svrs_str = '|'.join([d['host'] + ':' + d['port'] for d in shard_info_dicts])
+            repl_set_no = shard_info_dicts[0]['repl_set_no']
             cmd = [
-                self.conf['stop_shard_sh'],
-                '-r', dct['repl_set_no'],
-                '-s', dct['server_no'],
-                '-h', dct['host'],
-                '-p', dct['port']
+                self.conf['add_shard_sh'],
+                '-c', self.conf['mongos_conn'],
+                '-r', repl_set_no,
+                '-s', repl_svrs_str
             ]
-            cmds.append(cmd)
-
-        # restart ganglia command
+            add_stage.append((repl_set_no, cmd))
+
+        return [start_stage, add_stage]
+
+    def _get_rmv_repl_set_cmds(self, k=1):
+        """
+        Commands removing k replica sets, as stages of (repl_set_no, cmd) pairs.
+        Commands of a stage run concurrently, stages run in order.
+        """
+        stages = []
+        repl_sets = self._to_be_removed_repl_sets(k)
+
+        # remove shard commands, draining one shard at a time
+        removed = {'ShardReplSet' + d[0]['repl_set_no'] for d in repl_sets}
+        remaining = [d['_id'] for d in self._current_shard_dicts() if d['_id'] not in removed]
+        primary_to = min(remaining, key=lambda s: self.shard_load.get(s, 0), default=None)
+        cancelled = Event()     # cancelling the drain in progress cancels those after it too
+        for shard_info_dicts in repl_sets:
+            repl_set_no = shard_info_dicts[0]['repl_set_no']
+            if self.conf['drain_engine'] == 'python':
+                cmd = ShardDrain(self.topology.backend, 'ShardReplSet' + repl_set_no, primary_to,
+                                 self.conf['drain_poll_min'], self.conf['drain_poll_max'],
+                                 self.conf['drain_cancel_unset'], cancelled)
+            else:
+                cmd = [
+                    self.conf['rmv_shard_sh'],
+                    '-c', self.conf['mongos_conn'],
+                    '-r', repl_set_no
+                ]
+            stages.append([(repl_set_no, cmd)])
+
+        # stop shard commands, independent of each other
+        stop_stage = []
+        for shard_info_dicts in repl_sets:
+            for dct in shard_info_dicts:
+                cmd = [
+                    self.conf['stop_shard_sh'],
+                    '-r', dct['repl_set_no'],
+                    '-s', dct['server_no'],
+                    '-h', dct['host'],
+                    '-p', dct['port']
+                ]
+                stop_stage.append((dct['repl_set_no'], cmd))
+        stages.append(stop_stage)
+
+        # restart ganglia command, once all shards are stopped
         shard_hosts_str = '|'.join(self.conf['shard_hosts'])
         cmd = [
             self.conf['restart_ganglia_sh'],
             '-h', shard_hosts_str
         ]
-        cmds.append(cmd)
-        return cmds
+        stages.append([(None, cmd)])
+        return stages
 
     def current_shard_number(self):
         shard_dicts = self._current_shard_dicts()
         shard_hosts = [d['host'] for d in shard_dicts]
         return len(shard_hosts)
 
+    def expected_duration(self, action):
+        """
+        Expected wall clock seconds of action from the step timings, None if a step of it has not run yet.
+        Commands of a stage run concurrently, but the shards of rmv_k are drained one at a time. An add takes
+        effect once the rebalance after it is done, if any.
+        """
+        kind, _, k = action.partition('_')
+        k = int(k or 1)
+        t = self.timings
+        if kind == 'add':
+            steps = [t.mean('start'), t.mean('add')] + ([t.mean('rebalance')] if self.conf['rebalance'] else [])
+        elif kind == 'rmv':
+            drain = t.mean('drain')
+            steps = [drain and k * drain, t.mean('stop'), t.mean('ganglia')]
+        else:
+            return 0.0
+
+        return None if None in steps else sum(steps)
+
+    def draining(self):
+        """Whether a replica set is being drained by the drain engine."""
+        return any(d.progress['state'] in ('pending', 'started', 'ongoing') for d in self.drains)
+
+    def cancel_drain(self):
+        """Cancel the drains of the running action, its replica sets staying in the cluster."""
+        for d in self.drains:
+            d.cancel()
+
+    def drain_progress(self):
+        return [dict(d.progress) for d in self.drains]
+
+    def rebalancing(self):
+        """Whether chunks are being moved to replica sets just added, so their capacity is not effective yet."""
+        return self.rebalancer is not None and self.rebalancer.progress['state'] in ('pending', 'moving')
+
+    def rebalance_progress(self):
+        return None if self.rebalancer is None else dict(self.rebalancer.progress)
+
+    def _plan_rebalance(self):
+        """
+        Pending rebalance to the shards added by the last action, if rebalance is on, so that rebalancing() holds
+        from before the action is done until the rebalance has run.
+        """
+        if self.conf['rebalance'] and self.added:
+            self.rebalancer = Rebalancer(self.topology.backend, self.added, self.shard_load,
+                                         self.conf['rebalance_rate'], self.conf['rebalance_timeout'])
+
+    def rebalance(self, cmd_type, cmd_uuid='uuid'):
+        """
+        Move chunks to the shards added by the last action, if it left a rebalance pending, as a job of its own once
+        the action is done, so the actuator is available meanwhile.
+        :return: '' if balanced or nothing to do, else why not, as the errors of a command
+        """
+        if self.rebalancer is None or self.rebalancer.progress['state'] != 'pending':
+            return ''
+
+        def format_msg(msg):
+            return "Action '{}' [{}] {}".format(cmd_type, cmd_uuid, msg)
+
+        self.logger.info(format_msg('Command: {}'.format(cmd_str(self.rebalancer))))
+        return self._run_job(self.rebalancer, format_msg)
+
+    def _run_job(self, job, format_msg):
+        if isinstance(job, ShardDrain):
+            # only once its stage starts, so skipped or dry run drains never count as draining
+            self.drains.append(job)
+        start = perf_counter()
+        err = job(lambda msg: self.logger.info(format_msg(msg)))
+        elapsed = perf_counter() - start
+        step = 'drain' if isinstance(job, ShardDrain) else 'rebalance'
+        if job.progress['state'] in ('completed', 'balanced'):
+            # cut short jobs would bias the expected duration of the action
+            self.timings.record(step, elapsed)
+            self.logger.debug(format_msg('Step {} took {:.2f} s'.format(step, elapsed)))
+        return err
+
+    def _run_cmd(self, cmd, format_msg):
+        if not isinstance(cmd, list):
+            return self._run_job(cmd, format_msg)
+
+        start = perf_counter()
+        try:
+            p = Popen(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8')
+            res, err = p.communicate()
+        except OSError as e:
+            return str(e)
+
+        elapsed = perf_counter() - start
+        step = self.step_of.get(cmd[0])
+        if step is not None:
+            self.timings.record(step, elapsed)
+            self.logger.debug(format_msg('Step {} took {:.2f} s'.format(step, elapsed)))
+
+        if res != '':
+            self.logger.info(format_msg("Output of {}:\n{}".format(' '.join(cmd), res)))
+
+        return err
+
     def exec_cmds_of_type(self, cmd_type, cmd_uuid='uuid', dry_run=False):
+        """
+        Execute the commands of cmd_type, one of add, rmv or add_k, rmv_k to add/remove k replica sets in one job.
+        Commands of a stage run concurrently in a pool of max_parallel_cmds threads. A command is skipped once a
+        command of the same replica set has failed, a command of no replica set once all replica sets have failed.
+        :return: int number of replica sets actually added/removed
+        :raises: Exception: if busy, or the shards of the cluster cannot be read before or after
+        """
         def format_msg(msg):
             return "Action '{}' [{}] {}".format(cmd_type, cmd_uuid, msg)
 
@@ -181,126 +396,70 @@ class Actuator:
             'rmv': self._get_rmv_repl_set_cmds,
         }
 
-        if cmd_type not in get_cmd_dct:
-            raise Exception('cmd_type not one of: add, rmv')
+        kind, _, k = cmd_type.partition('_')
+        if kind not in get_cmd_dct or not (k == '' or k.isdigit() and int(k) > 0):
+            raise Exception('cmd_type not one of: add, rmv, add_k, rmv_k')
+        k = int(k or 1)
 
         if not self.is_available:
             raise Exception(__name__ + ' is busy')
 
-        cmds = get_cmd_dct[cmd_type]()
+        shards_before = self.current_shard_number()
+        stages = get_cmd_dct[kind](k)
 
         self.is_available = False
-        self.logger.info(format_msg('starting'))
-
-        for cmd in cmds:
-            cmd_str = ' '.join(cmd)
-            self.logger.info(format_msg('Command: {}'.format(cmd_str)))
-
-            if not dry_run:
-                p = Popen(cmd, stdout=PIPE, stderr=PIPE, encoding='utf-8')
-                res, err = p.communicate()
-
-                if res != '':
-                    self.logger.info(format_msg("Output:\n{}".format(res)))
-
-                if err != '':
-                    # break on first command failure
-                    self.logger.error(format_msg("Errors:\n{}".format(err)))
-                    break
-
-        # validate if commands succeeded by checking next same command
-        next_first_cmd = get_cmd_dct[cmd_type]()[0]
-        ok = next_first_cmd != cmds[0]
-
-        self.is_available = True
-        return ok
-
-
-def even_bucket_fill(init_bucket_dict, balls):
-    """
-    Evenly fill the semi-filled buckets in init_bucket_dict with the given balls.
-    :param: init_bucket_dict: dictionary of the form {bucket_tag: int number of balls}
-    :param: balls: int number of balls to add to the buckets
-    :return: list of the resulting bucket_tags for every ball given
-    """
-
-    bucket_dict = dict(init_bucket_dict)  # local copy
-    asc_bucket_tags = sorted(bucket_dict.keys(), key=lambda k: bucket_dict[k])
-
-    def get_diff_with_next(idx):
-        max_idx = len(asc_bucket_tags) - 1
-        if idx >= max_idx:
-            return 0
-
-        key = asc_bucket_tags[idx]
-        next_key = asc_bucket_tags[idx + 1]
-
-        return bucket_dict[next_key] - bucket_dict[key]
-
-    def equal_fill_with_next(idx, balls):
-        ball_tags = []
-        rem_balls = balls
-
-        # fill bucket at idx with balls to reach the next bucket
-        diff = get_diff_with_next(idx)
-        if diff > 0:
-            add_balls = min(diff, balls)
-            tag = asc_bucket_tags[idx]
-            bucket_dict[tag] += add_balls
-            ball_tags = [tag] * add_balls
-            rem_balls -= add_balls
+        self.added = []
+        try:
+            self.logger.info(format_msg('starting'))
 
-        return rem_balls, ball_tags
+            repl_sets = {rs for stage in stages for rs, _ in stage if rs is not None}
+            errors = {}  # cmd_str: errors of every failed command
+            failed = set()
 
-    def find_equal_level_idx(idx):
-        max_idx = len(asc_bucket_tags) - 1
-        if idx >= max_idx:
-            return max_idx
+            def runnable(repl_set_no):
+                if repl_set_no is None:
+                    return bool(repl_sets - failed)
+                return repl_set_no not in failed
 
-        level = bucket_dict[asc_bucket_tags[idx]]
-        for res_idx, tag in enumerate(asc_bucket_tags[idx+1:], idx+1):
-            lvl = bucket_dict[tag]
-            if lvl > level:
-                return res_idx - 1
+            with ThreadPoolExecutor(max_workers=self.conf['max_parallel_cmds']) as pool:
+                for stage in stages:
+                    stage = [(rs, cmd) for rs, cmd in stage if runnable(rs)]
 
-        # nothing returned so all buckets above idx have equal level
-        return max_idx
+                    for _, cmd in stage:
+                        self.logger.info(format_msg('Command: {}'.format(cmd_str(cmd))))
 
-    def asc_cyclic_fill(idx, balls):
-        ball_tags = []
-        rem_balls = balls
-        max_idx = len(asc_bucket_tags) - 1
+                    if dry_run:
+                        continue
 
-        # levels uniformly distributed at buckets if idx on last or further
-        # else levels = height difference of current with next bucket
-        levels = rem_balls / (max_idx + 1) if idx >= max_idx else get_diff_with_next(idx)
+                    errs = pool.map(lambda rs_cmd: self._run_cmd(rs_cmd[1], format_msg), stage)
+                    for (rs, cmd), err in zip(stage, errs):
+                        if err != '':
+                            self.logger.error(format_msg("Errors of {}:\n{}".format(cmd_str(cmd), err)))
+                            errors[cmd_str(cmd)] = err
+                            failed.add(rs)
 
-        while rem_balls > 0 and levels > 0:
-            add_balls = min(rem_balls, idx + 1)
-            for i in range(add_balls):
-                tag = asc_bucket_tags[i]
-                bucket_dict[tag] += 1
-                ball_tags.append(tag)
-            rem_balls -= add_balls
-            levels -= 1
+            if errors:
+                self.logger.error(format_msg('{} command(s) failed'.format(len(errors))))
 
-        return rem_balls, ball_tags
+            if not dry_run:
+                self.topology.invalidate()
+                if kind == 'add':
+                    self.added = ['ShardReplSet' + rs for rs in sorted(repl_sets - failed, key=int)]
+                    self._plan_rebalance()
 
-    rem_balls = balls   # remaining balls to be added
-    res_ball_tags = []  # list with bucket tags for each ball
-    start_idx = 0       # starting bucket index for each loop
+            # validate how many replica sets were actually added/removed
+            shards_diff = self.current_shard_number() - shards_before
+            done = shards_diff if kind == 'add' else -shards_diff
 
-    # fill starting bucket up to next level
-    rem_balls, ball_buckets = equal_fill_with_next(start_idx, rem_balls)
-    res_ball_tags.extend(ball_buckets)
+            return min(max(done, 0), k)
+        finally:
+            self.drains = []
+            self.is_available = True
 
-    while rem_balls > 0:
-        # fill equal levels cyclic
-        start_idx = find_equal_level_idx(start_idx)
-        rem_balls, ball_buckets = asc_cyclic_fill(start_idx, rem_balls)
-        res_ball_tags.extend(ball_buckets)
 
-    return res_ball_tags
+def cmd_str(cmd):
+    """Command line of a script command, description of a drain or rebalance."""
+    return ' '.join(cmd) if isinstance(cmd, list) else str(cmd)
 
 
 if __name__ == '__main__':
@@ -311,10 +470,14 @@ if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument('cmd_type', choices=['add', 'rmv'], help="mutually exclusive cmd_type set")
+    parser.add_argument('-k', type=int, default=1, help="number of replica sets to add/remove")
     parser.add_argument('--dry-run', action='store_true', help="output command without executing")
     args = parser.parse_args()
 
     actuator = Actuator()
-    ok = actuator.exec_cmds_of_type(args.cmd_type, 'uuid', args.dry_run)
-    print("Successful execution: {}".format(ok))
+    cmd_type = args.cmd_type if args.k == 1 else '{}_{}'.format(args.cmd_type, args.k)
+    done = actuator.exec_cmds_of_type(cmd_type, 'uuid', args.dry_run)
+    print("Successful execution: {}/{}".format(done, args.k))
+    if done and args.cmd_type == 'add':
+        print("Rebalance: {}".format(actuator.rebalance(cmd_type) or 'done'))
     print("Current Shards: {}".format(actuator.current_shard_number()))
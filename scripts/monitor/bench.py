@@ -0,0 +1,234 @@
+from xml.sax import make_parser as xml_sax_make_parser
+from statistics import median as statistics_median
+from json import dumps as json_dumps
+from argparse import ArgumentParser
+from placement import place_repl_sets
+from bench_mdp import make_mdp, timed
+from os.path import dirname, join
+from time import perf_counter
+from monitor import Monitor, XMLHandler
+from mdp import ClusterMDP
+from random import Random
+import subprocess
+import platform
+import sys
+
+sys.path.insert(0, join(dirname(__file__) or '.', '..', 'ganglia'))
+import mongodb as gmond_mongodb  # noqa: E402
+
+# ganglia host metrics reported by every host, besides those of its shards
+HOST_METRICS = [
+    'boottime', 'bytes_in', 'bytes_out', 'cpu_aidle', 'cpu_idle', 'cpu_nice', 'cpu_num', 'cpu_speed', 'cpu_steal',
+    'cpu_system', 'cpu_user', 'cpu_wio', 'disk_free', 'disk_total', 'load_fifteen', 'load_five', 'load_one',
+    'mem_buffers', 'mem_cached', 'mem_free', 'mem_shared', 'mem_total', 'part_max_used', 'pkts_in', 'pkts_out',
+    'proc_run', 'proc_total', 'swap_free', 'swap_total',
+]
+
+METRIC_XML = ('<METRIC NAME="{name}" VAL="{val}" TYPE="{type}" UNITS="" TN="5" TMAX="60" DMAX="0" SLOPE="both" '
+              'SOURCE="gmond">\n<EXTRA_DATA>\n<EXTRA_ELEMENT NAME="GROUP" VAL="{group}"/>\n'
+              '<EXTRA_ELEMENT NAME="DESC" VAL="{name}"/>\n<EXTRA_ELEMENT NAME="TITLE" VAL="{name}"/>\n'
+              '</EXTRA_DATA>\n</METRIC>\n')
+
+
+def host_xml_body(shards, rnd, tick=0):
+    """
+    Bytes of the metrics of a host with shards mongod processes, the same for every host. The counters of the
+    gmond module (positive slope) grow by 10 s of their rate every tick, so they make non zero rates.
+    """
+    parts = [METRIC_XML.format(name=m, val=round(rnd.uniform(0, 100), 2), type='float', group='system')
+             for m in HOST_METRICS]
+    for i in range(shards):
+        for m in gmond_mongodb.METRICS:
+            # gmond reports the int metrics of python modules as int32
+            ty = 'int32' if m[1] == 'int' else 'float'
+            if m[3] == 'positive':
+                val = rnd.randint(1, 1000) * 10 * (tick + 1)
+            else:
+                val = rnd.randint(0, 10 ** 6) if ty == 'int32' else round(rnd.uniform(0, 1), 4)
+            parts.append(METRIC_XML.format(name='shardr{}s{}_mongodb_{}'.format(i // 3 + 1, i % 3 + 1, m[0]),
+                                           val=val, type=ty, group='mongodb'))
+    return ''.join(parts).encode() + b'</HOST>\n'
+
+
+def feed_grid(parser, hosts, body, localtime):
+    """Feed a gmetad document of hosts hosts sharing body to an incremental parser, without building it whole."""
+    parser.feed('<?xml version="1.0" encoding="ISO-8859-1"?>\n<GANGLIA_XML VERSION="3.7.2" SOURCE="gmetad">\n'
+                '<GRID NAME="grid" AUTHORITY="" LOCALTIME="{0}">\n<CLUSTER NAME="mongodb_cluster" '
+                'LOCALTIME="{0}" OWNER="" LATLONG="" URL="">\n'.format(localtime).encode())
+    for h in range(hosts):
+        parser.feed('<HOST NAME="host{}" IP="10.0.0.1" REPORTED="{}" TN="5" TMAX="20" DMAX="0" LOCATION="" '
+                    'GMOND_STARTED="0" TAGS="">\n'.format(h, localtime).encode())
+        parser.feed(body)
+    parser.feed(b'</CLUSTER>\n</GRID>\n</GANGLIA_XML>\n')
+    parser.close()
+
+
+def measure(func, repeat):
+    """min and median seconds of repeat calls of func."""
+    times = [timed(func)[1] for _ in range(repeat)]
+    return {'min': min(times), 'median': statistics_median(times), 'repeat': repeat}
+
+
+def bench_xml_parse(conf, hosts, shards, repeat):
+    """XMLHandler parsing a gmetad document, with the metric filter and rates the monitor uses."""
+    wanted = {t[:-3] for s in ['thresholds_add', 'thresholds_remove'] for t in conf[s]} | conf['delta_metrics']
+    handler = XMLHandler(conf['delta_metrics'], wanted, conf['ignore_hosts'])
+    # a body per parse, 10 s apart, with the same seed so only the counters change
+    bodies = [host_xml_body(shards, Random(0), tick) for tick in range(repeat + 1)]
+    ticks = iter(range(repeat + 1))
+
+    def parse():
+        tick = next(ticks)
+        parser = xml_sax_make_parser()
+        parser.setContentHandler(handler)
+        feed_grid(parser, hosts, bodies[tick], 1000 + 10 * tick)
+
+    parse()  # first samples of the counters
+    res = measure(parse, repeat)
+    res['bytes'] = hosts * (len(bodies[0]) + 150)
+    return res, handler.metrics
+
+
+def bench_calc_reward(conf, metrics, repeat):
+    mdp = ClusterMDP('5', [str(x) for x in range(1, 11)], gamma=conf['gamma'], max_step=conf['max_step'])
+    return measure(lambda: mdp.calc_reward(metrics, conf['thresholds_add'], conf['thresholds_remove'],
+                                           conf['aggregation']), repeat)
+
+
+def bench_solve(n_states, repeat):
+    """Cold solve (compile included), and warm solve after a change of the reward of a single state."""
+    rnd = Random(0)
+
+    def cold():
+        mdp = make_mdp(n_states, 0.8)
+        mdp.solve()
+
+    mdp = make_mdp(n_states, 0.8)
+    mdp.solve()
+
+    def warm():
+        mdp.reward[mdp.states[rnd.randrange(n_states)]] = rnd.uniform(0, 0.05)
+        mdp.solve()
+
+    return {'cold': measure(cold, repeat), 'warm': measure(warm, repeat), 'mode': mdp.solve_stats['mode']}
+
+
+def bench_placement(hosts, k, members, repeat):
+    """Placement of k replica sets on hosts of random processes, capacities and loads."""
+    rnd = Random(0)
+    processes = {'host{}'.format(i): rnd.randint(0, 20) for i in range(hosts)}
+    weights = {h: rnd.choice([0.25, 0.5, 1.0]) for h in processes}
+    load = {h: rnd.uniform(0, 1) for h in processes}
+    return measure(lambda: place_repl_sets(processes, k, members, weights, load), repeat)
+
+
+def server_status_sample(rnd):
+    """serverStatus of a WiredTiger mongod with every section of a recorded one, the counters at random values."""
+    counters = {k: rnd.randint(0, 10 ** 9) for k in ['insert', 'query', 'update', 'delete', 'getmore', 'command']}
+    cache = {'bytes currently in the cache': rnd.randint(0, 10 ** 9), 'maximum bytes configured': 2 * 10 ** 9,
+             'tracked dirty bytes in the cache': rnd.randint(0, 10 ** 8)}
+    cache.update({'cache stat {}'.format(i): rnd.randint(0, 10 ** 6) for i in range(100)})
+    tickets = {'out': rnd.randint(0, 10), 'available': rnd.randint(100, 128), 'totalTickets': 128}
+    return {
+        'host': 'host0', 'version': '4.4.0', 'process': 'mongod', 'pid': 1234, 'uptime': 3600.0,
+        'asserts': {k: rnd.randint(0, 100) for k in ['regular', 'warning', 'msg', 'user', 'rollovers']},
+        'connections': {'current': rnd.randint(0, 100), 'available': 800, 'totalCreated': rnd.randint(0, 10 ** 5)},
+        'network': {'bytesIn': rnd.randint(0, 10 ** 12), 'bytesOut': rnd.randint(0, 10 ** 12),
+                    'numRequests': rnd.randint(0, 10 ** 9)},
+        'opcounters': counters, 'opcountersRepl': dict(counters),
+        'mem': {'bits': 64, 'resident': rnd.randint(0, 10 ** 4), 'virtual': rnd.randint(0, 10 ** 4)},
+        'opLatencies': {k: {'latency': rnd.randint(0, 10 ** 10), 'ops': rnd.randint(1, 10 ** 7)}
+                        for k in ['reads', 'writes', 'commands', 'transactions']},
+        'globalLock': {'currentQueue': {'total': rnd.randint(0, 10), 'readers': rnd.randint(0, 5),
+                                        'writers': rnd.randint(0, 5)},
+                       'activeClients': {'total': 10, 'readers': 0, 'writers': 0}},
+        'locks': {k: {'acquireCount': {'r': rnd.randint(0, 10 ** 9), 'w': rnd.randint(0, 10 ** 9)}}
+                  for k in ['Global', 'Database', 'Collection', 'Mutex', 'oplog']},
+        'wiredTiger': dict({'section {}'.format(i): {'stat {}'.format(j): rnd.randint(0, 10 ** 6) for j in range(40)}
+                            for i in range(20)},
+                           cache=cache, concurrentTransactions={'read': tickets, 'write': dict(tickets)}),
+        'metrics': {'section {}'.format(i): {'stat {}'.format(j): rnd.randint(0, 10 ** 6) for j in range(30)}
+                    for i in range(15)},
+        'tcmalloc': {'generic': {'current_allocated_bytes': 10 ** 8, 'heap_size': 2 * 10 ** 8},
+                     'tcmalloc': {'stat {}'.format(j): rnd.randint(0, 10 ** 6) for j in range(30)}},
+    }
+
+
+def bench_gmond(repeat):
+    """
+    The gmond module's refresh: decoding the serverStatus reply (full, and without the sections no metric reads, as
+    requested) and calc_values on it.
+    """
+    from bson import encode as bson_encode, decode as bson_decode
+
+    rnd = Random(0)
+    prev, curr = server_status_sample(rnd), server_status_sample(rnd)
+    needed = set(path[0] for m in gmond_mongodb.METRICS for path in gmond_mongodb.metric_paths(m[-1]))
+    full = bson_encode(curr)
+    trimmed = bson_encode({k: v for k, v in curr.items()
+                           if k not in gmond_mongodb.SERVER_STATUS_SECTIONS or k in needed})
+
+    return {
+        'decode_full': dict(measure(lambda: bson_decode(full), repeat), bytes=len(full)),
+        'decode_trimmed': dict(measure(lambda: bson_decode(trimmed), repeat), bytes=len(trimmed)),
+        'calc_values': measure(lambda: gmond_mongodb.calc_values(curr, prev), repeat),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(conf, quick, repeat, log=lambda msg: None):
+    hosts_list = [10, 100] if quick else [10, 100, 1000]
+    shards_list = [1, 5] if quick else [1, 5, 20]
+    results = []
+
+    def add(name, params, res):
+        results.append({'bench': name, 'params': params, 'result': res})
+        log('{} {} done'.format(name, params))
+
+    for hosts in hosts_list:
+        for shards in shards_list:
+            res, metrics = bench_xml_parse(conf, hosts, shards, repeat)
+            add('xml_parse', {'hosts': hosts, 'shards': shards}, res)
+            add('calc_reward', {'hosts': hosts, 'shards': shards}, bench_calc_reward(conf, metrics, repeat))
+
+    for n_states in ([10, 1000] if quick else [10, 1000, 100000]):
+        add('solve', {'states': n_states}, bench_solve(n_states, repeat))
+
+    for hosts in ([10, 1000] if quick else [10, 1000, 100000]):
+        for k in [1, 30]:
+            add('placement', {'hosts': hosts, 'repl_sets': k, 'members': 3}, bench_placement(hosts, k, 3, repeat))
+
+    add('gmond_refresh', {}, bench_gmond(repeat * 10))
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="micro-benchmarks of the monitor's hot paths, as JSON")
+    parser.add_argument('--conf', default='monitor.conf', help="monitor configuration of thresholds and rates")
+    parser.add_argument('--quick', action='store_true', help="smaller sizes only")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of every benchmark")
+    parser.add_argument('-o', '--output', default=None, help="JSON file to write, stdout if not given")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': run(Monitor._read_conf_file(args.conf), args.quick, args.repeat,
+                       lambda msg: print(msg, file=sys.stderr)),
+    }
+    report['seconds'] = perf_counter() - start
+
+    out = json_dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
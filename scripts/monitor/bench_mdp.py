@@ -0,0 +1,72 @@
+from argparse import ArgumentParser
+from time import perf_counter
+from mdp import ClusterMDP
+from random import Random
+
+
+def dict_value_iteration(mdp, epsilon=0.001):
+    """Reference dict based value iteration, as solved before the array form."""
+
+    U1 = {s: 0 for s in mdp.states}
+    R, T, gamma = mdp.R, mdp.T, mdp.gamma
+    while True:
+        U = U1.copy()
+        delta = 0
+        for s in mdp.states:
+            U1[s] = R(s) + gamma * max(sum(p * U[s1] for (p, s1) in T(s, a))
+                                       for a in mdp.actlist[s])
+            delta = max(delta, abs(U1[s] - U[s]))
+        if delta <= epsilon * (1 - gamma) / gamma:
+            return U
+
+
+def dict_best_policy(mdp, U):
+    return {s: max(mdp.actlist[s], key=lambda a: sum(p * U[s1] for (p, s1) in mdp.T(s, a)))
+            for s in mdp.states}
+
+
+def make_mdp(n_states, gamma, seed=0):
+    rnd = Random(seed)
+    states = [str(x) for x in range(1, n_states + 1)]
+    mdp = ClusterMDP(states[n_states // 2], states, gamma=gamma)
+    mdp.reward = {s: rnd.uniform(0, 0.05) for s in states}
+    return mdp
+
+
+def timed(func, *args):
+    start = perf_counter()
+    res = func(*args)
+    return res, perf_counter() - start
+
+
+def bench(n_states, gamma, reference):
+    mdp = make_mdp(n_states, gamma)
+    arr, t_compile = timed(mdp.compile)
+    U, t_solve = timed(mdp.value_iteration_array)
+    vi_iterations = mdp.solve_stats['iterations']
+    _, t_policy = timed(mdp.best_policy, U)
+    line = '{:>7} states: compile {:9.4f}s, value iteration {:9.4f}s ({} sweeps), best policy {:9.4f}s'
+    line = line.format(n_states, t_compile, t_solve, vi_iterations, t_policy)
+
+    if mdp.is_banded():
+        _, t_banded = timed(mdp.policy_iteration_banded)
+        line += ', banded policy iteration {:9.4f}s ({} evaluations)'.format(t_banded, mdp.solve_stats['iterations'])
+
+    if reference:
+        U_ref, t_ref = timed(dict_value_iteration, mdp)
+        same = dict_best_policy(mdp, U_ref) == mdp.best_policy(U)
+        err = max(abs(U_ref[s] - u) for s, u in mdp.value_iteration().items())
+        line += ', dict solver {:9.4f}s (same policy: {}, max |dU|: {:.2e})'.format(t_ref, same, err)
+
+    print(line)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('sizes', type=int, nargs='*', default=[10, 1000, 100000], help="number of states")
+    parser.add_argument('--gamma', type=float, default=0.8, help="discount factor")
+    parser.add_argument('--reference', action='store_true', help="also time and compare the dict solver")
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        bench(n, args.gamma, args.reference)
@@ -0,0 +1,163 @@
+from logging import getLogger as logging_getLogger
+from re import compile as re_compile
+from time import monotonic
+from threading import Event
+
+# mongod metrics of the gmond module are prefixed with shardr<replica set no>s<server no>
+MEMBER_PREFIX = re_compile(r'shardr(\d+)s\d+$')
+
+# cost of a database the shard is primary of, as that of moving all the chunks and data of the largest candidate,
+# for its unsharded collections are moved by movePrimary and removeShard waits for it
+PRIMARY_DB_COST = 1.0
+
+
+def shard_load(metrics, shard_prefix='ShardReplSet'):
+    """
+    Operations per second of every replica set, the sum of the mongodb_op_count_* metrics of its members in metrics,
+    in the layout of XMLHandler.metrics.
+    :return: {shard id: ops/s}
+    """
+    load = {}
+    for dct in metrics.values():
+        for shard, d in dct['shards'].items():
+            m = MEMBER_PREFIX.match(shard)
+            if m is None:
+                continue
+            ops = sum(v for k, v in d.items() if k.startswith('mongodb_op_count_'))
+            key = shard_prefix + m.group(1)
+            load[key] = load.get(key, 0) + ops
+    return load
+
+
+def drain_costs(shard_ids, stats, load=None):
+    """
+    Relative cost of draining each of shard_ids: the mean of its shares of chunks and data size of the largest
+    candidate, plus PRIMARY_DB_COST per database it is primary of, scaled by 1 + its share of the load of the
+    busiest candidate as migrations compete with the workload.
+    :param: stats: {shard id: {'chunks', 'data_size', 'primary_dbs'}} as of Topology.shard_stats, 0 if missing
+    :param: load: {shard id: ops/s}, 0 if missing
+    :return: {shard id: cost}
+    """
+    load = load or {}
+    empty = {'chunks': 0, 'data_size': 0, 'primary_dbs': ()}
+    st = {s: stats.get(s, empty) for s in shard_ids}
+    max_chunks = max([d['chunks'] for d in st.values()] + [0])
+    max_size = max([d['data_size'] for d in st.values()] + [0])
+    max_load = max([load.get(s, 0) for s in shard_ids] + [0])
+
+    costs = {}
+    for s, d in st.items():
+        moved = ((d['chunks'] / max_chunks if max_chunks else 0) + (d['data_size'] / max_size if max_size else 0)) / 2
+        cost = moved + PRIMARY_DB_COST * len(d['primary_dbs'])
+        costs[s] = cost * (1 + (load.get(s, 0) / max_load if max_load else 0))
+    return costs
+
+
+class ShardDrain:
+    """
+    Drain and removal of a shard through removeShard over the connection of a topology backend, polled every
+    min_poll to max_poll seconds: halving the interval while chunks move, doubling it while they do not. Once
+    its chunks are gone, the databases the shard is primary of are moved to primary_to. Cancelling stops polling
+    before the next removeShard, so a drain not started yet never starts; the shard stays draining, as MongoDB
+    has no command to stop a drain, unless unset_draining clears the draining flag of its config.shards document.
+    That is an edit of the cluster metadata MongoDB does not support, and may leave the balancer inconsistent.
+    :param: cancelled: Event shared by the drains of an action, so cancelling one cancels the drains after it
+    """
+
+    def __init__(self, backend, shard, primary_to=None, min_poll=1.0, max_poll=20.0, unset_draining=False,
+                 cancelled=None):
+        self.logger = logging_getLogger(__name__)
+        self.backend = backend
+        self.shard = shard
+        self.primary_to = primary_to
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.unset_draining = unset_draining
+        self.cancelled = cancelled if cancelled is not None else Event()
+        # state: pending, started, ongoing, completed, cancelled or failed; rate in chunks per second
+        self.progress = {'shard': shard, 'state': 'pending', 'chunks': None, 'dbs': None, 'rate': None, 'eta': None}
+
+    def __str__(self):
+        return 'removeShard {} (primary databases to {})'.format(self.shard, self.primary_to)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _stop(self, log, started=True):
+        """Outcome of a cancelled drain, as returned by __call__."""
+        if started and self.unset_draining:
+            try:
+                self.backend.stop_draining(self.shard)
+            except Exception as e:
+                self.progress['state'] = 'failed'
+                return 'stopping the drain of {} failed -- {}'.format(self.shard, e)
+            log('Drain of {} cancelled, its draining flag cleared'.format(self.shard))
+        elif started:
+            self.logger.warning('Drain of {} cancelled: the shard stays draining and its chunks keep moving off it, '
+                                'finish it with removeShard or clear its draining flag in config.shards by hand to '
+                                'keep the shard'.format(self.shard))
+        else:
+            log('Drain of {} cancelled before it started'.format(self.shard))
+        self.progress['state'] = 'cancelled'
+        return 'drain of {} cancelled'.format(self.shard)
+
+    def __call__(self, log=None):
+        """
+        Run the drain to its end.
+        :param: log: callable of progress messages, the logger's info if None
+        :return: '' if the shard was removed, else the error, as the errors of a command
+        """
+        log = log or self.logger.info
+        interval = self.min_poll
+        moved = set()   # databases whose primary was moved
+        prev = None     # (remaining chunks, time) of the previous poll
+
+        if self.cancelled.is_set():
+            return self._stop(log, started=False)
+
+        while True:
+            try:
+                res = self.backend.drain_shard(self.shard)
+            except Exception as e:
+                self.progress['state'] = 'failed'
+                return str(e)
+
+            state = res.get('state')
+            self.progress['state'] = state
+            if state == 'completed':
+                self.progress.update(chunks=0, dbs=0, eta=0.0)
+                log('Removed {}'.format(self.shard))
+                return ''
+
+            remaining = res.get('remaining', {})
+            chunks, dbs = remaining.get('chunks'), remaining.get('dbs')
+            now = monotonic()
+            if chunks is not None and prev is not None:
+                if chunks < prev[0]:
+                    rate = (prev[0] - chunks) / (now - prev[1])
+                    self.progress['rate'] = rate if self.progress['rate'] is None else \
+                        self.progress['rate'] + 0.3 * (rate - self.progress['rate'])
+                    interval = max(self.min_poll, interval / 2)
+                else:
+                    interval = min(self.max_poll, interval * 2)
+            if chunks is not None:
+                prev = (chunks, now)
+                rate = self.progress['rate']
+                self.progress.update(chunks=chunks, dbs=dbs, eta=chunks / rate if rate else None)
+                eta = self.progress['eta']
+                log('Draining {}: {} chunks, {} databases left, ETA {}'.format(
+                    self.shard, chunks, dbs, 'unknown' if eta is None else '{:.0f} s'.format(eta)))
+
+            if chunks == 0 and self.primary_to is not None:
+                for db in set(res.get('dbsToMove', [])) - moved:
+                    log('Moving primary of database {} to {}'.format(db, self.primary_to))
+                    try:
+                        self.backend.move_primary(db, self.primary_to)
+                    except Exception as e:
+                        self.progress['state'] = 'failed'
+                        return 'movePrimary of {} failed -- {}'.format(db, e)
+                    moved.add(db)
+                interval = self.min_poll
+
+            if self.cancelled.wait(interval):
+                return self._stop(log)
@@ -0,0 +1,69 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger as logging_getLogger
+from threading import Thread
+
+
+def render(families):
+    """
+    Prometheus text exposition (format 0.0.4) of metric families.
+    :param: families: iterable of (name, type, help, samples), samples a list of (labels dict, value) or of
+                      (name suffix, labels dict, value), e.g. the _bucket, _sum and _count samples of a histogram
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 else ('',) + tuple(sample)
+            label_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels.items())
+            lines.append('{}{}{} {}'.format(name, suffix, '{' + label_str + '}' if label_str else '', float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def histogram_samples(bounds, cumulative, total, count, labels=None):
+    """Samples of a histogram family from the cumulative counts up to every bound, the sum and the count."""
+    labels = labels or {}
+    samples = [('_bucket', dict(labels, le='+Inf' if b == float('inf') else '{:g}'.format(b)), n)
+               for b, n in zip(bounds, cumulative)]
+    return samples + [('_sum', labels, total), ('_count', labels, count)]
+
+
+class MetricsExporter:
+    """Serve the families returned by collect on http://bind:port/metrics, from a daemon thread."""
+
+    def __init__(self, collect, port=9108, bind='127.0.0.1'):
+        self.logger = logging_getLogger(__name__)
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(collect()).encode()
+                except Exception as e:
+                    exporter.logger.error('Metrics collection failed -- {}'.format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                exporter.logger.debug(fmt % args)
+
+        self.server = ThreadingHTTPServer((bind, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.logger.info('Serving metrics on http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
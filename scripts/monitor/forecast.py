@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def linear_forecast(t, V, at):
+    """
+    Least squares line through every column of V (samples x series, NaN where missing) over the sample times t,
+    evaluated at time at. Columns with a single sample forecast that sample, columns without any NaN.
+    """
+    ok = ~np.isnan(V)
+    n = ok.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_mean = np.where(ok, t[:, None], 0.0).sum(axis=0) / n
+        v_mean = np.where(ok, V, 0.0).sum(axis=0) / n
+        dt = np.where(ok, t[:, None] - t_mean, 0.0)
+        sxx = (dt * dt).sum(axis=0)
+        sxy = (dt * np.where(ok, V - v_mean, 0.0)).sum(axis=0)
+        slope = np.where(sxx > 0, sxy / sxx, 0.0)
+    return v_mean + slope * (at - t_mean)
+
+
+def holt_forecast(t, V, at, alpha=0.5, beta=0.3):
+    """
+    Holt's linear exponential smoothing of every column of V (samples x series, NaN where missing) over the
+    sample times t, forecast at time at. The trend is kept per second, so irregular sampling is accounted for,
+    and starts at the slope of the first two samples, so a linear series is extrapolated exactly.
+    beta = 0 keeps the trend at 0, i.e. a plain EWMA of the level.
+    """
+    level = np.full(V.shape[1], np.nan)
+    trend = np.zeros(V.shape[1])
+    last = np.full(V.shape[1], np.nan)
+    seeded = np.full(V.shape[1], beta == 0)
+
+    for i in range(V.shape[0]):
+        v = V[i]
+        ok = ~np.isnan(v)
+        first = ok & np.isnan(level)
+        level[first] = v[first]
+        last[first] = t[i]
+
+        dt = t[i] - last
+        upd = ok & ~first & (dt > 0)
+        if not upd.any():
+            continue
+        seed = upd & ~seeded
+        trend[seed] = (v[seed] - level[seed]) / dt[seed]
+        level[seed] = v[seed]
+        last[seed] = t[i]
+        seeded |= seed
+
+        upd &= ~seed
+        prev = level[upd]
+        pred = prev + trend[upd] * dt[upd]
+        level[upd] = alpha * v[upd] + (1 - alpha) * pred
+        trend[upd] = beta * (level[upd] - prev) / dt[upd] + (1 - beta) * trend[upd]
+        last[upd] = t[i]
+
+    return level + trend * (at - last)
+
+
+class Forecaster:
+    """
+    Metrics forecast horizon seconds ahead from the recent samples of a MetricStore, so that capacity may be
+    added while load is still rising, before it peaks. Only the metrics named are forecast.
+    :param: method: one of ewma, holt, linear
+    :param: window: number of recent samples fitted
+    """
+
+    methods = ('ewma', 'holt', 'linear')
+
+    def __init__(self, metric_names, method='holt', window=12, alpha=0.5, beta=0.3):
+        if method not in self.methods:
+            raise ValueError('forecast method not one of: ' + ', '.join(self.methods))
+        self.metric_names = set(metric_names)
+        self.method = method
+        self.window = window
+        self.alpha = alpha
+        self.beta = 0.0 if method == 'ewma' else beta
+
+    def forecast(self, store, horizon):
+        """(host, shard, metric) names and forecast values of the forecast series of the latest sample."""
+        t, V, names = store.recent(self.window, self.metric_names)
+        if not names:
+            return names, np.empty(0)
+
+        at = t[-1] + horizon
+        if self.method == 'linear':
+            F = linear_forecast(t, V, at)
+        else:
+            F = holt_forecast(t, V, at, self.alpha, self.beta)
+
+        # loads and rates do not go negative, however steep the fall
+        return names, np.maximum(F, 0.0)
+
+    def apply(self, store, metrics, horizon):
+        """Copy of metrics, in the layout of XMLHandler.metrics, with the forecast metrics at their forecast."""
+        res = {host: dict(dct, shards={s: dict(d) for s, d in dct['shards'].items()}) for host, dct in metrics.items()}
+        for (host, shard, metric), val in zip(*self.forecast(store, horizon)):
+            dct = res.get(host)
+            if dct is not None and shard is not None:
+                dct = dct['shards'].get(shard)
+            if dct is not None and metric in dct and not np.isnan(val):
+                dct[metric] = float(val)
+        return res
@@ -0,0 +1,272 @@
+from socket import socket, inet_aton, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, IPPROTO_IP, \
+    IP_ADD_MEMBERSHIP, INADDR_ANY
+from metrics import CounterRates, split_metric_name, ready_metrics
+from logging import getLogger as logging_getLogger
+from threading import Thread, Event, Lock
+from argparse import ArgumentParser
+from time import time, sleep
+import struct
+
+# message ids of the gmond (3.1+) XDR wire format
+GMETADATA_FULL = 128
+GMETRIC_USHORT = 129
+GMETRIC_SHORT = 130
+GMETRIC_INT = 131
+GMETRIC_UINT = 132
+GMETRIC_STRING = 133
+GMETRIC_FLOAT = 134
+GMETRIC_DOUBLE = 135
+GMETADATA_REQUEST = 136
+
+# value type: (message id, XDR format), shorts are padded to 4 bytes as any XDR integer
+VALUE_TYPES = {
+    'uint16': (GMETRIC_USHORT, '>I'),
+    'int16': (GMETRIC_SHORT, '>i'),
+    'int32': (GMETRIC_INT, '>i'),
+    'uint32': (GMETRIC_UINT, '>I'),
+    'string': (GMETRIC_STRING, None),
+    'float': (GMETRIC_FLOAT, '>f'),
+    'double': (GMETRIC_DOUBLE, '>d'),
+}
+VALUE_FORMATS = {msg_id: fmt for msg_id, fmt in VALUE_TYPES.values()}
+
+
+class XDRReader:
+    """Sequential reader of XDR encoded data, raising struct.error on truncated data."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt):
+        val, = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return val
+
+    def string(self):
+        n = self.unpack('>I')
+        if self.pos + n > len(self.data):
+            raise struct.error('string past end of packet')
+        val = self.data[self.pos:self.pos + n].decode('utf-8', 'replace')
+        self.pos += (n + 3) & ~3
+        return val
+
+
+def xdr_string(s):
+    b = s.encode()
+    return struct.pack('>I', len(b)) + b + b'\0' * (-len(b) % 4)
+
+
+def decode_packet(data):
+    """
+    Decode a gmond packet to (host, metric name, value), None for metadata and metadata requests.
+    :raises: ValueError: for unknown message ids, struct.error: for truncated packets
+    """
+    r = XDRReader(data)
+    msg_id = r.unpack('>I')
+    if msg_id == GMETADATA_FULL or msg_id == GMETADATA_REQUEST:
+        return None
+    if msg_id not in VALUE_FORMATS:
+        raise ValueError('unknown gmond message id {}'.format(msg_id))
+
+    host = r.string()
+    name = r.string()
+    r.unpack('>I')  # spoof
+    r.string()      # printf format of the value
+    fmt = VALUE_FORMATS[msg_id]
+    value = r.string() if fmt is None else r.unpack(fmt)
+    return host, name, value
+
+
+def encode_metadata(host, name, value_type, units='', slope='both', tmax=60, dmax=0, extra=None):
+    """Metadata packet of a metric, as gmond sends before its values and every send_metadata_interval."""
+    slopes = {'zero': 0, 'positive': 1, 'negative': 2, 'both': 3, 'unspecified': 4}
+    extra = extra or {}
+    data = struct.pack('>I', GMETADATA_FULL) + xdr_string(host) + xdr_string(name) + struct.pack('>I', 0)
+    data += xdr_string(value_type) + xdr_string(name) + xdr_string(units)
+    data += struct.pack('>III', slopes[slope], tmax, dmax) + struct.pack('>I', len(extra))
+    for k, v in extra.items():
+        data += xdr_string(k) + xdr_string(v)
+    return data
+
+
+def encode_metric(host, name, value, value_type='double'):
+    """Value packet of a metric."""
+    msg_id, fmt = VALUE_TYPES[value_type]
+    data = struct.pack('>I', msg_id) + xdr_string(host) + xdr_string(name) + struct.pack('>I', 0)
+    if fmt is None:
+        return data + xdr_string('%s') + xdr_string(str(value))
+    printf = '%f' if value_type in ('float', 'double') else '%d'
+    return data + xdr_string(printf) + struct.pack(fmt, value)
+
+
+class GmondListener(Thread):
+    """
+    Metrics pushed by gmond over UDP, kept in the layout of XMLHandler.metrics. Any change of a metric value
+    sets the changed event, so the monitor may re-evaluate within the collection period of gmond.
+    """
+
+    def __init__(self, port=8650, bind='', mcast_join=None, delta_metrics=(), wanted=None, ignore_hosts=(),
+                 expire=60):
+        super().__init__(daemon=True)
+        self.logger = logging_getLogger(__name__)
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind((bind, port))
+        if mcast_join:
+            mreq = struct.pack('4sl', inet_aton(mcast_join), INADDR_ANY)
+            self.sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, mreq)
+
+        self.wanted = wanted
+        self.ignore_hosts = set(ignore_hosts)
+        self.delta_metrics = set(delta_metrics)
+        self.expire = expire
+
+        self.metrics = {}
+        self.rates = CounterRates()
+        self.pending = set()    # counters without a rate yet
+        self.updated = {}       # (host, shard): time of last value
+        self.departed = set()   # hosts expired by the last snapshot
+        self.packets = 0
+        self.changed = Event()
+        self._lock = Lock()
+
+    def run(self):
+        while True:
+            data, addr = self.sock.recvfrom(65536)
+            self.packets += 1
+            try:
+                msg = decode_packet(data)
+            except (ValueError, struct.error) as e:
+                self.logger.debug('Dropped packet from {} -- {}'.format(addr[0], e))
+                continue
+
+            if msg is not None:
+                host, name, value = msg
+                self.ingest(host or addr[0], name, value, time())
+
+    def ingest(self, host, name, value, now):
+        if host in self.ignore_hosts:
+            return
+
+        shard, name = split_metric_name(name)
+        if self.wanted is not None and name not in self.wanted:
+            return
+
+        with self._lock:
+            if name in self.delta_metrics:
+                key = (host, shard, name)
+                value = self.rates.rate(key, value, now)
+                if value is None:
+                    self.pending.add(key)
+                    return
+                self.pending.discard(key)
+
+            if host not in self.metrics:
+                self.metrics[host] = {'shards': {}}
+            dct = self.metrics[host]
+            if shard is not None:
+                dct = dct['shards'].setdefault(shard, {})
+
+            if dct.get(name) != value:
+                dct[name] = value
+                self.changed.set()
+            self.updated[(host, shard)] = now
+
+    def wait_change(self, timeout, settle=0.2):
+        """
+        Wait up to timeout seconds for a changed metric, then settle seconds more for the rest of the packets of
+        the same gmond collection round.
+        :return: True if a metric changed
+        """
+        changed = self.changed.wait(timeout)
+        if changed and settle:
+            sleep(settle)
+        self.changed.clear()
+        return changed
+
+    def snapshot(self):
+        """Current metrics, without hosts/shards silent for expire seconds or whose rates are not ready yet."""
+        now = time()
+        with self._lock:
+            self.departed = set()
+            for host, shard in [k for k, t in self.updated.items() if now - t > self.expire]:
+                del self.updated[(host, shard)]
+                if host not in self.metrics:
+                    continue
+                if shard is None:
+                    del self.metrics[host]
+                    self.departed.add(host)
+                else:
+                    self.metrics[host]['shards'].pop(shard, None)
+
+            self.rates.retain({k for k, v in self.rates.counters.items() if now - v[1] <= self.expire})
+            self.pending &= set(self.rates.counters)
+            warming = {(k[0], k[1]) for k in self.pending}
+            return ready_metrics(self.metrics, warming)
+
+
+def generate(dest, port, hosts, shards, interval, rate, spike, spike_after):
+    """
+    Send gmond like packets of the mongodb module metrics, the query rate jumping from rate to spike after
+    spike_after seconds.
+    """
+    s = socket(AF_INET, SOCK_DGRAM)
+    counters = {}
+    start = time()
+    for host in hosts:
+        for shard in ['shardr{}s{}'.format(i // 3 + 1, i % 3 + 1) for i in range(shards)]:
+            s.sendto(encode_metadata(host, shard + '_mongodb_op_count_query', 'uint32', 'ops', 'positive'),
+                     (dest, port))
+            s.sendto(encode_metadata(host, shard + '_mongodb_conn_current', 'uint32', 'connections'), (dest, port))
+
+    while True:
+        elapsed = time() - start
+        curr_rate = spike if spike_after and elapsed > spike_after else rate
+        for host in hosts:
+            s.sendto(encode_metric(host, 'cpu_user', 20.0 + curr_rate / 100, 'float'), (dest, port))
+            for i in range(shards):
+                shard = 'shardr{}s{}'.format(i // 3 + 1, i % 3 + 1)
+                key = (host, shard)
+                counters[key] = counters.get(key, 0) + int(curr_rate * interval)
+                s.sendto(encode_metric(host, shard + '_mongodb_op_count_query', counters[key], 'uint32'),
+                         (dest, port))
+                s.sendto(encode_metric(host, shard + '_mongodb_conn_current', int(curr_rate / 10), 'uint32'),
+                         (dest, port))
+        sleep(interval)
+
+
+def listen(port, mcast_join, delta_metrics):
+    listener = GmondListener(port, mcast_join=mcast_join, delta_metrics=delta_metrics)
+    listener.start()
+    while True:
+        if listener.wait_change(10):
+            print('{:.3f} ({} packets): {}'.format(time(), listener.packets, listener.snapshot()))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="gmond packet generator and listener")
+    sub = parser.add_subparsers(dest='mode', required=True)
+
+    gen = sub.add_parser('send', help="send synthetic metric packets")
+    gen.add_argument('--dest', default='127.0.0.1', help="destination address")
+    gen.add_argument('-p', '--port', type=int, default=8650, help="destination port")
+    gen.add_argument('-H', '--hosts', nargs='+', default=['localhost'], help="host names in the packets")
+    gen.add_argument('-s', '--shards', type=int, default=1, help="shards per host")
+    gen.add_argument('-i', '--interval', type=float, default=1.0, help="seconds between collection rounds")
+    gen.add_argument('-r', '--rate', type=float, default=500, help="queries per second")
+    gen.add_argument('--spike', type=float, default=0, help="queries per second after spike-after seconds")
+    gen.add_argument('--spike-after', type=float, default=0, help="seconds before the spike")
+
+    lst = sub.add_parser('listen', help="print the metrics on every change")
+    lst.add_argument('-p', '--port', type=int, default=8650, help="listening port")
+    lst.add_argument('--mcast-join', default=None, help="multicast group to join")
+    lst.add_argument('--delta', nargs='*', default=['mongodb_op_count_query'], help="counters to turn to rates")
+
+    args = parser.parse_args()
+    if args.mode == 'send':
+        generate(args.dest, args.port, args.hosts, args.shards, args.interval, args.rate, args.spike,
+                 args.spike_after)
+    else:
+        listen(args.port, args.mcast_join, args.delta)
@@ -1,10 +1,30 @@
 from logging import getLogger as logging_getLogger
+from logging import DEBUG
 from json import dumps
-from operator import gt as operator_gt
-from operator import lt as operator_lt
+from itertools import repeat
+from math import comb
+from time import perf_counter
+import numpy as np
+
+try:
+    from scipy.linalg import solve_banded as scipy_solve_banded
+except ImportError:
+    scipy_solve_banded = None
 
 
 class MDP:
+    # widest band solved exactly by banded policy iteration
+    max_bandwidth = 8
+    # least gamma for which solve() prefers banded policy iteration, below it value iteration converges in few
+    # enough sweeps to be as fast (see bench_mdp.py)
+    banded_min_gamma = 0.85
+    # largest share of states whose reward may move for solve() to only propagate the change, to a tolerance
+    # tighter than that of a full solve so near ties resolve as a full solve would, and at most full_every times
+    # in a row so the errors of the states left out of the propagation cannot add up
+    local_share = 0.25
+    incremental_epsilon = 1e-6
+    full_every = 100
+
     def __init__(self, curr_state, actlist, transitions=None, reward=None, states=None, gamma=0.9):
         self.logger = logging_getLogger('mdp')
         
@@ -23,6 +43,16 @@ class MDP:
 
         self.reward = reward or {s: 0 for s in self.states}
 
+        # array form of the model, compiled lazily from self.transitions
+        self._arrays = None
+
+        # last solution, kept to warm start the next solve
+        self._U = None
+        self._R = None
+        self._pi = None
+        self._incremental = 0   # incremental solves since the last full one
+        self.solve_stats = {'mode': None, 'iterations': 0, 'time': 0.0}
+
         # self.check_consistency()
 
     def R(self, state):
@@ -67,87 +97,417 @@ class MDP:
                     s += o[0]
                 assert abs(s - 1) < 0.001
 
+    def compile(self):
+        """Index the states and flatten the transition model into sparse arrays,
+        one row per (state, action slot) pair, where the slot of an action is
+        its position in self.actlist[state]. Entries are kept grouped by state
+        (indptr) and by result-state (pred_ptr, preds) so that backups can be
+        restricted to a subset of states."""
+
+        states = list(self.states)
+        index = {s: i for i, s in enumerate(states)}
+        slots = max(len(self.actlist[s]) for s in states)
+
+        rows, cols, probs = [], [], []
+        indptr = np.zeros(len(states) + 1, dtype=np.intp)
+        valid = np.zeros((len(states), slots), dtype=bool)
+        for i, s in enumerate(states):
+            for j, a in enumerate(self.actlist[s]):
+                valid[i, j] = True
+                for (p, s1) in self.T(s, a):
+                    rows.append(i * slots + j)
+                    cols.append(index[s1])
+                    probs.append(p)
+            indptr[i + 1] = len(rows)
+
+        rows = np.array(rows, dtype=np.intp)
+        cols = np.array(cols, dtype=np.intp)
+        by_col = np.argsort(cols, kind='stable')
+
+        self._arrays = {
+            'states': states,
+            'index': index,
+            'slots': slots,
+            'rows': rows,
+            'cols': cols,
+            'probs': np.array(probs, dtype=float),
+            'valid': valid,
+            'indptr': indptr,
+            'preds': rows[by_col] // slots,
+            'pred_ptr': np.concatenate(([0], np.cumsum(np.bincount(cols, minlength=len(states))))),
+            # farthest any state reaches, 1 for a birth-death chain
+            'bandwidth': int(np.abs(cols - rows // slots).max()),
+        }
+        self.logger.debug('compiled {} states, {} transitions, bandwidth {}'.format(len(states), len(rows),
+                                                                                   self._arrays['bandwidth']))
+        return self._arrays
+
+    def q_values(self, U, idx=None):
+        """Expected next utility of every (state, action slot) pair as a
+        (states x slots) matrix, -inf where the slot holds no action.
+        If idx is given, only the rows of those state indices are computed."""
+
+        arr = self._arrays or self.compile()
+        slots = arr['slots']
+        if idx is None:
+            rows, cols, probs, valid = arr['rows'], arr['cols'], arr['probs'], arr['valid']
+        else:
+            ent = _ranges(arr['indptr'], idx)
+            local = np.repeat(np.arange(idx.size), np.diff(arr['indptr'])[idx])
+            rows = local * slots + arr['rows'][ent] % slots
+            cols, probs, valid = arr['cols'][ent], arr['probs'][ent], arr['valid'][idx]
+
+        Q = np.bincount(rows, weights=probs * U[cols], minlength=valid.size).reshape(valid.shape)
+        Q[~valid] = -np.inf
+        return Q
+
+    def reward_vector(self):
+        arr = self._arrays or self.compile()
+        return np.array([self.R(s) for s in arr['states']], dtype=float)
+
+    def value_iteration_array(self, epsilon=0.001, U=None):
+        """Value iteration over the array form of the MDP, returning U as a
+        vector indexed like the compiled states. A previous U may be passed
+        to warm start the iteration."""
+
+        R, gamma = self.reward_vector(), self.gamma
+        U1 = np.zeros(R.size) if U is None else U
+        self.solve_stats['iterations'] = 0
+        while True:
+            U = U1
+            U1 = R + gamma * self.q_values(U).max(axis=1)
+            self.solve_stats['iterations'] += 1
+            delta = np.abs(U1 - U).max()
+            if delta <= epsilon * (1 - gamma) / gamma:
+                return U
+
+    def propagate_values(self, U, changed, epsilon=0.001):
+        """Update a converged U after the rewards of the state indices in changed
+        moved, backing up only states whose successors' utility moved by more
+        than the convergence tolerance."""
+
+        R, gamma = self.reward_vector(), self.gamma
+        arr = self._arrays
+        tol = epsilon * (1 - gamma) / gamma
+        U = U.copy()
+        frontier = changed
+        self.solve_stats['iterations'] = 0
+        while frontier.size:
+            U1 = R[frontier] + gamma * self.q_values(U, frontier).max(axis=1)
+            moved = frontier[np.abs(U1 - U[frontier]) > tol]
+            U[frontier] = U1
+            frontier = np.unique(arr['preds'][_ranges(arr['pred_ptr'], moved)])
+            self.solve_stats['iterations'] += 1
+        return U
+
+    def is_banded(self):
+        """Whether the MDP can be solved by banded policy iteration, which
+        needs scipy: a banded solve in Python is slower than value iteration."""
+        if scipy_solve_banded is None:
+            return False
+        arr = self._arrays or self.compile()
+        return self.gamma < 1 and arr['bandwidth'] <= self.max_bandwidth
+
+    def evaluate_banded_policy(self, pi, R=None):
+        """Exact utility of the policy pi (action slot per state index) of a
+        banded MDP, solving the banded system (I - gamma * P_pi) U = R."""
+
+        arr = self._arrays or self.compile()
+        n = len(arr['states'])
+        ent_state = np.repeat(np.arange(n), np.diff(arr['indptr']))
+        sel = arr['rows'] == ent_state * arr['slots'] + pi[ent_state]
+
+        # the offset of the result-state selects the diagonal, b is the main one
+        b = arr['bandwidth']
+        state, offset = ent_state[sel], arr['cols'][sel] - ent_state[sel]
+        band = np.zeros((n, 2 * b + 1))
+        np.add.at(band, (state, offset + b), -self.gamma * arr['probs'][sel])
+        band[:, b] += 1.0
+        return _solve_banded(band, self.reward_vector() if R is None else R)
+
+    def policy_iteration_banded(self, pi=None):
+        """Solving a banded MDP by policy iteration, with an O(n * b^2) banded
+        solve per policy evaluation for bandwidth b. A previous policy may be
+        passed to warm start the iteration. Returns U and the policy as action
+        slots."""
+
+        arr = self._arrays or self.compile()
+        pi = np.zeros(len(arr['states']), dtype=np.intp) if pi is None else pi
+        rows = np.arange(pi.size)
+        R = self.reward_vector()
+        self.solve_stats['iterations'] = 0
+        while True:
+            U = self.evaluate_banded_policy(pi, R)
+            self.solve_stats['iterations'] += 1
+
+            # switch action only on a strict improvement, so that ties cannot cycle
+            Q = self.q_values(U)
+            best = Q.argmax(axis=1)
+            improve = Q[rows, best] > Q[rows, pi] + 1e-12 * np.maximum(1.0, np.abs(U))
+            if not improve.any():
+                return U, pi
+            pi = np.where(improve, best, pi)
+
     def value_iteration(self, epsilon=0.001):
         """Solving an MDP by value iteration."""
 
         self.logger.debug('value iteration started')
-        U1 = {s: 0 for s in self.states}
-        R, T, gamma = self.R, self.T, self.gamma
-        while True:
-            U = U1.copy()
-            delta = 0
-            for s in self.states:
-                U1[s] = R(s) + gamma * max(sum(p * U[s1] for (p, s1) in T(s, a))
-                                           for a in self.actlist[s])
-                delta = max(delta, abs(U1[s] - U[s]))
-            if delta <= epsilon * (1 - gamma) / gamma:
-                self.logger.debug('value iteration done')
-                return U
+        U = self.value_iteration_array(epsilon)
+        self.logger.debug('value iteration done')
+        return dict(zip(self._arrays['states'], U.tolist()))
 
     def best_policy(self, U):
         """Given an MDP and a utility function U, determine the best policy,
         as a mapping from state to action."""
 
-        pi = {}
-        for s in self.states:
-            pi[s] = max(self.actlist[s], key=lambda a: sum(p * U[s1] for (p, s1) in self.T(s, a)))
-        
-        return pi
+        arr = self._arrays or self.compile()
+        if isinstance(U, dict):
+            U = np.array([U[s] for s in arr['states']], dtype=float)
+
+        # argmax keeps the first best slot, i.e. ties resolve in actlist order
+        best = self.q_values(U).argmax(axis=1)
+        return {s: self.actlist[s][j] for s, j in zip(arr['states'], best.tolist())}
 
     def solve(self):
-        return self.best_policy(self.value_iteration())[self.curr_state]
+        """Best action for the current state. The last solution is kept: it is
+        reused as is if neither rewards nor transitions changed, and updated
+        from the states whose reward moved if only the rewards of up to
+        local_share of the states changed, up to full_every times in a row.
+        Otherwise MDPs whose states only reach states at most max_bandwidth
+        indices away, e.g. the birth-death chain of ClusterMDP, are solved
+        exactly by policy iteration if banded_min_gamma <= gamma < 1 and scipy
+        is installed, warm started from the previous policy; any other MDP
+        falls back to value iteration, warm started from the previous utility."""
+
+        start = perf_counter()
+        recompiled = self._arrays is None
+        R = self.reward_vector()
+        changed = None if recompiled or self._U is None else np.flatnonzero(R != self._R)
+        self._R = R
+
+        if changed is not None and not changed.size:
+            self.solve_stats['iterations'] = 0
+            self.solve_stats['mode'] = 'skipped'
+        elif (changed is not None and changed.size <= self.local_share * R.size
+              and self._incremental < self.full_every):
+            self._U = self.propagate_values(self._U, changed, self.incremental_epsilon)
+            self._pi = None
+            self._incremental += 1
+            self.solve_stats['mode'] = 'incremental'
+        elif self.gamma >= self.banded_min_gamma and self.is_banded():
+            pi = self._pi
+            if pi is None and self._U is not None and not recompiled:
+                pi = self.q_values(self._U).argmax(axis=1)
+            self._U, self._pi = self.policy_iteration_banded(pi)
+            self.solve_stats['mode'] = 'banded'
+        else:
+            self._U = self.value_iteration_array(U=self._U)
+            self._pi = None
+            self.solve_stats['mode'] = 'full'
+        if self.solve_stats['mode'] in ('banded', 'full'):
+            self._incremental = 0
+
+        i = self._arrays['index'][self.curr_state]
+        best = self._pi[i] if self._pi is not None else self.q_values(self._U, np.array([i]))[0].argmax()
+        self.solve_stats['time'] = perf_counter() - start
+        return self.actlist[self.curr_state][best]
 
 
 class ClusterMDP(MDP):
-    def __init__(self, curr_state, states, transitions=None, reward=None, gamma=0.8):
+    def __init__(self, curr_state, states, transitions=None, reward=None, gamma=0.8, max_step=1):
         states.sort(key=int)
+        self.max_step = max_step
         actlist = {}
         for i in range(len(states)):
             actlist[states[i]] = ['nop']
-            
-            if i+1 < len(states):
-                if i-1 > -1:
-                    actlist[states[i]] += ['rmv', 'add']
-                else:
-                    actlist[states[i]] += ['add']
-            else:
-                actlist[states[i]] += ['rmv']
+            actlist[states[i]] += [action_name('rmv', k) for k in range(1, max_step+1) if i-k > -1]
+            actlist[states[i]] += [action_name('add', k) for k in range(1, max_step+1) if i+k < len(states)]
 
         super().__init__(curr_state, actlist, transitions, reward, states, gamma)
         self.logger.info('Initial state of {} shard(s)'.format(curr_state))
 
+        # thresholds compiled to arrays, see compile_thresholds
+        self._thresholds = None
+
+        # expected seconds of the actions and of a decision period, see set_durations
+        self.durations = {}
+        self.period = None
+
         self.action_stats = {'#add': 100, '#rmv': 100, 'ok_add': 99, 'ok_rmv': 99}
         self.calc_transitions(self.action_stats['ok_add'] / self.action_stats['#add'],
                               self.action_stats['ok_rmv'] / self.action_stats['#rmv'])
 
-    def calc_reward_aux(self, metrics, thresholds, action='add', delta=0.01):
+    def scale_steps(self, values, thresholds, lo, action):
+        """Number of replica sets to add or remove so that metrics with values
+        per shard meet thresholds, assuming load spreads evenly over shards.
+        Only metrics that grow with load per shard ('_hi' for add, '_lo' for
+        rmv) are scaled, any other violation asks for a single step.
+        Element-wise over arrays, lo marking the '_lo' thresholds."""
+
+        shards = int(self.curr_state)
+        if self.max_step == 1:
+            return np.ones(values.shape, dtype=np.intp)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = shards * values / thresholds
+            if action == 'add':
+                steps = np.where(~lo & (thresholds > 0), np.ceil(ratio) - shards, 1)
+            else:
+                steps = np.where(lo & (thresholds > 0), shards - (np.floor(ratio) + 1), 1)
+
+        steps = np.nan_to_num(steps, nan=1, posinf=self.max_step, neginf=1)
+        return np.clip(steps, 1, self.max_step).astype(np.intp)
+
+    def compile_thresholds(self, thresholds_add, thresholds_rmv, aggregation=None):
+        """Thresholds as arrays over the union of their metrics, compiled
+        again only when the thresholds change. aggregation maps threshold
+        names to parse_aggregation results, unlisted ones vote per shard."""
+
+        aggregation = aggregation or {}
+        key = (tuple(thresholds_add.items()), tuple(thresholds_rmv.items()), tuple(aggregation.items()))
+        if self._thresholds is not None and self._thresholds['key'] == key:
+            return self._thresholds
+
+        metrics = sorted({t[:-3] for t in thresholds_add} | {t[:-3] for t in thresholds_rmv})
+        col = {m: i for i, m in enumerate(metrics)}
+
+        def compile_side(thresholds):
+            names = list(thresholds)
+            aggs = [aggregation.get(t, ('shard', None)) for t in names]
+            shard = np.array([kind == 'shard' for kind, _ in aggs], dtype=bool)
+            agg = ~shard
+            return {'names': names,
+                    'cols': np.array([col[t[:-3]] for t in names], dtype=np.intp),
+                    'values': np.array([thresholds[t] for t in names], dtype=float),
+                    'lo': np.array([t[-3:] == '_lo' for t in names], dtype=bool),
+                    'shard': shard,
+                    'percentile': np.array([p if kind == 'percentile' else np.nan for kind, p in aggs])[agg],
+                    'quorum': np.array([q if kind == 'quorum' else np.nan for kind, q in aggs])[agg]}
+
+        self._thresholds = {'key': key, 'metrics': metrics,
+                            'add': compile_side(thresholds_add), 'rmv': compile_side(thresholds_rmv)}
+        return self._thresholds
+
+    @staticmethod
+    def metric_matrix(metrics, names):
+        """Shard names, shard weights and (shard x metric) matrix of the
+        metrics names, host metrics repeated for every shard of the host and
+        NaN where missing. Weights are 1 / shards of the host, so that every
+        host weighs the same in cluster aggregates. Built a column at a time
+        over the (host, shard) pairs, without merging their dicts."""
+
+        nan = float('nan')
+        shards, weights, pairs = [], [], []
+        for dct in metrics.values():
+            shard_dcts = dct['shards']
+            if not shard_dcts:
+                continue
+            weights.extend(repeat(1 / len(shard_dcts), len(shard_dcts)))
+            shards.extend(shard_dcts)
+            pairs.extend(zip(repeat(dct), shard_dcts.values()))
+
+        # host metrics take precedence over shard metrics of the same name
+        columns = [[h[name] if name in h else s.get(name, nan) for h, s in pairs] for name in names]
+        return shards, np.array(weights), np.array(columns, dtype=float).reshape(len(names), len(shards)).T
+
+    @staticmethod
+    def aggregate(V, weights, violated, percentile, quorum):
+        """Cluster values of the columns of V and whether they violate, by
+        weighted percentile (percentile not NaN), by weighted quorum of
+        violating shards (quorum not NaN, value the weighted mean) or by
+        weighted mean (both NaN). Columns without values are None in neither."""
+
+        valid = ~np.isnan(V)
+        W = weights[:, None] * valid
+        total = W.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, V, 0.0).T @ weights / total
+            share = (W * violated).sum(axis=0) / total
+
+        # NaN sort last and weigh nothing, so the cumulative weight stops at the last value
+        order = np.argsort(V, axis=0)
+        cum = np.cumsum(np.take_along_axis(W, order, axis=0), axis=0)
+        idx = np.minimum((cum < np.nan_to_num(percentile) * total - 1e-12).sum(axis=0), len(V) - 1)
+        pct = np.take_along_axis(V, np.take_along_axis(order, idx[None, :], axis=0), axis=0)[0]
+
+        has_pct, has_quorum = ~np.isnan(percentile), ~np.isnan(quorum)
+        values = np.where(has_pct, pct, mean)
+        with np.errstate(invalid='ignore'):
+            return values, has_quorum & (share >= quorum), total > 0
+
+    def calc_reward_aux(self, values, weights, compiled, action='add', delta=0.01):
+        """Votes of every (shard, threshold) pair of the (shard x metric) values
+        against the compiled thresholds of action, as a single comparison, and
+        of the cluster aggregates of the thresholds with an aggregation."""
+
         index = self.states.index(self.curr_state)
         if action == 'add':
-            next_index = index + 1
+            sign = 1
             nop = False
             weight = 2.5
         else:
-            next_index = index - 1
+            sign = -1
             nop = True
             weight = 0.8
 
-        if next_index < 0 or next_index > len(self.states)-1:
+        if index + sign < 0 or index + sign > len(self.states)-1:
             return
 
-        def violation_check(shard, value, threshold, comp_func, nop):
-            if comp_func(value, threshold):
-                self.logger.debug(shard + ' violated ' + t + ', voted for ' + action)
-                self.reward[self.states[next_index]] += delta * weight
-            elif nop:
-                self.reward[self.states[index]] += delta
-
-        for t in thresholds:
-            for host, dct in metrics.items():
-                for shard, shard_dct in dct['shards'].items():
-                    metric_name = t[:-3]
-                    value = dct[metric_name] if metric_name in dct else shard_dct[metric_name]
-                    comp_func = operator_lt if t[-3:] == '_lo' else operator_gt
-                    violation_check(shard, value, thresholds[t], comp_func, nop)
+        V = values[:, compiled['cols']]
+        thr, lo = compiled['values'], compiled['lo']
+        valid = ~np.isnan(V)
+        with np.errstate(invalid='ignore'):
+            violated = np.where(lo, V < thr, V > thr) & valid
+
+        steps = self.scale_steps(V, thr, lo, action)
+
+        # per shard thresholds, a vote of every shard
+        shard = compiled['shard']
+        if shard.all():
+            shard_steps, shard_valid, shard_violated = steps, valid, violated
+        else:
+            shard_steps, shard_valid, shard_violated = steps[:, shard], valid[:, shard], violated[:, shard]
+        vote_steps, vote_weights = [shard_steps[shard_violated]], [np.ones(np.count_nonzero(shard_violated))]
+        nops = np.count_nonzero(shard_valid & ~shard_violated)
+        violations = violated.sum(axis=0)
+
+        # cluster thresholds, a single verdict cast with the weight of all shards, so they weigh as much
+        # as per shard thresholds the shards agree on
+        if not shard.all():
+            agg = ~shard
+            A, quorum_met, present = self.aggregate(V[:, agg], weights, violated[:, agg],
+                                                    compiled['percentile'], compiled['quorum'])
+            with np.errstate(invalid='ignore'):
+                agg_violated = np.where(np.isnan(compiled['quorum']),
+                                        np.where(lo[agg], A < thr[agg], A > thr[agg]), quorum_met) & present
+            agg_steps = self.scale_steps(A, thr[agg], lo[agg], action)
+            n = valid[:, agg].sum(axis=0)
+            vote_steps.append(agg_steps[agg_violated])
+            vote_weights.append(n[agg_violated].astype(float))
+            nops += int(n[~agg_violated & present].sum())
+            violations[agg] = np.where(agg_violated, n, 0)
+
+        # every vote goes to the state of the step they agree on, so that splitting them over several states
+        # never lets nop outvote them: the weighted median step for add, the least step for rmv, scaling out
+        # promptly and in only as far as every violated threshold allows; never past the first or last state
+        vote_steps, vote_weights = np.concatenate(vote_steps), np.concatenate(vote_weights)
+        votes = vote_weights.sum()
+        if votes:
+            if action == 'add':
+                order = np.argsort(vote_steps, kind='stable')
+                cum = np.cumsum(vote_weights[order])
+                k = int(vote_steps[order][np.searchsorted(cum, votes / 2)])
+            else:
+                k = int(vote_steps.min())
+            k = min(k, index if sign < 0 else len(self.states)-1 - index)
+            self.reward[self.states[index + sign * k]] += delta * weight * float(votes)
+        if nop:
+            self.reward[self.states[index]] += delta * int(nops)
+
+        if self.logger.isEnabledFor(DEBUG):
+            for t, n in zip(compiled['names'], violations):
+                if n:
+                    self.logger.debug('{} shard(s) violated {}, voted for {}'.format(n, t, action))
 
     def normalize_reward(self, delta=0.02):
         l = [self.reward[k] for k in self.reward]
@@ -164,17 +524,20 @@ class ClusterMDP(MDP):
         index = self.states.index(self.curr_state)
 
         self.reward[self.states[index]] = 0
-        if index-1 > -1:
-            self.reward[self.states[index-1]] = 0
+        for k in range(1, self.max_step+1):
+            if index-k > -1:
+                self.reward[self.states[index-k]] = 0
 
-        if index+2 < len(self.states):
-            self.reward[self.states[index+1]] = 0
+            if index+k < len(self.states):
+                self.reward[self.states[index+k]] = 0
 
-    def calc_reward(self, metrics, thresholds_add, thresholds_rmv):
+    def calc_reward(self, metrics, thresholds_add, thresholds_rmv, aggregation=None):
         # self.normalize_reward()
         self.reset_reward()
-        self.calc_reward_aux(metrics, thresholds_add, action='add')
-        self.calc_reward_aux(metrics, thresholds_rmv, action='rmv')
+        compiled = self.compile_thresholds(thresholds_add, thresholds_rmv, aggregation)
+        _, weights, values = self.metric_matrix(metrics, compiled['metrics'])
+        self.calc_reward_aux(values, weights, compiled['add'], action='add')
+        self.calc_reward_aux(values, weights, compiled['rmv'], action='rmv')
 
         reward_dict = dumps({int(x):self.reward[x] for x in self.reward.keys()}, sort_keys=True)
         self.logger.debug('state {}, rewards {}'.format(self.curr_state, reward_dict))
@@ -186,35 +549,129 @@ class ClusterMDP(MDP):
         for i in range(len(self.states)):
             self.transitions[self.states[i]]['nop'] = [(1.0, self.states[i])]
 
-            if i+1 < len(self.states):
-                if i-1 > -1:
-                    self.transitions[self.states[i]]['add'] = [(1.0-add_p, self.states[i]), (add_p, self.states[i+1])]
-                    self.transitions[self.states[i]]['rmv'] = [(rmv_p, self.states[i-1]), (1.0-rmv_p, self.states[i])]
-                else:
-                    self.transitions[self.states[i]]['add'] = [(1.0-add_p, self.states[i]), (add_p, self.states[i+1])]
-            else:
-                self.transitions[self.states[i]]['rmv'] = [(rmv_p, self.states[i-1]), (1.0-rmv_p, self.states[i])]
-
+            # each of the k replica sets of add_k/rmv_k succeeds independently,
+            # so the number of them actually added/removed is binomial
+            for k in range(1, self.max_step+1):
+                if i-k > -1:
+                    d = self.duration_discount(action_name('rmv', k))
+                    self.transitions[self.states[i]][action_name('rmv', k)] = [
+                        (d * binomial_pmf(k, j, rmv_p), self.states[i-j]) for j in range(k, -1, -1)]
+                if i+k < len(self.states):
+                    d = self.duration_discount(action_name('add', k))
+                    self.transitions[self.states[i]][action_name('add', k)] = [
+                        (d * binomial_pmf(k, j, add_p), self.states[i+j]) for j in range(k+1)]
+
+        self._arrays = None
         self.logger.debug('calculated new transitions')
 
-    def commit_action_result(self, ok, action):
-        index = self.states.index(self.curr_state)
+    def duration_discount(self, action):
+        """Discount of action beyond that of a single decision period,
+        gamma ** (periods it takes - 1), 1 if its duration is not known."""
 
-        if action == 'add':
-            next_index = index + 1
-        elif action == 'rmv':
-            next_index = index - 1
+        d = self.durations.get(action)
+        if not self.period or d is None or d <= self.period:
+            return 1.0
+        return self.gamma ** (d / self.period - 1)
+
+    def set_durations(self, durations, period):
+        """Turn the model into a semi-MDP, discounting the outcome of every
+        action by the decision periods it takes: durations are the expected
+        seconds of the actions (None if not known), period the seconds
+        between decisions. Probabilities are scaled by duration_discount, so
+        the solvers stay unchanged."""
+
+        durations = {a: d for a, d in durations.items() if d is not None}
+        if durations == self.durations and period == self.period:
+            return
+
+        self.durations, self.period = durations, period
+        self.calc_transitions(self.action_stats['ok_add'] / self.action_stats['#add'],
+                              self.action_stats['ok_rmv'] / self.action_stats['#rmv'])
+
+    def commit_action_result(self, ok, action, steps=None):
+        """Record the outcome of action, where steps is the number of replica
+        sets actually added/removed (all of them if ok, none otherwise, when
+        not given)."""
+
+        index = self.states.index(self.curr_state)
+        kind, k = split_action(action)
+        if steps is None:
+            steps = k if ok else 0
+
+        if kind == 'add':
+            next_index = index + steps
+        elif kind == 'rmv':
+            next_index = index - steps
         else:
             next_index = index
 
         if next_index < 0 or next_index > len(self.states)-1:
             raise Exception('transition to invalid state')
 
-        if action != 'nop':
-            self.action_stats['#'+action] += 1
-            if ok:
+        if kind != 'nop':
+            self.action_stats['#'+kind] += k
+            if steps:
                 self.curr_state = self.states[next_index]
                 self.logger.info('Transition to new state of {} shards'.format(self.curr_state))
-                self.action_stats['ok_'+action] += 1
+                self.action_stats['ok_'+kind] += steps
             self.calc_transitions(self.action_stats['ok_add'] / self.action_stats['#add'],
                                   self.action_stats['ok_rmv'] / self.action_stats['#rmv'])
+
+
+def action_name(kind, steps):
+    """Name of the action adding/removing steps replica sets: add, add_2, ..."""
+    return kind if steps == 1 else '{}_{}'.format(kind, steps)
+
+
+def split_action(action):
+    """Inverse of action_name, e.g. 'add_3' -> ('add', 3), 'nop' -> ('nop', 0)."""
+    kind, _, steps = action.partition('_')
+    return kind, int(steps) if steps else int(kind != 'nop')
+
+
+def parse_aggregation(spec):
+    """
+    Aggregation of a threshold from its monitor.conf spec: shard (vote per shard), mean, max, pNN (weighted
+    percentile) or quorum[:F] (violated when a weighted share F of the shards violates it, 0.5 by default).
+    :return: (kind, parameter) where kind is one of shard, mean, percentile, quorum
+    """
+    spec = spec.strip().lower()
+    if spec in ('shard', 'mean'):
+        return spec, None
+    if spec == 'max':
+        return 'percentile', 1.0
+    if spec[:1] == 'p' and spec[1:].isdigit() and 0 < int(spec[1:]) <= 100:
+        return 'percentile', int(spec[1:]) / 100
+    if spec.split(':')[0] == 'quorum':
+        share = float(spec.split(':')[1]) if ':' in spec else 0.5
+        if 0 < share <= 1:
+            return 'quorum', share
+
+    raise ValueError("aggregation '{}' not one of: shard, mean, max, pNN, quorum[:F]".format(spec))
+
+
+def binomial_pmf(n, k, p):
+    return comb(n, k) * p**k * (1.0-p)**(n-k)
+
+
+def _ranges(ptr, idx):
+    """Concatenated entry positions ptr[i]:ptr[i+1] for every i in idx."""
+
+    starts = ptr[idx]
+    lens = ptr[idx + 1] - starts
+    offsets = np.cumsum(lens) - lens
+    return np.repeat(starts - offsets, lens) + np.arange(lens.sum())
+
+
+def _solve_banded(band, rhs):
+    """Solution of the banded system where band[i, b + k] is the coefficient
+    of x[i+k] in row i, by LAPACK through scipy."""
+
+    n, b = band.shape[0], band.shape[1] // 2
+    ab = np.zeros((2 * b + 1, n))
+    for k in range(-b, b + 1):
+        if k >= 0:
+            ab[b - k, k:] = band[:n - k, b + k]
+        else:
+            ab[b - k, :n + k] = band[-k:, b + k]
+    return scipy_solve_banded((b, b), ab, rhs)
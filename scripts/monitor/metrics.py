@@ -0,0 +1,215 @@
+import numpy as np
+
+
+class CounterRates:
+    """Per second rates of cumulative counters, keyed by (host, shard, metric)."""
+
+    def __init__(self):
+        self.counters = {}  # key: (value, sample time, rate, whether a drop to 0 is held back)
+
+    def rate(self, key, value, sample_time):
+        """
+        Per second rate of the counter key since its previous sample, None until it has two samples.
+        The previous rate is kept while the counter is not sampled again, and a counter lower than
+        before is taken as reset to 0 (e.g. a restarted mongod). A single drop to 0 is ignored, as
+        gmond serves 0 for a stale snapshot, and only taken as a reset if the next sample is lower too.
+        """
+        prev = self.counters.get(key)
+        if prev is None:
+            self.counters[key] = (value, sample_time, None, False)
+            return None
+
+        prev_value, prev_time, prev_rate, held = prev
+        if sample_time <= prev_time:
+            return prev_rate
+
+        if value == 0 < prev_value and not held:
+            self.counters[key] = (prev_value, prev_time, prev_rate, True)
+            return prev_rate
+
+        increase = value - prev_value if value >= prev_value else value
+        rate = increase / (sample_time - prev_time)
+        self.counters[key] = (value, sample_time, rate, False)
+        return rate
+
+    def retain(self, keys):
+        """Forget the counters not in keys, e.g. of departed hosts and shards."""
+        self.counters = {k: v for k, v in self.counters.items() if k in keys}
+
+
+def split_metric_name(name):
+    """Shard and metric of a gmond metric name, e.g. shardr1s1_mongodb_conn_current, shard None for host metrics."""
+    if name[0:5] == 'shard':
+        shard, name = name.split('_', 1)
+        return shard, name
+    return None, name
+
+
+def ready_metrics(metrics, warming):
+    """Copy of metrics without the hosts (host, None) and shards (host, shard) in warming."""
+    res = {}
+    for host, dct in metrics.items():
+        if (host, None) in warming:
+            continue
+        res[host] = dict(dct)
+        res[host]['shards'] = {s: dict(d) for s, d in dct['shards'].items() if (host, s) not in warming}
+    return res
+
+
+class MetricStore:
+    """
+    Last depth samples of every (host, shard, metric) series, in a preallocated ring buffer of shape
+    (depth, capacity) with one row per sample time and one column per series. Host, shard and metric names
+    are interned to ids, series absent from evict_after consecutive samples are evicted and their columns reused,
+    as are the ids of names no series uses any more.
+    """
+
+    def __init__(self, depth=60, capacity=256, evict_after=None):
+        self.depth = depth
+        self.evict_after = evict_after or depth
+        self.values = np.full((depth, capacity), np.nan)
+        self.times = np.full(depth, np.nan)
+        self.pos = -1           # row of the latest sample
+        self.count = 0          # samples appended so far
+
+        self.ids = {}           # name: id, of hosts, shards and metrics alike
+        self.names = []         # id: name, None for a released id
+        self.free_ids = []
+        self.columns = {}       # (host id, shard id, metric id): column
+        self.last_seen = np.zeros(capacity, dtype=np.int64)    # sample count of the last value per column
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def _intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            if self.free_ids:
+                i = self.free_ids.pop()
+                self.names[i] = name
+            else:
+                i = len(self.names)
+                self.names.append(name)
+            self.ids[name] = i
+        return i
+
+    def _column(self, key):
+        col = self.columns.get(key)
+        if col is None:
+            if not self.free:
+                self._grow()
+            col = self.columns[key] = self.free.pop()
+            self.values[:, col] = np.nan
+        return col
+
+    def _grow(self):
+        capacity = self.values.shape[1]
+        self.values = np.hstack([self.values, np.full((self.depth, capacity), np.nan)])
+        self.last_seen = np.concatenate([self.last_seen, np.zeros(capacity, dtype=np.int64)])
+        self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+
+    def key(self, host, shard, metric):
+        """Interned key of a series, shard None for host metrics."""
+        return self._intern(host), -1 if shard is None else self._intern(shard), self._intern(metric)
+
+    def lookup(self, host, shard, metric):
+        """Key of a series without interning its names, None if a name is unknown."""
+        h, m = self.ids.get(host), self.ids.get(metric)
+        s = -1 if shard is None else self.ids.get(shard)
+        if h is None or s is None or m is None:
+            return None
+        return h, s, m
+
+    def append(self, metrics, sample_time):
+        """Append a snapshot in the layout of XMLHandler.metrics as the sample of sample_time."""
+        self.pos = (self.pos + 1) % self.depth
+        self.count += 1
+        self.values[self.pos] = np.nan
+        self.times[self.pos] = sample_time
+
+        for host, dct in metrics.items():
+            for shard, d in [(None, dct)] + list(dct['shards'].items()):
+                for metric, val in d.items():
+                    if metric == 'shards' or not isinstance(val, (int, float)):
+                        continue
+                    col = self._column(self.key(host, shard, metric))
+                    self.values[self.pos, col] = val
+                    self.last_seen[col] = self.count
+
+        self.evict()
+
+    def evict(self, host=None):
+        """
+        Release the columns of host, e.g. departed from the gmetad document, or of the series absent from the last
+        evict_after samples, and the ids of the names no series uses any more.
+        """
+        if host is not None:
+            h = self.ids.get(host)
+            gone = [k for k in self.columns if k[0] == h] if h is not None else []
+        else:
+            stale = self.last_seen < self.count - self.evict_after + 1
+            gone = [k for k, col in self.columns.items() if stale[col]]
+        if not gone:
+            return
+
+        for k in gone:
+            self.free.append(self.columns.pop(k))
+        used = {i for k in self.columns for i in k}
+        for name, i in [(name, i) for name, i in self.ids.items() if i not in used]:
+            del self.ids[name]
+            self.names[i] = None
+            self.free_ids.append(i)
+
+    def window(self, host, shard, metric, n=None):
+        """Times and values of the last n samples of a series, oldest first, NaN where the series was missing."""
+        n = min(n or self.depth, self.depth, self.count)
+        rows = (np.arange(self.pos - n + 1, self.pos + 1)) % self.depth
+        col = self.columns.get(self.lookup(host, shard, metric))
+        if col is None:
+            return self.times[rows], np.full(n, np.nan)
+        return self.times[rows], self.values[rows, col]
+
+    def means(self, n):
+        """
+        Snapshot in the layout of XMLHandler.metrics of the mean over the last n samples of every series of the
+        latest sample, so departed hosts and shards drop out at once.
+        """
+        n = min(n, self.depth, self.count)
+        rows = (np.arange(self.pos - n + 1, self.pos + 1)) % self.depth
+        keys = [k for k, col in self.columns.items() if self.last_seen[col] == self.count]
+        cols = np.fromiter((self.columns[k] for k in keys), dtype=np.int64, count=len(keys))
+        block = self.values[np.ix_(rows, cols)]
+        valid = ~np.isnan(block)
+        sums = np.where(valid, block, 0.0).sum(axis=0)
+        counts = valid.sum(axis=0)
+
+        res = {}
+        for (h, s, m), total, cnt in zip(keys, sums, counts):
+            if not cnt:
+                continue
+            dct = res.setdefault(self.names[h], {'shards': {}})
+            if s >= 0:
+                dct = dct['shards'].setdefault(self.names[s], {})
+            dct[self.names[m]] = float(total / cnt)
+        return res
+
+    def recent(self, n, metric_names=None):
+        """
+        Times (n,) and values (n x series) of the last n samples, oldest first, of the series of the latest sample
+        whose metric is in metric_names (all if None), with their (host, shard, metric) names.
+        """
+        n = min(n, self.depth, self.count)
+        rows = (np.arange(self.pos - n + 1, self.pos + 1)) % self.depth
+        keys = [k for k, col in self.columns.items() if self.last_seen[col] == self.count and
+                (metric_names is None or self.names[k[2]] in metric_names)]
+        cols = np.fromiter((self.columns[k] for k in keys), dtype=np.int64, count=len(keys))
+        names = [(self.names[h], self.names[s] if s >= 0 else None, self.names[m]) for h, s, m in keys]
+        return self.times[rows], self.values[np.ix_(rows, cols)], names
+
+    def slope(self, host, shard, metric, n=None):
+        """Least squares trend of a series over its last n samples in units per second, None below two samples."""
+        t, v = self.window(host, shard, metric, n)
+        ok = ~np.isnan(v)
+        if ok.sum() < 2:
+            return None
+        t, v = t[ok] - t[ok].mean(), v[ok]
+        denom = (t * t).sum()
+        return float((t * (v - v.mean())).sum() / denom) if denom else None
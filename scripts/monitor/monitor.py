@@ -1,34 +1,73 @@
+from asyncio import run as asyncio_run, sleep as asyncio_sleep, TimeoutError as asyncio_TimeoutError
+from metrics import CounterRates, MetricStore, split_metric_name, ready_metrics
+from asyncio import get_running_loop, open_connection, wait_for, create_task
 from logging.config import fileConfig as logging_fileConfig
 from traceback import print_exc as traceback_print_exc
 from xml.sax import make_parser as xml_sax_make_parser
 from logging import getLogger as logging_getLogger
-from socket import socket, AF_INET, SOCK_STREAM
 from xml.sax import handler as xml_sax_handler
-from socket import error as socket_error
+from mdp import ClusterMDP, split_action, parse_aggregation
+from exporter import MetricsExporter, histogram_samples
 from configparser import ConfigParser
+from xml.sax import SAXException
+from ingest import GmondListener
+from forecast import Forecaster
+from tracefile import TraceWriter
 from actuator import Actuator
-from threading import Thread
-from mdp import ClusterMDP
-from time import sleep
+from time import perf_counter, time
 from sys import stdout
 from uuid import uuid4
 
 
 class XMLHandler(xml_sax_handler.ContentHandler):
-    def __init__(self):
+    def __init__(self, delta_metrics=(), wanted=None, ignore_hosts=()):
         super().__init__()
         self.metrics = {}
         self.host = ''
+        self.localtime = 0
+
+        # metric names (without shard prefix) to keep, all if None
+        self.wanted = wanted
+        self.ignore_hosts = set(ignore_hosts)
+
+        # cumulative counters delivered as per second rates
+        self.delta_metrics = set(delta_metrics)
+        self.rates = CounterRates()
+        self.seen = set()       # counters of the current parse
+        self.warming = set()    # (host, shard) without a rate yet
+        self.departed = set()   # hosts of the previous parse missing from the current one
+
+    def startDocument(self):
+        # rebuilt on every parse, so departed hosts and shards drop out
+        self.departed = set(self.metrics)
+        self.metrics = {}
+        self.seen = set()
+        self.warming = set()
+
+    def endDocument(self):
+        # forget counters of departed hosts and shards
+        self.rates.retain(self.seen)
+        self.departed -= set(self.metrics)
 
     def startElement(self, tag, attr):
-        if tag == 'HOST':
+        if tag == 'GRID' or tag == 'CLUSTER':
+            self.localtime = int(attr.get('LOCALTIME'))
+
+        elif tag == 'HOST':
             self.host = attr.get('NAME')
-            if self.host not in self.metrics:
+            if self.host in self.ignore_hosts:
+                self.host = None
+            elif self.host not in self.metrics:
                 self.metrics[self.host] = {}
                 self.metrics[self.host]['shards'] = {}
 
-        elif tag == 'METRIC':
-            name = attr.get('NAME')
+        elif tag == 'METRIC' and self.host is not None:
+            shard, name = split_metric_name(attr.get('NAME'))
+
+            # drop unused metrics before any conversion
+            if self.wanted is not None and name not in self.wanted:
+                return
+
             val = attr.get('VAL')
             ty = attr.get('TYPE')
             if ty == 'double' or ty == 'float':
@@ -36,118 +75,445 @@ class XMLHandler(xml_sax_handler.ContentHandler):
             elif ty == 'uint32' or ty == 'int32':
                 val = int(val)
 
-            if name[0:5] == 'shard':
-                split = name.split('_', 1)
-                if split[0] not in self.metrics[self.host]['shards']:
-                    self.metrics[self.host]['shards'][split[0]] = {}
-                self.metrics[self.host]['shards'][split[0]][split[1]] = val
-            else:
-                self.metrics[self.host][name] = val
+            dct = self.metrics[self.host]
+            if shard is not None:
+                if shard not in dct['shards']:
+                    dct['shards'][shard] = {}
+                dct = dct['shards'][shard]
+
+            if name in self.delta_metrics:
+                # sampled TN seconds before the time of the report
+                key = (self.host, shard, name)
+                self.seen.add(key)
+                val = self.rates.rate(key, val, self.localtime - int(attr.get('TN', 0)))
+                if val is None:
+                    self.warming.add((self.host, shard))
+                    return
+
+            dct[name] = val
 
 
 class Monitor:
-    def __init__(self, ganglia_host='127.0.0.1', conf_file='monitor.conf'):
-        logging_fileConfig('logging.conf')
+    def __init__(self, ganglia_host='127.0.0.1', conf_file='monitor.conf', conf=None, actuator=None, live=True):
+        """
+        :param: conf: configuration as read by _read_conf_file, read from conf_file if None
+        :param: actuator: Actuator or a stand-in with its interface
+        :param: live: False to decide on given metrics only (e.g. replays): no logging.conf, metric listener,
+                      metrics endpoint or trace
+        """
+        if live:
+            logging_fileConfig('logging.conf')
         self.logger = logging_getLogger('monitor')
-        self.conf = self._read_conf_file(conf_file)
+        self.conf = conf or self._read_conf_file(conf_file)
 
-        self.actuator = Actuator()
+        self.actuator = actuator or Actuator()
 
         states = [str(x) for x in range(1, 11)]
-        start_state = str(self.actuator.current_shard_number())
+        try:
+            start_state = str(self.actuator.current_shard_number())
+        except Exception as e:
+            self.logger.critical('Shards of the cluster unknown -- {}, terminating'.format(e))
+            exit(1)
 
         if start_state not in set(states):
             self.logger.critical("Start state '{}' not in {}, terminating".format(start_state, states))
             exit(1)
 
-        self.mdp = ClusterMDP(start_state, states)
+        self.mdp = ClusterMDP(start_state, states, gamma=self.conf['gamma'], max_step=self.conf['max_step'])
 
         self.ganglia_host = ganglia_host
-        self.ganglia_port = 8651
-        
-        self.handler = XMLHandler()
-        self.parser = xml_sax_make_parser()
-        self.parser.setContentHandler(self.handler)
+        self.ganglia_port = self.conf['ganglia']['xml_port']
+        self.fetch_stats = {'bytes': 0, 'time': 0.0}
+        self.stage_times = {'fetch': 0.0, 'parse': 0.0, 'reward': 0.0, 'solve': 0.0, 'dispatch': 0.0}
+        self.actuator_tasks = set()
 
-    def get_metrics(self):
+        # counters of the control loop, exported with its other stats on the metrics endpoint
+        self.cycles = 0
+        self.decisions = {}         # action: times decided
+        self.outcomes = {}          # (action kind, succeeded/partial/failed/aborted/busy): count
+        self.actuator_busy_time = 0.0
+        self.exporter = None
+        if live and self.conf['exporter']['port']:
+            self.exporter = MetricsExporter(self.collect_metrics, self.conf['exporter']['port'],
+                                            self.conf['exporter']['bind'])
+
+        # recent samples of every series, for smoothing over the last window cycles
+        self.store = MetricStore(self.conf['store']['depth'])
+
+        # rates forecast at the time it takes to bring a replica set online, measured on every successful add
+        forecast = self.conf['forecast']
+        self.forecaster = None
+        if forecast['method'] != 'none':
+            self.forecaster = Forecaster(forecast['metrics'], forecast['method'], forecast['window'],
+                                         forecast['alpha'], forecast['beta'])
+        self.provision_time = forecast['horizon']
+
+        # only the metrics thresholds and rates are computed on
+        wanted = {t[:-3] for s in ['thresholds_add', 'thresholds_remove'] for t in self.conf[s]}
+        wanted |= self.conf['delta_metrics']
+        self.handler = XMLHandler(self.conf['delta_metrics'], wanted, self.conf['ignore_hosts'])
+
+        # metrics pushed by gmond instead of polled from gmetad
+        self.listener = None
+        ingest = self.conf['ingest']
+        if live and ingest['mode'] == 'push':
+            self.listener = GmondListener(ingest['port'], ingest['bind'], ingest['mcast_join'],
+                                          self.conf['delta_metrics'], wanted, self.conf['ignore_hosts'],
+                                          ingest['expire'])
+
+        # every cycle's metrics and decision, for offline replays
+        self.trace = None
+        if live and self.conf['trace']:
+            self.trace = TraceWriter(self.conf['trace'])
+
+    async def get_metrics(self):
+        """
+        Parse the metrics of gmetad, only of the configured cluster when the interactive query port is configured
+        or of the whole grid from the xml port otherwise. The xml is parsed while it streams in, the time spent in
+        the parser is the parse stage and the rest the fetch stage.
+        """
+        ganglia = self.conf['ganglia']
+        start = perf_counter()
+        parser = xml_sax_make_parser()
+        parser.setContentHandler(self.handler)
+        parse_time = 0.0
+        nbytes = 0
+
+        writer = None
         try:
-            s = socket(AF_INET, SOCK_STREAM)
-            s.connect((self.ganglia_host, self.ganglia_port))
-            self.parser.parse(s.makefile('r'))
-            s.close()
-            self.logger.info('Fresh metrics acquired')
+            if ganglia['query_port']:
+                reader, writer = await open_connection(self.ganglia_host, ganglia['query_port'])
+                writer.write('/{}\n'.format(ganglia['cluster']).encode())
+            else:
+                reader, writer = await open_connection(self.ganglia_host, self.ganglia_port)
+
+            while True:
+                data = await reader.read(65536)
+                parse_start = perf_counter()
+                if data:
+                    parser.feed(data)
+                else:
+                    parser.close()
+                parse_time += perf_counter() - parse_start
+                if not data:
+                    break
+                nbytes += len(data)
 
-        except socket_error as e:
+        except (OSError, SAXException) as e:
             self.logger.error(e)
             return None
+        finally:
+            if writer is not None:
+                writer.close()
+
+        total = perf_counter() - start
+        self.fetch_stats = {'bytes': nbytes, 'time': total}
+        self.stage_times['fetch'] = total - parse_time
+        self.stage_times['parse'] = parse_time
+        self.logger.info('Fresh metrics acquired, {} bytes in {:.1f} ms'.format(nbytes, total * 1000))
+        for host in self.handler.departed:
+            self.store.evict(host)
 
-        metrics = self.handler.metrics
-        for host in self.conf['ignore_hosts']:
-            if host in metrics:
-                del metrics[host]
+        # leave out hosts/shards whose rates are not ready yet
+        return ready_metrics(self.handler.metrics, self.handler.warming)
 
+    def wait_metrics(self):
+        """Metrics on the next change pushed by gmond, or at the latest after the polling interval."""
+        ingest = self.conf['ingest']
+        start = perf_counter()
+        self.listener.wait_change(self.conf['schedule']['interval'], ingest['settle'])
+        metrics = self.listener.snapshot()
+        for host in self.listener.departed:
+            self.store.evict(host)
+        self.fetch_stats = {'bytes': 0, 'time': perf_counter() - start}
+        self.stage_times['fetch'] = self.fetch_stats['time']
+        self.stage_times['parse'] = 0.0
+        self.logger.info('Pushed metrics acquired, {} packets so far'.format(self.listener.packets))
         return metrics
 
+    def update_durations(self):
+        """Discount the actions of the MDP by their expected durations over the monitoring interval."""
+        actions = {a for acts in self.mdp.actlist.values() for a in acts}
+        self.mdp.set_durations({a: self.actuator.expected_duration(a) for a in actions},
+                               self.conf['schedule']['interval'])
+
     def decide_action(self, metrics):
-        self.mdp.calc_reward(metrics, self.conf['thresholds_add'], self.conf['thresholds_remove'])
-        return self.mdp.solve()
+        start = perf_counter()
+        self.mdp.calc_reward(metrics, self.conf['thresholds_add'], self.conf['thresholds_remove'],
+                             self.conf['aggregation'])
+        self.stage_times['reward'] = perf_counter() - start
+        action = self.mdp.solve()
+        self.stage_times['solve'] = perf_counter() - start - self.stage_times['reward']
+
+        stats = self.mdp.solve_stats
+        self.logger.debug('Solve {} in {} iteration(s), {:.3f} ms'.format(stats['mode'], stats['iterations'],
+                                                                         stats['time'] * 1000))
+        return action
 
     def monitor(self):
         while True:
             try:
-                self._monitor()
+                asyncio_run(self._monitor())
             except Exception as e:
                 self.logger.critical(e)
                 traceback_print_exc(file=stdout)
 
-    def _monitor(self):
+    async def _monitor(self):
         self.logger.info('Monitoring started')
-        cached_metrics = self.get_metrics()
-        # self.logger.debug('Initial Metrics:\n' + self._human_readable_metrics(cached_metrics))
+        loop = get_running_loop()
+        if self.exporter is not None and not self.exporter.thread.is_alive():
+            self.exporter.start()
+        schedule = self.conf['schedule']
+        interval = schedule['interval']
+
+        if self.listener is not None:
+            if not self.listener.is_alive():
+                self.listener.start()
+        else:
+            # first samples of the delta metrics, rates are available from the next fetch
+            await self._fetch_with_timeout()
 
+        # fixed rate cadence, cycles are started every interval seconds regardless of their own duration
+        next_cycle = loop.time() + interval
         while True:
-            sleep(10)
-            current_metrics = self.get_metrics()
+            if self.listener is not None:
+                current_metrics = await loop.run_in_executor(None, self.wait_metrics)
+            else:
+                await asyncio_sleep(max(0.0, next_cycle - loop.time()))
+                lag = loop.time() - next_cycle
+                next_cycle += interval
+                if lag > interval:
+                    # skip the cycles missed, e.g. after a suspend, instead of running them back to back
+                    skipped = int(lag // interval)
+                    next_cycle += skipped * interval
+                    self.logger.warning('Monitoring cycle {:.1f} s late, {} cycle(s) skipped'.format(lag, skipped))
+                current_metrics = await self._fetch_with_timeout()
 
-            for host, dct in current_metrics.items():
-                for shard, shard_dct in dct['shards'].items():
-                    for m in self.conf['delta_metrics']:
-                        shard_dct[m] -= cached_metrics[host]['shards'][shard][m]
+            if current_metrics is None:
+                continue
             # self.logger.debug('Metrics:\n' + self._human_readable_metrics(current_metrics))
 
-            action = self.decide_action(current_metrics)
-            action_uuid = uuid4().hex[:5]
-            self.logger.info("Action '{}' [{}] decided".format(action, action_uuid))
-
-            # run actuator in parallel threads, so as not to block monitoring
-            def thread_actuator_func():
-                local_action = action
-                local_action_uuid = action_uuid
-                try:
-                    ok = self.actuator.exec_cmds_of_type(local_action, local_action_uuid, dry_run=False)
-                    status_msg = 'succeeded' if ok else 'failed'
-                    self.logger.info("Action '{}' [{}] {}".format(local_action, local_action_uuid, status_msg))
-                    self.mdp.commit_action_result(ok, local_action)
-                except Exception as e:
-                    self.logger.warning("Action '{}' [{}] aborted -- {}".format(local_action, local_action_uuid, e))
-
-            # avoid thread creation cost in case of 'nop' action or busy actuator
-            if action != 'nop' and self.actuator.is_available:
-                Thread(target=thread_actuator_func).start()
+            try:
+                self._cycle(current_metrics)
+            except Exception as e:
+                self.logger.critical(e)
+                traceback_print_exc(file=stdout)
+
+    async def _fetch_with_timeout(self):
+        try:
+            return await wait_for(self.get_metrics(), self.conf['schedule']['fetch_timeout'])
+        except asyncio_TimeoutError:
+            self.logger.error('Metrics fetch timed out after {} s'.format(self.conf['schedule']['fetch_timeout']))
+            return None
+
+    def evaluate(self, metrics, now):
+        """Action on the metrics sampled at time now, smoothed and forecast as configured."""
+        self.store.append(metrics, now)
+        window = self.conf['store']['window']
+        if window > 1:
+            metrics = self.store.means(window)
+        if self.forecaster is not None:
+            metrics = self.forecaster.apply(self.store, metrics, self.provision_time)
+
+        return self.decide_action(metrics)
+
+    def _cycle(self, metrics):
+        now = time()
+        state = self.mdp.curr_state
+        action = self.evaluate(metrics, now)
+        if self.trace is not None:
+            self.trace.write({'time': now, 'state': state, 'action': action, 'metrics': metrics})
+
+        self.cycles += 1
+        self.decisions[action] = self.decisions.get(action, 0) + 1
+        action_uuid = uuid4().hex[:5]
+        self.logger.info("Action '{}' [{}] decided".format(action, action_uuid))
+        duration = self.actuator.expected_duration(action)
+        if action != 'nop' and duration is not None:
+            self.logger.debug("Action '{}' [{}] expected to take {:.1f} s".format(action, action_uuid, duration))
+
+        # run actuator as a task, so as not to block monitoring
+        start = perf_counter()
+        if action != 'nop' and self.actuator.is_available and not self.actuator.rebalancing():
+            self.actuator.observe(metrics)
+            task = create_task(self._actuate(action, action_uuid))
+            self.actuator_tasks.add(task)
+            task.add_done_callback(self.actuator_tasks.discard)
+        else:
+            if split_action(action)[0] == 'add' and self.actuator.draining():
+                # load is climbing again, so the replica sets being drained are needed after all
+                self.logger.info("Action '{}' [{}] cancelling the drain in progress".format(action, action_uuid))
+                self.actuator.cancel_drain()
+            if action == 'nop':
+                status = 'succeeded'
+            elif self.actuator.rebalancing():
+                status = 'aborted -- capacity added but not yet effective'
+            else:
+                status = 'aborted -- busy actuator'
+            self.logger.info("Action '{}' [{}] {}".format(action, action_uuid, status))
+            if action != 'nop':
+                self._count_outcome(action, 'rebalancing' if self.actuator.rebalancing() else 'busy')
+        self.stage_times['dispatch'] = perf_counter() - start
+
+        self.logger.debug('Cycle stages: ' + ', '.join('{} {:.3f} ms'.format(k, v * 1000)
+                                                       for k, v in self.stage_times.items()))
+
+    async def _actuate(self, action, action_uuid):
+        loop = get_running_loop()
+        start = perf_counter()
+        try:
+            try:
+                done = await loop.run_in_executor(None, self.actuator.exec_cmds_of_type, action, action_uuid, False)
+            finally:
+                self.actuator_busy_time += perf_counter() - start
+            steps = split_action(action)[1]
+            if done and split_action(action)[0] == 'add':
+                # replica sets of an action are added concurrently, so the action takes as long as one
+                self.provision_time += 0.3 * (perf_counter() - start - self.provision_time)
+                self.logger.debug('Provisioning time {:.1f} s'.format(self.provision_time))
+            if done == steps:
+                status_msg = 'succeeded'
+            elif done:
+                status_msg = 'partially succeeded ({}/{})'.format(done, steps)
             else:
-                status = 'succeeded' if action == 'nop' else 'aborted -- busy actuator'
-                self.logger.info("Action '{}' [{}] {}".format(action, action_uuid, status))
+                status_msg = 'failed'
+            self.logger.info("Action '{}' [{}] {}".format(action, action_uuid, status_msg))
+            self._count_outcome(action, status_msg.split(' ')[0].replace('partially', 'partial'))
+            self.mdp.commit_action_result(done == steps, action, done)
+
+            timings = self.actuator.timings.summary()
+            if timings:
+                self.logger.debug('Step timings: ' + ', '.join('{} mean {:.1f} s p90 {:.1f} s ({} runs)'.format(
+                    step, t['mean'], t['p90'], t['count']) for step, t in timings.items()))
+            if self.conf['semi_mdp']:
+                self.update_durations()
+        except Exception as e:
+            self.logger.warning("Action '{}' [{}] aborted -- {}".format(action, action_uuid, e))
+            self._count_outcome(action, 'aborted')
+
+        # the add left the rebalance pending, so no action is dispatched before it has run
+        if self.actuator.rebalancing():
+            await self._rebalance(action, action_uuid)
+
+    async def _rebalance(self, action, action_uuid):
+        """Chunk migrations to the replica sets added by action, after it is committed and off the busy time."""
+        try:
+            err = await get_running_loop().run_in_executor(None, self.actuator.rebalance, action, action_uuid)
+        except Exception as e:
+            self.logger.warning("Action '{}' [{}] rebalance aborted -- {}".format(action, action_uuid, e))
+            return
+        rebalance = self.actuator.rebalance_progress()
+        if err:
+            self.logger.info("Action '{}' [{}] {}, the rest left to the balancer".format(action, action_uuid, err))
+        elif rebalance is not None and rebalance['time_to_balance'] is not None:
+            self.logger.info("Action '{}' [{}] effective after {:.1f} s of rebalancing".format(
+                action, action_uuid, rebalance['time_to_balance']))
+
+    def _count_outcome(self, action, outcome):
+        key = (split_action(action)[0], outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
 
-            cached_metrics = current_metrics
+    def collect_metrics(self):
+        """Metric families of the control loop itself, see exporter.render."""
+        solve = self.mdp.solve_stats
+        rebalance = self.actuator.rebalance_progress()
+        timings = self.actuator.timings
+        families = [
+            ('monitor_cycles_total', 'counter', 'Monitoring cycles that reached a decision.',
+             [({}, self.cycles)]),
+            ('monitor_stage_seconds', 'gauge', 'Duration of every stage of the last monitoring cycle.',
+             [({'stage': k}, v) for k, v in list(self.stage_times.items())]),
+            ('monitor_fetch_bytes', 'gauge', 'Bytes of the last gmetad fetch.',
+             [({}, self.fetch_stats.get('bytes', 0))]),
+            ('monitor_fetch_seconds', 'gauge', 'Duration of the last gmetad fetch, parsing included.',
+             [({}, self.fetch_stats.get('time', 0.0))]),
+            ('monitor_solve_iterations', 'gauge', 'Sweeps or policy evaluations of the last MDP solve.',
+             [({'mode': solve['mode'] or 'none'}, solve['iterations'])]),
+            ('monitor_solve_seconds', 'gauge', 'Duration of the last MDP solve.',
+             [({}, solve['time'])]),
+            ('monitor_state_shards', 'gauge', 'Current state of the MDP, in shards.',
+             [({}, int(self.mdp.curr_state))]),
+            ('monitor_reward', 'gauge', 'Reward of every state of the MDP, by its shard count.',
+             [({'state': s}, r) for s, r in list(self.mdp.reward.items())]),
+            ('monitor_decisions_total', 'counter', 'Actions decided.',
+             [({'action': a}, n) for a, n in list(self.decisions.items())]),
+            ('monitor_action_results_total', 'counter', 'Outcomes of the actions decided, busy when the actuator '
+                                                        'was still running a previous one, rebalancing while chunks '
+                                                        'moved to the replica sets last added.',
+             [({'kind': k, 'outcome': o}, n) for (k, o), n in list(self.outcomes.items())]),
+            ('monitor_actuator_busy_seconds_total', 'counter', 'Time the actuator spent running actions.',
+             [({}, self.actuator_busy_time)]),
+            ('monitor_actuator_busy_aborts_total', 'counter', 'Actions not run because the actuator was busy.',
+             [({}, sum(n for (_, o), n in list(self.outcomes.items()) if o == 'busy'))]),
+            ('monitor_actuator_step_seconds', 'gauge', 'Rolling mean and quantiles of the actuator step durations.',
+             [({'step': step, 'stat': stat}, t[stat]) for step, t in self.actuator.timings.summary().items()
+              for stat in ('mean', 'p50', 'p90', 'max')]),
+            ('monitor_actuator_step_duration_seconds', 'histogram', 'Durations of the actuator steps run since start.',
+             [sample for step, (cumulative, total, count) in ((s, timings.histogram(s)) for s in timings.steps)
+              if count for sample in histogram_samples(timings.buckets, cumulative, total, count, {'step': step})]),
+            ('monitor_drain_remaining_chunks', 'gauge', 'Chunks left on the replica sets being drained.',
+             [({'shard': d['shard'], 'state': d['state']}, d['chunks']) for d in self.actuator.drain_progress()
+              if d['chunks'] is not None]),
+            ('monitor_drain_eta_seconds', 'gauge', 'Estimated time to the end of the drain of a replica set.',
+             [({'shard': d['shard']}, d['eta']) for d in self.actuator.drain_progress() if d['eta'] is not None]),
+            ('monitor_rebalance_chunks', 'gauge', 'Chunks planned and moved to the replica sets last added.',
+             [({'stat': k, 'state': rebalance['state']}, rebalance[k]) for k in ('planned', 'moved')
+              if rebalance is not None and rebalance[k] is not None]),
+            ('monitor_time_to_balance_seconds', 'gauge', 'Time from the addition of the last replica sets to the '
+                                                         'end of their planned chunk migrations.',
+             [({}, rebalance['time_to_balance'])] if rebalance and rebalance['time_to_balance'] is not None else []),
+        ]
+        return families
 
-    def _read_conf_file(self, conf_file):
+    @staticmethod
+    def _read_conf_file(conf_file):
         cfg = ConfigParser(interpolation=None, allow_no_value=True)
         cfg.read(conf_file)
         thr_sects = ['thresholds_add', 'thresholds_remove']
         other_sects = ['ignore_hosts']
         dct1 = {s: {k: float(v) for k, v in cfg.items(s)} for s in thr_sects}
         dct2 = {s: {k: v for k, v in cfg.items(s)} for s in other_sects}
-        dct = {**dct1, **dct2, 'delta_metrics': set(cfg.options('delta_metrics'))}
+        ganglia = {
+            'xml_port': cfg.getint('ganglia', 'xml_port', fallback=8651),
+            'query_port': cfg.getint('ganglia', 'query_port', fallback=0),
+            'cluster': cfg.get('ganglia', 'cluster', fallback='mongodb_cluster'),
+        }
+        schedule = {
+            'interval': cfg.getfloat('schedule', 'interval', fallback=10),
+            'fetch_timeout': cfg.getfloat('schedule', 'fetch_timeout', fallback=5),
+        }
+        store = {
+            'depth': cfg.getint('store', 'depth', fallback=60),
+            'window': cfg.getint('store', 'window', fallback=1),
+        }
+        forecast = {
+            'method': cfg.get('forecast', 'method', fallback='none'),
+            'metrics': [m.strip() for m in cfg.get('forecast', 'metrics', fallback='').split(',') if m.strip()],
+            'window': cfg.getint('forecast', 'window', fallback=12),
+            'alpha': cfg.getfloat('forecast', 'alpha', fallback=0.5),
+            'beta': cfg.getfloat('forecast', 'beta', fallback=0.3),
+            'horizon': cfg.getfloat('forecast', 'horizon', fallback=120),
+        }
+        exporter = {
+            'port': cfg.getint('exporter', 'port', fallback=0),
+            'bind': cfg.get('exporter', 'bind', fallback='127.0.0.1'),
+        }
+        ingest = {
+            'mode': cfg.get('ingest', 'mode', fallback='pull'),
+            'port': cfg.getint('ingest', 'port', fallback=8650),
+            'bind': cfg.get('ingest', 'bind', fallback=''),
+            'mcast_join': cfg.get('ingest', 'mcast_join', fallback=None) or None,
+            'settle': cfg.getfloat('ingest', 'settle', fallback=0.2),
+            'expire': cfg.getfloat('ingest', 'expire', fallback=60),
+        }
+        aggregation = {t: parse_aggregation(v) for t, v in cfg.items('aggregation')} \
+            if cfg.has_section('aggregation') else {}
+        dct = {**dct1, **dct2, 'aggregation': aggregation, 'delta_metrics': set(cfg.options('delta_metrics')),
+               'gamma': cfg.getfloat('scaling', 'gamma', fallback=0.8),
+               'max_step': cfg.getint('scaling', 'max_step', fallback=1),
+               'semi_mdp': cfg.getboolean('scaling', 'semi_mdp', fallback=False),
+               'ganglia': ganglia, 'schedule': schedule, 'store': store, 'forecast': forecast,
+               'exporter': exporter, 'ingest': ingest, 'trace': cfg.get('trace', 'file', fallback='')}
         return dct
 
     def _human_readable_metrics(self, metrics):
@@ -0,0 +1,96 @@
+from heapq import heapify, heappop, heappush
+
+# resources a host may declare in the [host_capacity] section of actuator.conf
+RESOURCES = ('cores', 'ram', 'disk')
+
+# least headroom a host is credited with, so a saturated host still ranks by its capacity and processes
+MIN_HEADROOM = 0.05
+
+
+def parse_capacity(items):
+    """
+    Declared capacity of the hosts in (host, 'cores=8 ram=16 disk=200') pairs, as {host: {resource: float}}.
+    :raises: ValueError: for an unknown resource or a non positive value
+    """
+    capacity = {}
+    for host, spec in items:
+        res = {}
+        for part in spec.split():
+            name, _, val = part.partition('=')
+            if name not in RESOURCES:
+                raise ValueError('unknown resource {} of host {}, not one of {}'.format(name, host, RESOURCES))
+            res[name] = float(val)
+            if res[name] <= 0:
+                raise ValueError('non positive {} of host {}'.format(name, host))
+        capacity[host] = res
+    return capacity
+
+
+def host_weights(hosts, capacity):
+    """
+    Relative capacity of every host, the mean over the declared resources of its share of the largest host.
+    A resource a host does not declare counts at the mean of the hosts declaring it, and hosts declaring
+    nothing weigh 1 when no host does.
+    """
+    norm = {}   # resource: (largest, mean) of the declared values
+    for r in RESOURCES:
+        vals = [capacity[h][r] for h in hosts if r in capacity.get(h, {})]
+        if vals:
+            norm[r] = (max(vals), sum(vals) / len(vals))
+
+    if not norm:
+        return {h: 1.0 for h in hosts}
+    return {h: sum(capacity.get(h, {}).get(r, mean) / largest for r, (largest, mean) in norm.items()) / len(norm)
+            for h in hosts}
+
+
+def host_load(metrics):
+    """
+    Busy fraction of the CPUs of every host of metrics, in the layout of XMLHandler.metrics, from cpu_idle or
+    else load_one per cpu_num. Hosts reporting neither are left out.
+    """
+    load = {}
+    for host, dct in metrics.items():
+        if 'cpu_idle' in dct:
+            busy = 1 - dct['cpu_idle'] / 100
+        elif 'load_one' in dct and dct.get('cpu_num'):
+            busy = dct['load_one'] / dct['cpu_num']
+        else:
+            continue
+        load[host] = min(max(busy, 0.0), 1.0)
+    return load
+
+
+def place_repl_sets(processes, k, members, weights=None, load=None):
+    """
+    Hosts of the members of k new replica sets, every member on the host of the most headroom: the least
+    (processes + 1) / (weight * (1 - load)), with the processes placed so far counted. Members of a replica
+    set never share a host. A heap of the hosts makes it O(h + k * members * log h) for h hosts, ties going
+    to the host listed first.
+    :param: processes: {host: number of mongod processes}, in the order of preference on ties
+    :param: weights: {host: relative capacity}, 1 for hosts not given
+    :param: load: {host: busy fraction}, 0 for hosts not given
+    :return: list of k lists of members hosts
+    :raises: ValueError: if there are fewer hosts than members
+    """
+    if members > len(processes):
+        raise ValueError('{} members of a replica set on {} hosts break anti-affinity'.format(members,
+                                                                                              len(processes)))
+    weights = weights or {}
+    load = load or {}
+    scale = {h: 1 / (weights.get(h, 1.0) * max(1 - load.get(h, 0.0), MIN_HEADROOM)) for h in processes}
+    counts = dict(processes)
+
+    heap = [((n + 1) * scale[h], i, h) for i, (h, n) in enumerate(counts.items())]
+    heapify(heap)
+
+    repl_sets = []
+    for _ in range(k):
+        # popped hosts leave the heap until the replica set is complete, so its members are on distinct hosts
+        chosen = [heappop(heap) for _ in range(members)]
+        for _, i, h in chosen:
+            counts[h] += 1
+            heappush(heap, ((counts[h] + 1) * scale[h], i, h))
+        repl_sets.append([h for _, _, h in chosen])
+
+    return repl_sets
@@ -0,0 +1,139 @@
+from logging import getLogger as logging_getLogger
+from itertools import zip_longest
+from datetime import datetime
+from time import monotonic
+from threading import Event
+
+
+def in_window(window, now):
+    """Whether the time now is in the balancer active window ('HH:MM' start, 'HH:MM' stop), maybe past midnight."""
+    start, stop = (datetime.strptime(t, '%H:%M').time() for t in window)
+    if start <= stop:
+        return start <= now < stop
+    return now >= start or now < stop
+
+
+def plan_moves(chunks, shards, targets, load=None):
+    """
+    Chunk migrations bringing the target shards up to the mean chunk count of every collection, as the balancer
+    balances collection by collection, taken from the shards above the mean hottest first, each going to the
+    target of the fewest chunks of the collection at the time. Collections of the config database, e.g.
+    config.system.sessions, are left to the balancer. Migrations of the collections alternate, so that a
+    rebalance cut short still spreads every collection.
+    :param: chunks: {namespace: {shard id: number of chunks}}, 0 if missing
+    :param: shards: shard ids of the cluster, targets included
+    :param: load: {shard id: ops/s}, 0 if missing
+    :return: list of (namespace, from shard, to shard)
+    """
+    load = load or {}
+    plans = []
+    for ns in sorted(chunks):
+        if ns.split('.', 1)[0] == 'config':
+            continue
+        counts = {s: chunks[ns].get(s, 0) for s in shards}
+        fair = sum(counts.values()) / len(counts)
+        donors = sorted((s for s in counts if s not in targets and counts[s] > fair),
+                        key=lambda s: (-load.get(s, 0), -counts[s]))
+
+        moves = []
+        for src in donors:
+            while counts[src] - 1 >= fair:
+                dst = min(targets, key=lambda s: counts[s])
+                if counts[dst] + 1 > fair:
+                    break
+                counts[src] -= 1
+                counts[dst] += 1
+                moves.append((ns, src, dst))
+        plans.append(moves)
+
+    return [m for ms in zip_longest(*plans) for m in ms if m is not None]
+
+
+class Rebalancer:
+    """
+    Migrations of chunks to newly added shards at up to rate chunks per minute, instead of waiting for the
+    balancer, while in the balancer active window and for up to timeout seconds. The time to balance is from
+    the start of the migrations to the end of the last planned one.
+    """
+
+    def __init__(self, backend, new_shards, load=None, rate=30.0, timeout=600.0, max_failures=3):
+        self.logger = logging_getLogger(__name__)
+        self.backend = backend
+        self.new_shards = list(new_shards)
+        self.load = load or {}
+        self.rate = rate
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cancelled = Event()
+        # state: pending, moving, balanced, window_closed, timeout, cancelled or failed
+        self.progress = {'shards': self.new_shards, 'state': 'pending', 'planned': None, 'moved': 0,
+                         'time_to_balance': None}
+
+    def __str__(self):
+        return 'rebalance to {}'.format(', '.join(self.new_shards))
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def __call__(self, log=None):
+        """
+        Run the planned migrations.
+        :param: log: callable of progress messages, the logger's info if None
+        :return: '' once balanced, else why not, as the errors of a command
+        """
+        log = log or self.logger.info
+        start = monotonic()
+        try:
+            present = [d['_id'] for d in self.backend.list_shards()]
+            chunks = self.backend.namespace_chunks()
+            window = self.backend.balancer_window()
+        except Exception as e:
+            self.progress['state'] = 'failed'
+            return str(e)
+
+        targets = [s for s in self.new_shards if s in present]
+        if not targets:
+            self.progress['state'] = 'failed'
+            return 'none of {} in the cluster'.format(', '.join(self.new_shards))
+
+        moves = plan_moves(chunks, present, targets, self.load)
+        self.progress.update(state='moving', planned=len(moves))
+        log('Moving {} chunks to {}'.format(len(moves), ', '.join(targets)))
+
+        failures = 0
+        last_move = start
+        for ns, src, dst in moves:
+            if window and not in_window(window, datetime.now().time()):
+                self.progress['state'] = 'window_closed'
+                break
+            if monotonic() - start > self.timeout:
+                self.progress['state'] = 'timeout'
+                break
+
+            move_start = monotonic()
+            try:
+                self.backend.move_chunk(ns, src, dst)
+                last_move = monotonic()
+                self.progress['moved'] += 1
+                failures = 0
+            except Exception as e:
+                failures += 1
+                log('Moving a chunk of {} from {} to {} failed -- {}'.format(ns, src, dst, e))
+                if failures >= self.max_failures:
+                    self.progress['state'] = 'failed'
+                    return '{} chunk migrations in a row failed -- {}'.format(failures, e)
+
+            if self.cancelled.wait(max(0.0, 60 / self.rate - (monotonic() - move_start))):
+                self.progress['state'] = 'cancelled'
+                break
+        else:
+            # not counting the rate limiting wait after the last move
+            self.progress.update(state='balanced', time_to_balance=last_move - start)
+
+        p = self.progress
+        status = 'Rebalance {}: {}/{} chunks moved{}'.format(
+            p['state'], p['moved'], p['planned'],
+            '' if p['time_to_balance'] is None else ' in {:.1f} s'.format(p['time_to_balance']))
+        log(status)
+        # the rest is left to the balancer
+        return '' if p['state'] == 'balanced' else status
@@ -0,0 +1,98 @@
+from logging import basicConfig as logging_basicConfig
+from json import dumps as json_dumps
+from argparse import ArgumentParser
+from actuator import StepTimings
+from tracefile import read_trace
+from mdp import split_action
+from time import perf_counter
+from monitor import Monitor
+from random import Random
+
+
+class StubActuator:
+    """Actuator stand-in adding/removing replica sets at once, each of them successfully with probability success."""
+
+    def __init__(self, shards, success=1.0, seed=0):
+        self.shards = shards
+        self.success = success
+        self.rnd = Random(seed)
+        self.is_available = True
+        self.timings = StepTimings()
+
+    def current_shard_number(self):
+        return self.shards
+
+    def expected_duration(self, action):
+        return None
+
+    def exec_cmds_of_type(self, cmd_type, cmd_uuid='uuid', dry_run=False):
+        kind, k = split_action(cmd_type)
+        done = sum(self.rnd.random() < self.success for _ in range(k))
+        self.shards += done if kind == 'add' else -done
+        return done
+
+
+def replay(monitor, records):
+    """
+    Decide on every record of a trace as fast as possible, the actions taking effect at once.
+    :return: dict of the decisions, shard count timeline and throughput
+    """
+    decisions = {}
+    timeline = []       # (seconds since the first record, shards) on every change
+    agreed = cycles = 0
+    first = None
+    start = perf_counter()
+
+    for rec in records:
+        first = rec['time'] if first is None else first
+        action = monitor.evaluate(rec['metrics'], rec['time'])
+        decisions[action] = decisions.get(action, 0) + 1
+        agreed += action == rec['action']
+        cycles += 1
+
+        if action != 'nop':
+            done = monitor.actuator.exec_cmds_of_type(action)
+            monitor.mdp.commit_action_result(done == split_action(action)[1], action, done)
+        if not timeline or timeline[-1][1] != int(monitor.mdp.curr_state):
+            timeline.append((rec['time'] - first, int(monitor.mdp.curr_state)))
+
+    elapsed = perf_counter() - start
+    return {'cycles': cycles, 'decisions': decisions, 'agreement': agreed / cycles if cycles else None,
+            'timeline': timeline, 'seconds': elapsed, 'cycles_per_second': cycles / elapsed if elapsed else None}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="replay a monitor trace against the decision layer")
+    parser.add_argument('trace', help="trace file recorded through [trace] file of monitor.conf")
+    parser.add_argument('--conf', default='monitor.conf', help="monitor configuration to replay with")
+    parser.add_argument('--gamma', type=float, default=None, help="discount factor, that of --conf if not given")
+    parser.add_argument('--max-step', type=int, default=None, help="max replica sets per action")
+    parser.add_argument('--start-state', type=int, default=None, help="shards at start, as traced if not given")
+    parser.add_argument('--success', type=float, default=1.0, help="success probability of a replica set change")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the action outcomes")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging_basicConfig(level='WARNING')
+    conf = Monitor._read_conf_file(args.conf)
+    if args.gamma is not None:
+        conf['gamma'] = args.gamma
+    if args.max_step is not None:
+        conf['max_step'] = args.max_step
+
+    records = list(read_trace(args.trace))
+    if not records:
+        parser.error('empty trace')
+    shards = args.start_state or int(records[0]['state'])
+
+    monitor = Monitor(conf=conf, actuator=StubActuator(shards, args.success, args.seed), live=False)
+    report = replay(monitor, records)
+
+    if args.json:
+        print(json_dumps(report))
+    else:
+        print('{} cycles in {:.3f} s, {:.0f} decisions/s'.format(report['cycles'], report['seconds'],
+                                                                report['cycles_per_second'] or 0))
+        print('decisions: ' + ', '.join('{} {}'.format(a, n) for a, n in sorted(report['decisions'].items())))
+        print('agreement with the traced decisions: {:.1%}'.format(report['agreement']))
+        print('shards: ' + ' -> '.join('{} (+{:.0f} s)'.format(s, t) for t, s in report['timeline']))
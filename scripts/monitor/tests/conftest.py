@@ -0,0 +1,28 @@
+import sys
+from os.path import dirname, abspath
+
+# the monitor modules import each other as top level modules, as when run from scripts/monitor
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import pytest
+
+from topology import MemoryBackend
+
+
+def make_cluster(chunks=(100, 100, 100), primary_dbs=(), migrate_per_call=1, window=None):
+    """
+    Backend of shards ShardReplSet1, ShardReplSet2, ... on one host, with the given number of chunks each, all of
+    the collection app.data, and ShardReplSet1 primary of primary_dbs. Drains move a chunk per removeShard, so
+    they are slow enough to cancel.
+    """
+    docs = [{'_id': 'ShardReplSet{}'.format(n), 'host': 'ShardReplSet{0}/h1:{1}'.format(n, 27016 + n), 'state': 1}
+            for n in range(1, len(chunks) + 1)]
+    stats = {d['_id']: {'chunks': c, 'data_size': 1000 * c, 'primary_dbs': [], 'namespaces': {'app.data': c}}
+             for d, c in zip(docs, chunks)}
+    stats['ShardReplSet1']['primary_dbs'] = list(primary_dbs)
+    return MemoryBackend(docs, stats, migrate_per_call, window)
+
+
+@pytest.fixture
+def cluster():
+    return make_cluster
@@ -0,0 +1,114 @@
+from os.path import dirname, join
+from threading import Thread, Event
+from time import sleep
+
+from topology import ShellBackend
+from actuator import Actuator
+from drain import ShardDrain, drain_costs
+
+
+def draining(backend, shard):
+    return next(d for d in backend.shards if d['_id'] == shard).get('draining', False)
+
+
+def test_drain_removes_the_shard(cluster):
+    backend = cluster((5, 5, 5), primary_dbs=['app'])
+    drain = ShardDrain(backend, 'ShardReplSet1', 'ShardReplSet2', min_poll=0.001, max_poll=0.002)
+    assert drain() == ''
+    assert drain.progress['state'] == 'completed'
+    assert 'ShardReplSet1' not in {d['_id'] for d in backend.list_shards()}
+    assert backend.stats['ShardReplSet2']['primary_dbs'] == ['app']
+
+
+class FailingShell(ShellBackend):
+    """Shell backend whose mongo shell answers every command with an error document."""
+
+    def __init__(self):
+        super().__init__('mongos:27017')
+        self.calls = 0
+
+    def _eval(self, js, what):
+        self.calls += 1
+        return {'ok': 0, 'errmsg': 'Shard ShardReplSet9 not found', 'code': 70}
+
+
+def test_drain_error_fails_the_drain():
+    backend = FailingShell()
+    drain = ShardDrain(backend, 'ShardReplSet9', min_poll=0.001, max_poll=0.002)
+    assert drain() == 'Shard ShardReplSet9 not found'
+    assert drain.progress['state'] == 'failed' and backend.calls == 1
+
+
+def test_larger_shard_costs_more():
+    stats = {'small': {'chunks': 10, 'data_size': 1000, 'primary_dbs': []},
+             'large': {'chunks': 40, 'data_size': 8000, 'primary_dbs': []}}
+    costs = drain_costs(['small', 'large'], stats)
+    assert costs == {'small': (10 / 40 + 1000 / 8000) / 2, 'large': 1.0}
+    # busier under load, but not enough to outweigh four times the chunks
+    costs = drain_costs(['small', 'large'], stats, load={'small': 100, 'large': 10})
+    assert costs['small'] < costs['large']
+
+
+def run_and_cancel(drain):
+    res = []
+    t = Thread(target=lambda: res.append(drain()))
+    t.start()
+    while drain.progress['chunks'] is None:
+        sleep(0.001)
+    drain.cancel()
+    t.join(5)
+    return res[0]
+
+
+def test_cancel_leaves_the_shard_draining(cluster):
+    backend = cluster()
+    drain = ShardDrain(backend, 'ShardReplSet1', min_poll=0.001, max_poll=0.002)
+    assert run_and_cancel(drain) == 'drain of ShardReplSet1 cancelled'
+    assert drain.progress['state'] == 'cancelled'
+    assert 'ShardReplSet1' in {d['_id'] for d in backend.list_shards()}
+    # no unsupported edit of config.shards unless asked for
+    assert draining(backend, 'ShardReplSet1')
+
+
+def test_cancel_unsets_draining_if_asked(cluster):
+    backend = cluster()
+    drain = ShardDrain(backend, 'ShardReplSet1', min_poll=0.001, max_poll=0.002, unset_draining=True)
+    assert run_and_cancel(drain) == 'drain of ShardReplSet1 cancelled'
+    assert not draining(backend, 'ShardReplSet1')
+
+
+def test_cancelled_drain_never_starts(cluster):
+    backend = cluster()
+    cancelled = Event()
+    first = ShardDrain(backend, 'ShardReplSet1', min_poll=0.001, max_poll=0.002, cancelled=cancelled)
+    second = ShardDrain(backend, 'ShardReplSet2', min_poll=0.001, max_poll=0.002, cancelled=cancelled)
+    run_and_cancel(first)
+    assert second() == 'drain of ShardReplSet2 cancelled'
+    assert second.progress['state'] == 'cancelled'
+    assert not draining(backend, 'ShardReplSet2')
+    assert backend.stats['ShardReplSet2']['chunks'] == 100
+
+
+def test_actuator_cancel_stops_the_later_drains(cluster):
+    # ShardReplSet1 the costliest to drain, as the primary of a database
+    backend = cluster(primary_dbs=['app'])
+    actuator = Actuator(join(dirname(dirname(__file__)), 'actuator.conf'), backend=backend)
+    actuator.conf.update(drain_engine='python', drain_poll_min=0.001, drain_poll_max=0.002)
+    # drains are only registered once their stage starts
+    assert actuator.exec_cmds_of_type('rmv_2', dry_run=True) == 0
+    assert not actuator.draining() and actuator.drains == []
+
+    res = []
+    t = Thread(target=lambda: res.append(actuator.exec_cmds_of_type('rmv_2')))
+    t.start()
+    while not actuator.draining():
+        sleep(0.001)
+    assert len(actuator.drains) == 1
+    actuator.cancel_drain()
+    t.join(5)
+
+    assert res == [0]
+    assert actuator.drains == [] and not actuator.draining() and actuator.is_available
+    assert {d['_id'] for d in backend.list_shards()} == {'ShardReplSet1', 'ShardReplSet2', 'ShardReplSet3'}
+    # one of the two cheapest was draining when cancelled, the other never got a removeShard
+    assert sum(draining(backend, s) for s in ('ShardReplSet2', 'ShardReplSet3')) == 1
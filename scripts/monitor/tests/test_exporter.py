@@ -0,0 +1,19 @@
+from actuator import StepTimings
+from exporter import render, histogram_samples
+
+
+def test_step_histogram_exposition():
+    timings = StepTimings(size=2)
+    for seconds in (0.5, 3, 3, 4000):
+        timings.record('add', seconds)
+    cumulative, total, count = timings.histogram('add')
+    # all the runs since start, not only the rolling window
+    assert (cumulative[-1], total, count) == (4, 4006.5, 4)
+
+    lines = render([('step_seconds', 'histogram', 'Step durations.',
+                     histogram_samples(timings.buckets, cumulative, total, count, {'step': 'add'}))]).splitlines()
+    assert lines[:2] == ['# HELP step_seconds Step durations.', '# TYPE step_seconds histogram']
+    assert 'step_seconds_bucket{step="add",le="1"} 1.0' in lines
+    assert 'step_seconds_bucket{step="add",le="5"} 3.0' in lines
+    assert 'step_seconds_bucket{step="add",le="+Inf"} 4.0' in lines
+    assert lines[-2:] == ['step_seconds_sum{step="add"} 4006.5', 'step_seconds_count{step="add"} 4.0']
@@ -0,0 +1,27 @@
+import pytest
+
+from metrics import MetricStore
+from forecast import Forecaster
+
+
+def store_of(times, values):
+    store = MetricStore(depth=len(times))
+    for t, v in zip(times, values):
+        store.append({'h1': {'shards': {'r1s1': {'conn': v}}}}, t)
+    return store
+
+
+@pytest.mark.parametrize('method', ['holt', 'linear'])
+def test_linear_series_extrapolated_exactly(method):
+    # irregular sampling of 10 + 2 t
+    times = [0, 1, 3, 4, 7]
+    store = store_of(times, [10 + 2 * t for t in times])
+    names, F = Forecaster(['conn'], method).forecast(store, horizon=5)
+    assert names == [('h1', 'r1s1', 'conn')]
+    assert F[0] == pytest.approx(10 + 2 * 12)
+
+
+def test_ewma_smooths_without_trend():
+    store = store_of([0, 1, 2, 3], [0, 0, 0, 8])
+    _, F = Forecaster(['conn'], 'ewma', alpha=0.5).forecast(store, horizon=60)
+    assert F[0] == pytest.approx(4)
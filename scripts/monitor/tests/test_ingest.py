@@ -0,0 +1,30 @@
+import struct
+
+import pytest
+
+from ingest import decode_packet, encode_metadata, encode_metric, VALUE_TYPES
+
+
+@pytest.mark.parametrize('value_type, value', [
+    ('uint16', 65535), ('int16', -7), ('int32', -2 ** 31), ('uint32', 2 ** 32 - 1),
+    ('float', 0.5), ('double', 1234.5678), ('string', 'mongod 6.0'),
+])
+def test_metric_round_trip(value_type, value):
+    data = encode_metric('host1', 'shardr1s1_mongodb_op_count_query', value, value_type)
+    # XDR is 4 byte aligned
+    assert len(data) % 4 == 0
+    assert decode_packet(data) == ('host1', 'shardr1s1_mongodb_op_count_query', value)
+
+
+def test_metadata_is_skipped():
+    data = encode_metadata('host1', 'load_one', 'float', units='', slope='both', extra={'GROUP': 'load'})
+    assert decode_packet(data) is None
+
+
+def test_truncated_and_unknown_packets_raise():
+    data = encode_metric('host1', 'load_one', 1.5, 'float')
+    for n in (2, 8, len(data) - 1):
+        with pytest.raises(struct.error):
+            decode_packet(data[:n])
+    with pytest.raises(ValueError):
+        decode_packet(struct.pack('>I', max(VALUE_TYPES[t][0] for t in VALUE_TYPES) + 100) + data[4:])
@@ -0,0 +1,134 @@
+from bench_mdp import make_mdp, dict_value_iteration, dict_best_policy
+from mdp import ClusterMDP, split_action
+from random import Random
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('n_states', [2, 10, 50])
+@pytest.mark.parametrize('gamma', [0.5, 0.8, 0.95])
+def test_array_solver_matches_dict_solver(n_states, gamma):
+    mdp = make_mdp(n_states, gamma)
+    U_ref = dict_value_iteration(mdp)
+    U = mdp.value_iteration()
+
+    assert max(abs(U_ref[s] - U[s]) for s in mdp.states) < 1e-9
+    assert mdp.best_policy(U) == dict_best_policy(mdp, U_ref)
+
+
+def test_local_reward_change_is_propagated():
+    mdp = make_mdp(1000, 0.8)
+    mdp.solve()
+    for s in ['499', '500', '501']:
+        mdp.reward[s] += 0.1
+    action = mdp.solve()
+    assert mdp.solve_stats['mode'] == 'incremental'
+
+    ref = make_mdp(1000, 0.8)
+    ref.reward = dict(mdp.reward)
+    assert action == ref.solve()
+
+    assert mdp.solve() == action
+    assert mdp.solve_stats['mode'] == 'skipped'
+
+
+@pytest.mark.parametrize('gamma', [0.8, 0.95, 0.99])
+def test_banded_policy_iteration_matches_dict_solver(gamma):
+    pytest.importorskip('scipy')
+    mdp = make_mdp(50, gamma)
+    U, pi = mdp.policy_iteration_banded()
+    U_ref = dict_value_iteration(mdp, epsilon=1e-9)
+
+    states = mdp.compile()['states']
+    assert max(abs(U_ref[s] - u) for s, u in zip(states, U)) < 1e-6
+    assert {s: mdp.actlist[s][j] for s, j in zip(states, pi)} == dict_best_policy(mdp, U_ref)
+
+
+THRESHOLDS_ADD = {'cpu_idle_lo': 40, 'cpu_system_hi': 12, 'cpu_user_hi': 30, 'cpu_wio_hi': 22, 'load_fifteen_hi': 5,
+                  'load_five_hi': 7, 'load_one_hi': 7, 'mongodb_conn_current_hi': 70,
+                  'mongodb_op_count_query_hi': 4000, 'mongodb_op_count_update_hi': 1000}
+THRESHOLDS_RMV = {'cpu_idle_hi': 96, 'cpu_system_lo': 3, 'cpu_user_lo': 5, 'cpu_wio_lo': 8, 'load_fifteen_lo': 0.5,
+                  'load_five_lo': 0.5, 'load_one_lo': 0.5, 'mongodb_conn_current_lo': 7,
+                  'mongodb_op_count_query_lo': 400, 'mongodb_op_count_update_lo': 100}
+
+
+def cluster_metrics(shards, values):
+    """A host per shard, every host and shard with values."""
+    host = {m: v for m, v in values.items() if not m.startswith('mongodb_')}
+    shard = {m: v for m, v in values.items() if m.startswith('mongodb_')}
+    return {'host{}'.format(i): dict(host, shards={'shardr{}s1'.format(i + 1): dict(shard)}) for i in range(shards)}
+
+
+def violating(thresholds, factors):
+    """Values violating every threshold by its factor, above _hi and below _lo ones."""
+    return {t[:-3]: v * factors[t] if t.endswith('_hi') else v / factors[t] for t, v in thresholds.items()}
+
+
+@pytest.mark.parametrize('max_step', [1, 2, 3, 4])
+def test_violated_add_thresholds_vote_add(max_step):
+    rnd = Random(max_step)
+    for _ in range(200):
+        factors = {t: rnd.choice([1.05, 1.3, 1.8, 2.5, 4, 8]) for t in THRESHOLDS_ADD}
+        mdp = ClusterMDP('3', [str(x) for x in range(1, 11)], gamma=0.8, max_step=max_step)
+        mdp.calc_reward(cluster_metrics(3, violating(THRESHOLDS_ADD, factors)), THRESHOLDS_ADD, THRESHOLDS_RMV)
+        assert split_action(mdp.solve())[0] == 'add', factors
+
+
+@pytest.mark.parametrize('max_step', [1, 2, 3, 4])
+def test_add_steps_grow_with_load(max_step):
+    steps = []
+    for factor in [1.05, 1.5, 2, 3, 8]:
+        mdp = ClusterMDP('3', [str(x) for x in range(1, 11)], gamma=0.8, max_step=max_step)
+        values = violating(THRESHOLDS_ADD, {t: factor for t in THRESHOLDS_ADD})
+        mdp.calc_reward(cluster_metrics(3, values), THRESHOLDS_ADD, THRESHOLDS_RMV)
+        kind, k = split_action(mdp.solve())
+        assert kind == 'add'
+        steps.append(k)
+    assert steps == sorted(steps)
+
+
+@pytest.mark.parametrize('max_step', [1, 2, 4])
+@pytest.mark.parametrize('shards', [3, 6])
+def test_violated_remove_thresholds_vote_rmv(max_step, shards):
+    mdp = ClusterMDP(str(shards), [str(x) for x in range(1, 11)], gamma=0.8, max_step=max_step)
+    values = violating(THRESHOLDS_RMV, {t: 2 for t in THRESHOLDS_RMV})
+    mdp.calc_reward(cluster_metrics(shards, values), THRESHOLDS_ADD, THRESHOLDS_RMV)
+    assert split_action(mdp.solve())[0] == 'rmv'
+
+
+def test_incremental_solves_match_the_exact_policy():
+    rnd = Random(1)
+    mdp = make_mdp(50, 0.8, seed=1)
+    mdp.solve()
+    modes = set()
+    for _ in range(300):
+        for _ in range(rnd.randint(1, 3)):
+            mdp.reward[rnd.choice(mdp.states)] = rnd.uniform(0, 0.05)
+        mdp.solve()
+        modes.add(mdp.solve_stats['mode'])
+
+        ref = make_mdp(50, 0.8, seed=1)
+        ref.reward = dict(mdp.reward)
+        ref.compile()
+        Q = ref.q_values(ref.value_iteration_array(epsilon=1e-12))
+        # states of a single best action, exact ties may go either way
+        top = np.sort(Q, axis=1)
+        clear = top[:, -1] - top[:, -2] > 1e-9
+        assert (mdp.q_values(mdp._U).argmax(axis=1)[clear] == Q.argmax(axis=1)[clear]).all()
+    assert modes == {'incremental', 'full'}
+
+
+@pytest.mark.parametrize('state', ['6', '7', '9'])
+def test_top_state_reward_clears_after_load_drops(state):
+    mdp = ClusterMDP(state, [str(x) for x in range(1, 11)], gamma=0.8, max_step=4)
+    high = cluster_metrics(int(state), violating(THRESHOLDS_ADD, {t: 3 for t in THRESHOLDS_ADD}))
+    for _ in range(5):
+        mdp.calc_reward(high, THRESHOLDS_ADD, THRESHOLDS_RMV)
+        assert split_action(mdp.solve())[0] == 'add'
+
+    # between the add and remove thresholds
+    calm = {t[:-3]: (THRESHOLDS_ADD[t] + THRESHOLDS_RMV[t[:-3] + ('_lo' if t.endswith('_hi') else '_hi')]) / 2
+            for t in THRESHOLDS_ADD}
+    mdp.calc_reward(cluster_metrics(int(state), calm), THRESHOLDS_ADD, THRESHOLDS_RMV)
+    assert mdp.solve() == 'nop'
+    assert mdp.reward['10'] == 0
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from metrics import CounterRates, MetricStore
+from mdp import ClusterMDP, parse_aggregation
+
+
+def test_rate_of_increase():
+    rates = CounterRates()
+    assert rates.rate('c', 100, 0) is None
+    assert rates.rate('c', 300, 10) == 20
+    # not sampled again, previous rate kept
+    assert rates.rate('c', 300, 10) == 20
+
+
+def test_single_drop_to_0_is_ignored():
+    rates = CounterRates()
+    rates.rate('c', 1000, 0)
+    assert rates.rate('c', 1200, 10) == 20
+    # stale gmond snapshot served as 0
+    assert rates.rate('c', 0, 20) == 20
+    # increase since the last real sample, no spike of the whole counter
+    assert rates.rate('c', 1600, 30) == 20
+
+
+def test_drop_is_taken_as_reset():
+    rates = CounterRates()
+    rates.rate('c', 1000, 0)
+    rates.rate('c', 1200, 10)
+    # restarted mongod, its counter climbing from 0 again
+    assert rates.rate('c', 50, 20) == 5
+
+
+def test_repeated_0_is_taken_as_reset():
+    rates = CounterRates()
+    rates.rate('c', 1000, 0)
+    rates.rate('c', 1200, 10)
+    assert rates.rate('c', 0, 20) == 20
+    assert rates.rate('c', 0, 30) == 0
+    assert rates.rate('c', 100, 40) == 10
+
+
+def test_store_lookups_do_not_intern():
+    store = MetricStore(depth=4)
+    store.append({'h1': {'load_one': 1.0, 'shards': {}}}, 0)
+    ids = dict(store.ids)
+    t, v = store.window('h9', 'shardr1s1', 'load_one')
+    assert len(t) == 1 and np.isnan(v).all()
+    assert store.slope('h1', None, 'no_such_metric') is None
+    assert store.ids == ids
+
+
+def test_store_evicts_departed_hosts_and_their_names():
+    store = MetricStore(depth=4)
+    store.append({'h1': {'load_one': 1.0, 'shards': {}},
+                  'h2': {'load_one': 2.0, 'shards': {'shardr1s1': {'conn': 3.0}}}}, 0)
+    store.evict('h2')
+    assert {store.names[k[0]] for k in store.columns} == {'h1'}
+    assert set(store.ids) == {'h1', 'load_one'}
+    # released ids are reused
+    store.append({'h3': {'load_one': 1.0, 'shards': {}}}, 1)
+    assert len(store.names) == 5 and store.names.count(None) == 2
+
+
+def aggregate(metrics, spec, threshold):
+    """Cluster value and quorum verdict of the conn metric of metrics against threshold, aggregated by spec."""
+    _, weights, V = ClusterMDP.metric_matrix(metrics, ['conn'])
+    kind, param = parse_aggregation(spec)
+    nan = float('nan')
+    values, quorum_met, present = ClusterMDP.aggregate(
+        V, weights, V > threshold, np.array([param if kind == 'percentile' else nan]),
+        np.array([param if kind == 'quorum' else nan]))
+    return values[0], quorum_met[0]
+
+
+def test_host_of_several_shards_counts_once():
+    metrics = {'h1': {'shards': {s: {'conn': 90.0} for s in ('r1s1', 'r2s1', 'r3s1')}},
+               'h2': {'shards': {'r4s1': {'conn': 10.0}}}}
+    _, weights, _ = ClusterMDP.metric_matrix(metrics, ['conn'])
+    assert weights.tolist() == pytest.approx([1 / 3] * 3 + [1])
+    # 3 of the 4 shards violate, but only 1 of the 2 hosts
+    value, quorum_met = aggregate(metrics, 'quorum:0.6', 50)
+    assert value == pytest.approx(50) and not quorum_met
+    assert aggregate(metrics, 'quorum:0.5', 50)[1]
+
+
+def test_quorum_just_missed():
+    # violating share (1/2 + 1) / 3 = 0.5 of the hosts
+    metrics = {'h1': {'shards': {'r1s1': {'conn': 90.0}, 'r2s1': {'conn': 10.0}}},
+               'h2': {'shards': {'r3s1': {'conn': 90.0}}},
+               'h3': {'shards': {'r4s1': {'conn': 10.0}}}}
+    assert aggregate(metrics, 'quorum', 50)[1]
+    assert not aggregate(metrics, 'quorum:0.51', 50)[1]
@@ -0,0 +1,41 @@
+from random import Random
+
+import pytest
+
+from placement import place_repl_sets, host_weights, parse_capacity
+
+
+def test_members_never_share_a_host():
+    rnd = Random(0)
+    for _ in range(200):
+        hosts = ['host{}'.format(i) for i in range(rnd.randint(3, 12))]
+        processes = {h: rnd.randint(0, 5) for h in hosts}
+        weights = {h: rnd.uniform(0.2, 1) for h in hosts}
+        load = {h: rnd.uniform(0, 1) for h in hosts}
+        members = rnd.randint(1, len(hosts))
+        repl_sets = place_repl_sets(processes, rnd.randint(1, 10), members, weights, load)
+        for hs in repl_sets:
+            assert len(hs) == members and len(set(hs)) == members
+
+
+def test_placement_spreads_processes():
+    repl_sets = place_repl_sets({'a': 0, 'b': 0, 'c': 0, 'd': 2}, 2, 3)
+    # the least loaded hosts first, ties in the order given
+    assert repl_sets == [['a', 'b', 'c'], ['a', 'b', 'c']]
+    # a host of twice the capacity takes twice the processes
+    repl_sets = place_repl_sets({'a': 0, 'b': 0, 'c': 0}, 3, 1, weights={'a': 2})
+    assert repl_sets == [['a'], ['a'], ['b']]
+
+
+def test_too_few_hosts_for_anti_affinity():
+    with pytest.raises(ValueError):
+        place_repl_sets({'a': 0, 'b': 0}, 1, 3)
+
+
+def test_host_weights_of_declared_capacity():
+    capacity = parse_capacity([('a', 'cores=8 ram=32'), ('b', 'cores=4'), ('c', '')])
+    weights = host_weights(['a', 'b', 'c'], capacity)
+    assert weights['a'] == 1.0
+    # ram of b and c at the mean of the declared ones, cores of c too
+    assert weights['b'] == pytest.approx((0.5 + 1) / 2)
+    assert weights['c'] == pytest.approx((0.75 + 1) / 2)
@@ -0,0 +1,67 @@
+from os.path import dirname, join
+
+from rebalance import Rebalancer, plan_moves
+from actuator import Actuator
+
+
+def test_plan_fills_new_shards_from_the_hottest():
+    moves = plan_moves({'app.data': {'a': 40, 'b': 20}}, ['a', 'b', 'c'], ['c'], load={'b': 100})
+    # b is hotter but at the mean, so only a gives
+    assert moves == [('app.data', 'a', 'c')] * 20
+
+
+def test_plan_balances_every_collection():
+    chunks = {'app.data': {'a': 30, 'b': 0}, 'app.log': {'a': 0, 'b': 4},
+              'config.system.sessions': {'a': 1024}}
+    moves = plan_moves(chunks, ['a', 'b', 'c'], ['c'])
+    # a surplus of one collection never makes up for the deficit of another, migrations alternate
+    assert moves[:2] == [('app.data', 'a', 'c'), ('app.log', 'b', 'c')]
+    assert sorted(moves) == [('app.data', 'a', 'c')] * 10 + [('app.log', 'b', 'c')]
+
+
+def test_balanced_rebalance_returns_no_error(cluster):
+    backend = cluster((40, 40, 0))
+    rebalancer = Rebalancer(backend, ['ShardReplSet3'], rate=1e6)
+    assert rebalancer() == ''
+    assert rebalancer.progress['state'] == 'balanced' and rebalancer.progress['moved'] == 26
+    assert backend.stats['ShardReplSet3']['chunks'] == 26
+    assert backend.namespace_chunks() == {'app.data': {'ShardReplSet1': 27, 'ShardReplSet2': 27, 'ShardReplSet3': 26}}
+
+
+def test_time_to_balance_ends_at_the_last_move(cluster):
+    # a move every 0.05 s, the wait after the last one not counted
+    rebalancer = Rebalancer(cluster(chunks=(2, 0)), ['ShardReplSet2'], rate=1200)
+    assert rebalancer() == ''
+    assert rebalancer.progress['time_to_balance'] < 0.05
+
+
+def test_timeout_and_closed_window_are_reported(cluster):
+    rebalancer = Rebalancer(cluster((40, 40, 0)), ['ShardReplSet3'], rate=1e6, timeout=0)
+    status = rebalancer()
+    assert rebalancer.progress['state'] == 'timeout'
+    assert status.startswith('Rebalance timeout: 0/26 chunks moved')
+
+    # an empty window, never open
+    rebalancer = Rebalancer(cluster((40, 40, 0), window=('23:59', '23:59')), ['ShardReplSet3'], rate=1e6)
+    assert rebalancer() != ''
+    assert rebalancer.progress['state'] == 'window_closed'
+
+
+def test_actuator_rebalances_only_after_an_add(cluster):
+    backend = cluster((40, 40, 0))
+    actuator = Actuator(join(dirname(dirname(__file__)), 'actuator.conf'), backend=backend)
+    actuator.conf.update(rebalance=True, rebalance_rate=1e6, shard_hosts=['h1', 'h2'])
+    # building and dry running an add starts no rebalance
+    assert actuator.exec_cmds_of_type('add', dry_run=True) == 0
+    assert not actuator.rebalancing() and actuator.rebalance_progress() is None
+    assert actuator.rebalance('add') == ''
+    assert actuator.rebalance_progress() is None
+
+    # the add leaves the rebalance pending, so no action is dispatched before it has run
+    actuator.added = ['ShardReplSet3']
+    actuator._plan_rebalance()
+    assert actuator.rebalancing() and actuator.rebalance_progress()['state'] == 'pending'
+    assert actuator.rebalance('add') == ''
+    assert actuator.rebalance_progress()['state'] == 'balanced' and not actuator.rebalancing()
+    # run once only
+    assert actuator.rebalance('add') == '' and actuator.rebalance_progress()['moved'] == 26
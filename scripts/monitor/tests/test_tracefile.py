@@ -0,0 +1,49 @@
+import gzip
+
+from tracefile import TraceWriter, read_trace, segment_path
+
+
+def crash(path, keep):
+    """Cut the trace at path to keep bytes, as a monitor killed while writing leaves it."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:keep])
+
+
+def test_restart_after_crash_keeps_both_runs(tmp_path):
+    path = str(tmp_path / 'trace.gz')
+    trace = TraceWriter(path)
+    for i in range(100):
+        trace.write({'cycle': i, 'pad': 'x' * i})
+    # killed: only the flushed records are on disk, without the end of the gzip member
+    with open(path, 'rb') as f:
+        flushed = f.read()
+    trace.close()
+    with open(path, 'wb') as f:
+        f.write(flushed[:-8])
+
+    trace = TraceWriter(path)
+    assert trace.path == segment_path(path, 1) == str(tmp_path / 'trace.1.gz')
+    for i in range(100, 110):
+        trace.write({'cycle': i})
+    trace.close()
+
+    cycles = [r['cycle'] for r in read_trace(path)]
+    assert cycles[-10:] == list(range(100, 110))
+    # the first run up to its last complete record
+    assert cycles[:-10] == list(range(len(cycles) - 10)) and len(cycles) > 10
+
+
+def test_member_appended_after_a_crash_stops_cleanly(tmp_path):
+    path = str(tmp_path / 'trace.gz')
+    with gzip.open(path, 'wt') as f:
+        for i in range(100):
+            f.write('{{"cycle": {}, "pad": "{}"}}\n'.format(i, 'x' * i))
+    crash(path, len(open(path, 'rb').read()) // 2)
+    # as earlier writers appended on every start
+    with gzip.open(path, 'at') as f:
+        f.write('{"cycle": 100}\n')
+
+    cycles = [r['cycle'] for r in read_trace(path)]
+    assert cycles == list(range(len(cycles)))
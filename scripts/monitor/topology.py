@@ -0,0 +1,320 @@
+from logging import getLogger as logging_getLogger
+from json import loads as json_loads, dumps as json_dumps
+from subprocess import Popen, PIPE
+from time import monotonic
+from threading import Lock
+
+# migration of a (non jumbo) chunk of a collection from a shard to another, its chunks matched by namespace or,
+# as of MongoDB 5.0, by the uuid of the collection
+MOVE_CHUNK_JS = '''
+var config = db.getSiblingDB("config");
+var coll = config.collections.findOne({{_id: {0}}});
+var q = {{shard: {1}, jumbo: {{$ne: true}}, $or: [{{ns: {0}}}]}};
+if (coll !== null && coll.uuid) {{ q.$or.push({{uuid: coll.uuid}}); }}
+var c = config.chunks.findOne(q);
+if (c === null) {{ throw new Error("no chunk of " + {0} + " on " + {1} + " to move"); }}
+JSON.stringify(db.adminCommand({{moveChunk: {0}, bounds: [c.min, c.max], to: {2}}}))
+'''
+
+# chunks per collection and shard, the namespace of the chunks of MongoDB 5.0 looked up by uuid
+NAMESPACE_CHUNKS_PIPELINE = [
+    {'$lookup': {'from': 'collections', 'localField': 'uuid', 'foreignField': 'uuid', 'as': 'coll'}},
+    {'$group': {'_id': {'ns': {'$ifNull': ['$ns', {'$arrayElemAt': ['$coll._id', 0]}]}, 'shard': '$shard'},
+                'n': {'$sum': 1}}},
+]
+NAMESPACE_CHUNKS_JS = '''
+var chunks = {{}};
+db.getSiblingDB("config").chunks.aggregate({}).forEach(function (d) {{
+    (chunks[d._id.ns] = chunks[d._id.ns] || {{}})[d._id.shard] = d.n;
+}});
+JSON.stringify(chunks)
+'''.format(json_dumps(NAMESPACE_CHUNKS_PIPELINE))
+
+# chunks, data size and primary databases per shard, from the config database and listDatabases through mongos
+SHARD_STATS_JS = '''
+var stats = {};
+function entry(shard) { return stats[shard] = stats[shard] || {chunks: 0, data_size: 0, primary_dbs: []}; }
+var config = db.getSiblingDB("config");
+config.chunks.aggregate([{$group: {_id: "$shard", n: {$sum: 1}}}]).forEach(function (d) { entry(d._id).chunks = d.n; });
+config.databases.find({primary: {$exists: true}}).forEach(function (d) { entry(d.primary).primary_dbs.push(d._id); });
+db.adminCommand({listDatabases: 1}).databases.forEach(function (d) {
+    for (var shard in d.shards || {}) { entry(shard).data_size += d.shards[shard]; }
+});
+JSON.stringify(stats)
+'''
+
+
+class ShellBackend:
+    """Cluster access through a fresh mongo shell process per command."""
+
+    def __init__(self, mongos_conn):
+        self.mongos_conn = mongos_conn
+
+    def _eval(self, js, what):
+        cmd = [
+            'mongo',
+            'admin',
+            '--quiet',
+            '--host', self.mongos_conn,
+            '--eval',
+            js
+        ]
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        res, err = p.communicate()
+
+        if not res:
+            raise Exception(err.decode() or 'no {} result'.format(what))
+        return json_loads(res)
+
+    def list_shards(self):
+        return self._eval('JSON.stringify(db.adminCommand({ listShards: 1 })["shards"])', 'listShards')
+
+    def shard_stats(self):
+        return self._eval(SHARD_STATS_JS, 'shard stats')
+
+    def drain_shard(self, name):
+        res = self._eval('JSON.stringify(db.adminCommand({{ removeShard: {} }}))'.format(json_dumps(name)),
+                         'removeShard')
+        if not res.get('ok'):
+            raise Exception(res.get('errmsg', 'removeShard failed'))
+        return res
+
+    def move_primary(self, db, to):
+        res = self._eval('JSON.stringify(db.adminCommand({{ movePrimary: {}, to: {} }}))'.format(
+            json_dumps(db), json_dumps(to)), 'movePrimary')
+        if not res.get('ok'):
+            raise Exception(res.get('errmsg', 'movePrimary failed'))
+        return res
+
+    def namespace_chunks(self):
+        return self._eval(NAMESPACE_CHUNKS_JS, 'chunks per collection')
+
+    def move_chunk(self, ns, from_shard, to_shard):
+        res = self._eval(MOVE_CHUNK_JS.format(json_dumps(ns), json_dumps(from_shard), json_dumps(to_shard)),
+                         'moveChunk')
+        if not res.get('ok'):
+            raise Exception(res.get('errmsg', 'moveChunk failed'))
+        return res
+
+    def balancer_window(self):
+        w = self._eval('JSON.stringify((db.getSiblingDB("config").settings.findOne({ _id: "balancer" }) || {})'
+                       '.activeWindow || null)', 'balancer settings')
+        return (w['start'], w['stop']) if w else None
+
+    def stop_draining(self, name):
+        return self._eval('JSON.stringify(db.getSiblingDB("config").shards.updateOne({{ _id: {} }}, '
+                          '{{ $unset: {{ draining: true }} }}))'.format(json_dumps(name)), 'stop draining')
+
+
+class PyMongoBackend:
+    """Cluster access through a persistent, pooled driver connection to mongos."""
+
+    def __init__(self, mongos_conn, max_pool_size=4, timeout_ms=5000):
+        from pymongo import MongoClient
+
+        self.client = MongoClient('mongodb://' + mongos_conn,
+                                  maxPoolSize=max_pool_size,
+                                  connectTimeoutMS=timeout_ms,
+                                  serverSelectionTimeoutMS=timeout_ms)
+
+    def list_shards(self):
+        return self.client.admin.command('listShards')['shards']
+
+    def shard_stats(self):
+        stats = {}
+
+        def entry(shard):
+            return stats.setdefault(shard, {'chunks': 0, 'data_size': 0, 'primary_dbs': []})
+
+        config = self.client.config
+        for d in config.chunks.aggregate([{'$group': {'_id': '$shard', 'n': {'$sum': 1}}}]):
+            entry(d['_id'])['chunks'] = d['n']
+        for d in config.databases.find({'primary': {'$exists': True}}, {'primary': 1}):
+            entry(d['primary'])['primary_dbs'].append(d['_id'])
+        for d in self.client.admin.command('listDatabases')['databases']:
+            for shard, size in d.get('shards', {}).items():
+                entry(shard)['data_size'] += size
+        return stats
+
+    def drain_shard(self, name):
+        """removeShard, starting the drain of the shard on the first call and reporting its progress after."""
+        return self.client.admin.command('removeShard', name)
+
+    def move_primary(self, db, to):
+        return self.client.admin.command('movePrimary', db, to=to)
+
+    def stop_draining(self, name):
+        """
+        Stop an ongoing drain, leaving the shard in the cluster, by clearing the draining flag of its config.shards
+        document: not a supported edit of the cluster metadata, only done with drain_cancel_unset.
+        """
+        self.client.config.shards.update_one({'_id': name}, {'$unset': {'draining': True}})
+
+    def namespace_chunks(self):
+        """{namespace: {shard id: number of chunks}} of every sharded collection."""
+        chunks = {}
+        for d in self.client.config.chunks.aggregate(NAMESPACE_CHUNKS_PIPELINE):
+            chunks.setdefault(d['_id']['ns'], {})[d['_id']['shard']] = d['n']
+        return chunks
+
+    def move_chunk(self, ns, from_shard, to_shard):
+        """Migrate a chunk of collection ns on from_shard, not a jumbo one, to to_shard."""
+        config = self.client.config
+        coll = config.collections.find_one({'_id': ns}, {'uuid': 1}) or {}
+        match = [{'ns': ns}] + ([{'uuid': coll['uuid']}] if coll.get('uuid') else [])
+        c = config.chunks.find_one({'shard': from_shard, 'jumbo': {'$ne': True}, '$or': match})
+        if c is None:
+            raise Exception('no chunk of {} on {} to move'.format(ns, from_shard))
+        return self.client.admin.command('moveChunk', ns, bounds=[c['min'], c['max']], to=to_shard)
+
+    def balancer_window(self):
+        """(start, stop) 'HH:MM' of the balancer active window, None if the balancer may run any time."""
+        settings = self.client.config.settings.find_one({'_id': 'balancer'}) or {}
+        w = settings.get('activeWindow')
+        return (w['start'], w['stop']) if w else None
+
+
+class MemoryBackend:
+    """
+    In-process stand-in of a cluster, holding its listShards documents. A draining shard loses up to
+    migrate_per_call chunks on every removeShard. The stats of a shard may break its chunks down by collection
+    in namespaces, {namespace: number of chunks}.
+    """
+
+    def __init__(self, shards=(), stats=None, migrate_per_call=8, window=None):
+        self.shards = [dict(d) for d in shards]
+        self.stats = dict(stats or {})
+        self.migrate_per_call = migrate_per_call
+        self.window = window
+
+    def list_shards(self):
+        return [dict(d) for d in self.shards]
+
+    def shard_stats(self):
+        return {k: dict(v) for k, v in self.stats.items()}
+
+    def add_shard(self, host):
+        self.shards.append({'_id': host.split('/')[0], 'host': host, 'state': 1})
+
+    def remove_shard(self, name):
+        self.shards = [d for d in self.shards if d['_id'] != name]
+        self.stats.pop(name, None)
+
+    def drain_shard(self, name):
+        shard = next((d for d in self.shards if d['_id'] == name), None)
+        if shard is None:
+            raise Exception('Shard {} not found'.format(name))
+        if not shard.get('draining'):
+            shard['draining'] = True
+            return {'msg': 'draining started successfully', 'state': 'started', 'shard': name, 'ok': 1}
+
+        st = self.stats.setdefault(name, {'chunks': 0, 'data_size': 0, 'primary_dbs': []})
+        for _ in range(min(st['chunks'], self.migrate_per_call)):
+            namespaces = st.get('namespaces')
+            self._take_chunk(st, max(namespaces, key=namespaces.get) if namespaces else None)
+        if st['chunks'] or st['primary_dbs']:
+            return {'msg': 'draining ongoing', 'state': 'ongoing', 'ok': 1, 'dbsToMove': list(st['primary_dbs']),
+                    'remaining': {'chunks': st['chunks'], 'dbs': len(st['primary_dbs']), 'jumboChunks': 0}}
+
+        self.remove_shard(name)
+        return {'msg': 'removeshard completed successfully', 'state': 'completed', 'shard': name, 'ok': 1}
+
+    def move_primary(self, db, to):
+        for st in self.stats.values():
+            if db in st['primary_dbs']:
+                st['primary_dbs'].remove(db)
+        self.stats.setdefault(to, {'chunks': 0, 'data_size': 0, 'primary_dbs': []})['primary_dbs'].append(db)
+        return {'ok': 1}
+
+    def stop_draining(self, name):
+        for d in self.shards:
+            if d['_id'] == name:
+                d.pop('draining', None)
+
+    @staticmethod
+    def _take_chunk(st, ns):
+        """Take a chunk of collection ns, None if not broken down by collection, off the stats st, its data size."""
+        size = st['data_size'] // st['chunks']
+        st['chunks'] -= 1
+        st['data_size'] -= size
+        if ns is not None:
+            st['namespaces'][ns] -= 1
+        return size
+
+    def namespace_chunks(self):
+        chunks = {}
+        for shard, st in self.stats.items():
+            for ns, n in st.get('namespaces', {}).items():
+                chunks.setdefault(ns, {})[shard] = n
+        return chunks
+
+    def move_chunk(self, ns, from_shard, to_shard):
+        src = self.stats.get(from_shard)
+        if not src or not src.get('namespaces', {}).get(ns):
+            raise Exception('no chunk of {} on {} to move'.format(ns, from_shard))
+        dst = self.stats.setdefault(to_shard, {'chunks': 0, 'data_size': 0, 'primary_dbs': []})
+        dst['data_size'] += self._take_chunk(src, ns)
+        dst['chunks'] += 1
+        dst.setdefault('namespaces', {}).setdefault(ns, 0)
+        dst['namespaces'][ns] += 1
+        return {'ok': 1}
+
+    def balancer_window(self):
+        return self.window
+
+
+def make_backend(name, mongos_conn):
+    """
+    Backend of the given name, falling back to the mongo shell if pymongo is not installed.
+    :param: name: one of pymongo, shell, memory
+    :param: mongos_conn: host:port of mongos
+    """
+    if name == 'pymongo':
+        try:
+            return PyMongoBackend(mongos_conn)
+        except ImportError:
+            logging_getLogger(__name__).warning('pymongo not installed, falling back to mongo shell')
+            return ShellBackend(mongos_conn)
+    elif name == 'shell':
+        return ShellBackend(mongos_conn)
+    elif name == 'memory':
+        return MemoryBackend()
+
+    raise ValueError('topology backend not one of: pymongo, shell, memory')
+
+
+class Topology:
+    """Shards of the cluster, cached for ttl seconds or until invalidated."""
+
+    def __init__(self, backend, ttl=5.0):
+        self.logger = logging_getLogger(__name__)
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = Lock()
+        self._shards = None
+        self._fetched = 0.0
+
+    def shards(self):
+        """Shard documents of listShards, raising the error of the backend if they cannot be read."""
+        with self._lock:
+            if self._shards is None or monotonic() - self._fetched > self.ttl:
+                # errors are not cached, next call retries, and propagate as a failed read is not an empty cluster
+                self._shards = self.backend.list_shards()
+                self._fetched = monotonic()
+
+            return [dict(d) for d in self._shards]
+
+    def shard_stats(self):
+        """
+        {shard id: {'chunks': int, 'data_size': bytes, 'primary_dbs': [database]}}, uncached as it is only read on
+        scale-in, and empty on errors.
+        """
+        try:
+            return self.backend.shard_stats()
+        except Exception as e:
+            self.logger.error('Shard stats failed -- {}'.format(e))
+            return {}
+
+    def invalidate(self):
+        with self._lock:
+            self._shards = None
@@ -0,0 +1,85 @@
+from json import dumps as json_dumps
+from json import loads as json_loads
+from os.path import exists
+import gzip
+import zlib
+
+
+def segment_path(path, n):
+    """Path of segment n of the trace path, path itself for the first, e.g. trace.2.gz for trace.gz."""
+    if n == 0:
+        return path
+    if path.endswith('.gz'):
+        return '{}.{}.gz'.format(path[:-3], n)
+    return '{}.{}'.format(path, n)
+
+
+class TraceWriter:
+    """
+    Append-only trace of the monitoring cycles, as gzip compressed JSON lines. Every record is flushed, so the
+    trace is readable up to the last complete cycle even if the monitor dies. Every start writes a new segment
+    rather than appending to the last one, whose gzip member is left truncated by a crash and would hide the
+    members after it from gzip.
+    """
+
+    def __init__(self, path):
+        n = 0
+        while exists(segment_path(path, n)):
+            n += 1
+        self.path = segment_path(path, n)
+        self.f = gzip.open(self.path, 'wt', encoding='utf-8')
+
+    def write(self, record):
+        self.f.write(json_dumps(record, separators=(',', ':')) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def member_lines(f, chunk_size=1 << 16):
+    """
+    Complete lines of the gzip members of the binary file f, decompressed a chunk at a time, up to the end of the
+    last complete line before the end of the file or the first corrupt data, e.g. a member left truncated by a
+    crash and appended to after it.
+    """
+    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    pending = b''
+    data = f.read(chunk_size)
+    while data:
+        backup = d.copy()
+        try:
+            lines = (pending + d.decompress(data)).split(b'\n')
+        except zlib.error:
+            # keep what decompresses before the corrupt data
+            out = b''
+            for i in range(0, len(data), 64):
+                try:
+                    out += backup.decompress(data[i:i + 64])
+                except zlib.error:
+                    break
+            yield from (pending + out).split(b'\n')[:-1]
+            return
+        pending = lines.pop()
+        yield from lines
+        if d.eof:
+            # next member, maybe in the data left over
+            data = d.unused_data or f.read(chunk_size)
+            d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        else:
+            data = f.read(chunk_size)
+
+
+def read_trace(path):
+    """Records of a trace in order, its segments one after the other, each up to its last complete record."""
+    n = 0
+    while n == 0 or exists(segment_path(path, n)):
+        with open(segment_path(path, n), 'rb') as f:
+            for line in member_lines(f):
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    # the rest of a truncated member decompressed along with what was appended after it
+                    break
+                yield record
+        n += 1